@@ -0,0 +1,314 @@
+import os
+import json
+import zlib
+import threading
+from collections import OrderedDict
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from rasterio.coords import BoundingBox
+from rasterio.transform import Affine, array_bounds
+from raster_catalog import refresh_catalog, get_entries, band_key, file_name_pattern
+from build_manifest import is_up_to_date, record_output, save_manifest, input_hash
+from tracing import span, log, annotate, file_size, start_trace
+
+# Folder of the band cubes, one subfolder per band, and the folder of the GeoTIFFs they are ingested from
+store_folder = 'C:/Users/nboub/Pictures/Band_Store'
+source_folder = 'C:/Users/nboub/Pictures/Data'
+
+# Read rasters from the band cubes where a cube holds the same file contents, instead of opening each GeoTIFF
+use_store = True
+
+# Shape of the chunks as (years, rows, columns): a year, a window or a pixel's history only decompresses the chunks it touches
+chunk_shape = (8, 128, 128)
+
+# zlib compression level of the chunks, the float bytes are shuffled first so they compress better
+compression_level = 6
+
+# Overviews halve the previous level until its smaller side is at most this size
+overview_min_size = 64
+
+# Byte budget of the decompressed chunks kept in memory by each cube
+chunk_cache_bytes = 64 * 1024 * 1024
+
+# Cubes already opened in this run, reopened when their metadata changes
+_cubes = {}
+_cubes_lock = threading.Lock()
+
+# Function to get the folder of a band's cube, band names of every script map to the same folder
+def cube_folder(band):
+    return os.path.join(store_folder, band_key(band))
+
+# Function to compress a chunk: bytes of each float are grouped by significance, then deflated
+def encode_chunk(chunk):
+    shuffled = np.ascontiguousarray(chunk, dtype=np.float32).view(np.uint8).reshape(-1, 4).T
+    return zlib.compress(shuffled.tobytes(), compression_level)
+
+# Function to decompress a chunk of the given shape
+def decode_chunk(data, shape):
+    shuffled = np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(4, -1)
+    return np.ascontiguousarray(shuffled.T).view(np.float32).reshape(shape)
+
+# Function to downsample a stack of years by 2 with a NaN-aware mean of each 2x2 block
+def downsample_by_two(stack):
+    n_years, height, width = stack.shape
+    padded = np.full((n_years, height + height % 2, width + width % 2), np.nan, dtype=np.float32)
+    padded[:, :height, :width] = stack
+    blocks = padded.reshape(n_years, padded.shape[1] // 2, 2, padded.shape[2] // 2, 2)
+    valid = ~np.isnan(blocks)
+    count = valid.sum(axis=(2, 4))
+    total = np.where(valid, blocks, 0).sum(axis=(2, 4))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, total / count, np.nan).astype(np.float32)
+
+# Function to read one GeoTIFF as float32 with nodata set to NaN, with its grid
+def read_geotiff(path):
+    with span('read', path=path, bytes_read=file_size(path)), rasterio.open(path) as src:
+        array = src.read(1).astype(np.float32)
+        if src.nodata is not None:
+            array[array == src.nodata] = np.nan
+        return array, src.crs, src.transform, src.nodata
+
+# Function to convert the years of a band into one cube with its overviews
+# The years are read chunk_shape[0] at a time, so memory holds one row of chunks, not the whole band
+def write_cube(band, paths_by_year, folder):
+    years = sorted(paths_by_year)
+    first, crs, transform, nodata = read_geotiff(paths_by_year[years[0]])
+    height, width = first.shape
+    levels = [{'shape': [height, width], 'transform': list(transform)[:6]}]
+    while min(levels[-1]['shape']) > overview_min_size:
+        level_height, level_width = levels[-1]['shape']
+        level_transform = Affine(*levels[-1]['transform']) * Affine.scale(2)
+        levels.append({'shape': [-(-level_height // 2), -(-level_width // 2)], 'transform': list(level_transform)[:6]})
+
+    # Readers fall back to the GeoTIFFs while the cube is rewritten
+    os.makedirs(folder, exist_ok=True)
+    if os.path.exists(os.path.join(folder, 'meta.json')):
+        os.remove(os.path.join(folder, 'meta.json'))
+    data_files = [open(os.path.join(folder, f"level{n}.bin.tmp"), 'wb') for n in range(len(levels))]
+    indexes = [[] for _ in levels]
+    offsets = [0] * len(levels)
+    try:
+        for year_start in range(0, len(years), chunk_shape[0]):
+            group = years[year_start:year_start + chunk_shape[0]]
+            stack = np.empty((len(group), height, width), dtype=np.float32)
+            for n_year, year in enumerate(group):
+                array, year_crs, year_transform, _ = read_geotiff(paths_by_year[year])
+                if array.shape != (height, width) or year_crs != crs or year_transform != transform:
+                    raise ValueError(f"{paths_by_year[year]} is not on the grid of {paths_by_year[years[0]]}")
+                stack[n_year] = array
+            for n_level in range(len(levels)):
+                if n_level > 0:
+                    stack = downsample_by_two(stack)
+                with span('encode', level=n_level) as args:
+                    start_offset = offsets[n_level]
+                    for row in range(0, stack.shape[1], chunk_shape[1]):
+                        for col in range(0, stack.shape[2], chunk_shape[2]):
+                            data = encode_chunk(stack[:, row:row + chunk_shape[1], col:col + chunk_shape[2]])
+                            data_files[n_level].write(data)
+                            indexes[n_level].append((offsets[n_level], len(data)))
+                            offsets[n_level] += len(data)
+                    args['bytes_written'] = offsets[n_level] - start_offset
+    finally:
+        for data_file in data_files:
+            data_file.close()
+
+    # Chunks were written year group by year group, rows then columns within each group
+    for n_level, level in enumerate(levels):
+        n_rows = -(-level['shape'][0] // chunk_shape[1])
+        n_cols = -(-level['shape'][1] // chunk_shape[2])
+        index = np.array(indexes[n_level], dtype=np.int64).reshape(-1, n_rows, n_cols, 2)
+        with open(os.path.join(folder, f"level{n_level}_index.npy.tmp"), 'wb') as f:
+            np.save(f, index)
+        os.replace(os.path.join(folder, f"level{n_level}_index.npy.tmp"), os.path.join(folder, f"level{n_level}_index.npy"))
+        os.replace(os.path.join(folder, f"level{n_level}.bin.tmp"), os.path.join(folder, f"level{n_level}.bin"))
+
+    # The metadata is written last, a cube is only opened once it is complete
+    meta = {
+        'band': band_key(band),
+        'years': years,
+        'sources': {str(year): input_hash(paths_by_year[year]) for year in years},
+        'crs': crs.to_wkt() if crs else None,
+        'nodata': nodata,
+        'dtype': 'float32',
+        'chunk_shape': list(chunk_shape),
+        'compression': 'zlib',
+        'compression_level': compression_level,
+        'shuffle': True,
+        'levels': levels
+    }
+    with open(os.path.join(folder, 'meta.json.tmp'), 'w') as f:
+        json.dump(meta, f)
+    os.replace(os.path.join(folder, 'meta.json.tmp'), os.path.join(folder, 'meta.json'))
+    log(f"Ingested {len(years)} years of {band} into {folder} with {len(levels) - 1} overviews.")
+
+# Function to describe the storage parameters of the cubes for the build manifest
+def store_params():
+    return {'chunk_shape': list(chunk_shape), 'compression_level': compression_level, 'overview_min_size': overview_min_size}
+
+# Function to ingest one band from the source folder, only if its GeoTIFFs or the storage parameters changed
+def ingest_band(band):
+    entries = [entry for entry in get_entries(band, folder=source_folder) if entry['valid_count']]
+    if not entries:
+        log(f"No {band} rasters to ingest in {source_folder}")
+        return
+    paths_by_year = {entry['year']: entry['path'] for entry in entries}
+    folder = cube_folder(band)
+    meta_path = os.path.join(folder, 'meta.json')
+    inputs = [paths_by_year[year] for year in sorted(paths_by_year)]
+    if is_up_to_date(meta_path, inputs, store_params()):
+        log(f"Cube of {band} is up to date")
+        return
+    with span('ingest', band=band_key(band), years=len(entries)):
+        write_cube(band, paths_by_year, folder)
+    record_output(meta_path, inputs, store_params())
+
+# Function to ingest every band found in the source folder
+def ingest_bands():
+    bands = sorted({entry['band'] for entry in get_entries(folder=source_folder)})
+    for band in bands:
+        ingest_band(band)
+    save_manifest()
+
+# Lazy reader of a band cube: slices decompress only the chunks they touch, recently used chunks stay in memory
+class BandCube:
+    def __init__(self, folder):
+        with open(os.path.join(folder, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.folder = folder
+        self.years = self.meta['years']
+        self.crs = CRS.from_wkt(self.meta['crs']) if self.meta['crs'] else None
+        self.nodata = self.meta['nodata']
+        self.chunk_shape = tuple(self.meta['chunk_shape'])
+        self.levels = [{
+            'shape': tuple(level['shape']),
+            'transform': Affine(*level['transform']),
+            'index': np.load(os.path.join(folder, f"level{n}_index.npy")),
+            'data': None
+        } for n, level in enumerate(self.meta['levels'])]
+        self.shape = (len(self.years),) + self.levels[0]['shape']
+        self.transform = self.levels[0]['transform']
+        self.cache = OrderedDict()
+        self.cache_bytes = 0
+        self.lock = threading.Lock()
+
+    # Memory map of a level's chunk file, opened on first use
+    def level_data(self, level):
+        if self.levels[level]['data'] is None:
+            path = os.path.join(self.folder, f"level{level}.bin")
+            self.levels[level]['data'] = np.memmap(path, dtype=np.uint8, mode='r') if os.path.getsize(path) else np.zeros(0, np.uint8)
+        return self.levels[level]['data']
+
+    # Function to get one decompressed chunk, from the cache or the memory-mapped file
+    def chunk(self, level, year_chunk, row_chunk, col_chunk):
+        key = (level, year_chunk, row_chunk, col_chunk)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        height, width = self.levels[level]['shape']
+        shape = (min(self.chunk_shape[0], len(self.years) - year_chunk * self.chunk_shape[0]),
+                 min(self.chunk_shape[1], height - row_chunk * self.chunk_shape[1]),
+                 min(self.chunk_shape[2], width - col_chunk * self.chunk_shape[2]))
+        offset, length = self.levels[level]['index'][year_chunk, row_chunk, col_chunk]
+        chunk = decode_chunk(self.level_data(level)[offset:offset + length], shape)
+        annotate(bytes_read=int(length))
+        with self.lock:
+            self.cache[key] = chunk
+            self.cache_bytes += chunk.nbytes
+            while self.cache_bytes > chunk_cache_bytes and len(self.cache) > 1:
+                _, evicted = self.cache.popitem(last=False)
+                self.cache_bytes -= evicted.nbytes
+        return chunk
+
+    # Function to read a block of years, rows and columns of a level, given as slices with a step of 1
+    def read(self, years=slice(None), rows=slice(None), cols=slice(None), level=0):
+        height, width = self.levels[level]['shape']
+        y0, y1, _ = years.indices(len(self.years))
+        r0, r1, _ = rows.indices(height)
+        c0, c1, _ = cols.indices(width)
+        out = np.empty((max(0, y1 - y0), max(0, r1 - r0), max(0, c1 - c0)), dtype=np.float32)
+        cy, cr, cc = self.chunk_shape
+        for year_chunk in range(y0 // cy, -(-y1 // cy)):
+            for row_chunk in range(r0 // cr, -(-r1 // cr)):
+                for col_chunk in range(c0 // cc, -(-c1 // cc)):
+                    chunk = self.chunk(level, year_chunk, row_chunk, col_chunk)
+                    # Overlap of the request and the chunk, in cube coordinates
+                    ya, yb = max(y0, year_chunk * cy), min(y1, (year_chunk + 1) * cy)
+                    ra, rb = max(r0, row_chunk * cr), min(r1, (row_chunk + 1) * cr)
+                    ca, cb = max(c0, col_chunk * cc), min(c1, (col_chunk + 1) * cc)
+                    out[ya - y0:yb - y0, ra - r0:rb - r0, ca - c0:cb - c0] = \
+                        chunk[ya - year_chunk * cy:yb - year_chunk * cy, ra - row_chunk * cr:rb - row_chunk * cr, ca - col_chunk * cc:cb - col_chunk * cc]
+        return out
+
+    # Function to read one year, optionally only a window given as (rows, cols) slices
+    def read_year(self, year, window=None, level=0):
+        position = self.years.index(year)
+        rows, cols = window if window is not None else (slice(None), slice(None))
+        return self.read(slice(position, position + 1), rows, cols, level)[0]
+
+    # Function to read the full history of one pixel
+    def read_history(self, row, col, level=0):
+        return self.read(slice(None), slice(row, row + 1), slice(col, col + 1), level)[:, 0, 0]
+
+    # Function to pick the smallest level that still has at least the requested size
+    def level_for(self, height=None, width=None):
+        for level in range(len(self.levels) - 1, 0, -1):
+            level_height, level_width = self.levels[level]['shape']
+            if (height is None or level_height >= height) and (width is None or level_width >= width):
+                return level
+        return 0
+
+    # Function to get the bounds of the cube in its CRS
+    def bounds(self):
+        return BoundingBox(*array_bounds(self.shape[1], self.shape[2], self.transform))
+
+    # Function to check whether a year was ingested from a file with the given content hash
+    def has_source(self, year, sha256):
+        return self.meta['sources'].get(str(year)) == sha256
+
+# Function to open the cube of a band, None if it was never ingested
+def open_cube(band):
+    folder = cube_folder(band)
+    meta_path = os.path.join(folder, 'meta.json')
+    try:
+        mtime_ns = os.stat(meta_path).st_mtime_ns
+    except OSError:
+        return None
+    with _cubes_lock:
+        cube, known_mtime_ns = _cubes.get(folder, (None, None))
+        if cube is None or known_mtime_ns != mtime_ns:
+            try:
+                cube = BandCube(folder)
+            except OSError:  # Being rewritten
+                return None
+            _cubes[folder] = (cube, mtime_ns)
+        return cube
+
+# Function to find the cube and year holding the same contents as a GeoTIFF, None if there is none
+def find_stored(path):
+    if not use_store:
+        return None, None
+    match = file_name_pattern.match(os.path.basename(path))
+    if not match:
+        return None, None
+    cube = open_cube(match.group('band'))
+    year = int(match.group('year'))
+    if cube is None or not cube.has_source(year, input_hash(path)):
+        return None, None
+    return cube, year
+
+# Function to read a GeoTIFF's data from its band cube as float32 with NaN for nodata, with the CRS and transform
+# Returns None when the file is not in a cube or changed since it was ingested, callers then read the GeoTIFF
+def read_stored(path):
+    cube, year = find_stored(path)
+    if cube is None:
+        return None
+    with span('read', path=path, store=True):
+        return cube.read_year(year), cube.crs, cube.transform
+
+# Ingest every band of the source folder into its cube
+if __name__ == '__main__':
+    start_trace()
+    refresh_catalog()
+    ingest_bands()
@@ -0,0 +1,505 @@
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import threading
+import contextlib
+import http.client
+import http.server
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import rasterio
+import pyvista as pv
+from PIL import Image
+from rasterio.transform import from_bounds
+from rasterio.warp import transform_bounds
+import raster_cache
+import reproject_index
+import raster_catalog
+import build_manifest
+import tracing
+import band_store
+import timeseries
+import climatology
+import zonal_stats
+import legend_atlas
+import tif_to_png
+import create_plots
+import create_3D
+import create_gifs
+import server
+
+# Folder the synthetic rasters and every output of the benchmark are written to, emptied before each run
+benchmark_folder = os.path.join(tempfile.gettempdir(), 'crete_benchmark')
+
+# Machine-readable results of the run
+results_path = 'benchmark_results.json'
+
+# Synthetic data: size and CRS of the DEM and of the band rasters, the bands and the years
+# The extent is in longitude and latitude, both grids cover it in their own CRS
+synthetic_data = {
+    'dem_shape': (600, 1200),
+    'dem_crs': 'EPSG:2100',
+    'band_shape': (60, 160),
+    'band_crs': 'EPSG:4326',
+    'bands': ['Temperature_2m', 'Total_Precipitation', 'Soil_Moisture'],
+    'years': list(range(1990, 1998)),
+    'extent': (23.4, 34.8, 26.4, 35.8),
+    'seed': 0
+}
+
+# Typical value and spread of each band, so limits and colorbars look like the real data
+band_ranges = {
+    'Temperature_2m': (291.0, 4.0),
+    'Total_Precipitation': (0.0015, 0.0008),
+    'Soil_Moisture': (0.25, 0.06),
+    'Surface_Pressure': (100500.0, 900.0),
+    'Wind_U': (0.5, 3.0)
+}
+
+# Nodata value written over the sea in the band rasters
+synthetic_nodata = -9999.0
+
+# Number of times each stage is run, the median is reported
+repeats = 3
+
+# Stages to time, plot frames are the input of the GIF assembly
+run_stages = {
+    'catalog_refresh': True,
+    'get_global_min_max': True,
+    'band_store': True,
+    'timeseries': True,
+    'climatology': True,
+    'zonal_statistics': True,
+    'load_and_resample': True,
+    'colormap_png': True,
+    'plot_and_save_data': True,
+    'legend_atlas': True,
+    'plot_data': True,
+    'gif_assembly': True,
+    'server': True
+}
+
+# Number of frames rendered by the 3D stages, the legacy plot_data waits one second per frame
+render_frames = 3
+
+# Load on server.py: concurrent clients, requests per client and the widths requested from /render
+server_clients = 8
+server_requests_per_client = 50
+render_widths = [None, 256, 512]
+
+# Overlay encodings of tif_to_png.py compared by time and total size
+overlay_encodings = ['rgba', 'palette', 'webp']
+
+# Hide the progress printed by the scripts while a stage is timed
+quiet_stages = True
+
+# Function to make a smooth random field, a sum of waves with a little noise
+def synthetic_field(shape, rng, offset, spread):
+    y, x = np.mgrid[0:1:shape[0] * 1j, 0:1:shape[1] * 1j]
+    field = np.zeros(shape)
+    for _ in range(4):
+        fx, fy = rng.uniform(0.5, 3, size=2)
+        px, py = rng.uniform(0, 2 * np.pi, size=2)
+        field += rng.normal() * np.sin(2 * np.pi * fx * x + px) * np.cos(2 * np.pi * fy * y + py)
+    field += 0.05 * rng.standard_normal(shape)
+    return (offset + spread * field / 2).astype(np.float32)
+
+# Function to make an elongated island mask like Crete
+def island_mask(shape):
+    y, x = np.mgrid[-1:1:shape[0] * 1j, -1:1:shape[1] * 1j]
+    return (x / 0.85) ** 2 + (y / 0.45) ** 2 + 0.08 * np.sin(9 * x) * np.cos(5 * y) < 1
+
+# Function to get the affine transform of a grid covering the extent in the given CRS
+def grid_transform(crs, shape):
+    bounds = transform_bounds('EPSG:4326', crs, *synthetic_data['extent'])
+    return from_bounds(*bounds, shape[1], shape[0])
+
+# Function to write a single band float32 GeoTIFF
+def write_geotiff(path, array, crs, transform, nodata=None):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    profile = {'driver': 'GTiff', 'height': array.shape[0], 'width': array.shape[1], 'count': 1,
+               'dtype': 'float32', 'crs': crs, 'transform': transform, 'nodata': nodata}
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(array.astype(np.float32), 1)
+
+# Function to generate the DEM: a few mountain ranges on the island, sea level around it
+def generate_dem(path, rng):
+    shape = synthetic_data['dem_shape']
+    y, x = np.mgrid[-1:1:shape[0] * 1j, -1:1:shape[1] * 1j]
+    elevation = np.zeros(shape)
+    for cx in (-0.55, -0.1, 0.45):
+        cy = rng.uniform(-0.15, 0.15)
+        elevation += rng.uniform(1200, 2400) * np.exp(-((x - cx) ** 2 / 0.04 + (y - cy) ** 2 / 0.05))
+    elevation += 60 * np.abs(np.sin(40 * x) * np.cos(30 * y))
+    elevation *= island_mask(shape)
+    write_geotiff(path, elevation, synthetic_data['dem_crs'], grid_transform(synthetic_data['dem_crs'], shape))
+
+# Function to generate every band and year into the Data folder, with a copy in the band folder of create_plots.py and create_3D.py
+def generate_bands(bands, rng):
+    shape = synthetic_data['band_shape']
+    crs = synthetic_data['band_crs']
+    transform = grid_transform(crs, shape)
+    sea = ~island_mask(shape)
+    for band in bands:
+        offset, spread = band_ranges.get(band['band'], (0.0, 1.0))
+        for n_year, year in enumerate(synthetic_data['years']):
+            # A slow trend over the years on top of the yearly field
+            array = synthetic_field(shape, rng, offset + 0.05 * spread * n_year, spread)
+            array[sea] = synthetic_nodata
+            data_path = os.path.join(tif_to_png.data_folder, f"Crete_{band['band']}_{year}.tif")
+            write_geotiff(data_path, array, crs, transform, synthetic_nodata)
+            band['data_paths'][year] = data_path
+            band_path = os.path.join(band['folder_path'], f"Crete_{band['band']}_{year}.tif")
+            os.makedirs(band['folder_path'], exist_ok=True)
+            shutil.copyfile(data_path, band_path)
+            band['band_paths'][year] = band_path
+
+# Number of zones of each synthetic zone layer as (rows, columns) of rectangles over the extent
+synthetic_zones = {'prefecture': (1, 4), 'municipality': (4, 12)}
+
+# Function to generate the zone layers as GeoJSON grids of rectangles over the extent
+def generate_zones():
+    west, south, east, north = synthetic_data['extent']
+    for layer, (n_rows, n_cols) in synthetic_zones.items():
+        lats, lons = np.linspace(south, north, n_rows + 1), np.linspace(west, east, n_cols + 1)
+        features = [{'type': 'Feature', 'properties': {'NAME': f"{layer} {row}-{col}"},
+                     'geometry': {'type': 'Polygon', 'coordinates': [[[lons[col], lats[row]], [lons[col + 1], lats[row]],
+                                                                     [lons[col + 1], lats[row + 1]], [lons[col], lats[row + 1]],
+                                                                     [lons[col], lats[row]]]]}}
+                    for row in range(n_rows) for col in range(n_cols)]
+        with open(zonal_stats.zone_layers[layer]['path'], 'w') as f:
+            json.dump({'type': 'FeatureCollection', 'features': features}, f)
+
+# Function to point the configuration of every script into the benchmark folder, so nothing is read from or written to C:/Users/nboub
+# Returns the benchmarked bands with their names in each script
+def use_benchmark_folder(folder):
+    raster_cache.cache_folder = os.path.join(folder, 'Reprojection_Cache')
+    reproject_index.index_folder = os.path.join(folder, 'Reprojection_Cache', 'index')
+    raster_catalog.catalog_path = os.path.join(folder, 'raster_catalog.sqlite')
+    build_manifest.manifest_path = os.path.join(folder, 'build_manifest.json')
+    build_manifest._manifest = None
+    tracing.trace_folder = os.path.join(folder, 'Traces')
+    band_store.store_folder = os.path.join(folder, 'Band_Store')
+    band_store.source_folder = os.path.join(folder, 'Data')
+    tif_to_png.data_folder = os.path.join(folder, 'Data')
+    tif_to_png.overlay_folder = os.path.join(folder, 'Data1')
+    tif_to_png.years = list(synthetic_data['years'])
+    create_3D.base_folder = folder
+    create_3D.dem_path = os.path.join(folder, 'crete_dem.tif')
+    create_plots.dem_path = create_3D.dem_path
+    create_plots.plot_folder = os.path.join(folder, 'Plots')
+    create_plots.csv_folder = folder
+    create_gifs.base_plot_path = create_plots.plot_folder
+    create_gifs.output_gif_path = os.path.join(folder, 'GIFs')
+    climatology.climatology_folder = os.path.join(folder, 'Climatology')
+    climatology.layer_folder = os.path.join(tif_to_png.overlay_folder, 'climatology')
+    zonal_stats.zone_layers = {layer: {'path': os.path.join(folder, f"{layer}.geojson"), 'name_field': 'NAME'} for layer in synthetic_zones}
+    zonal_stats.label_folder = os.path.join(folder, 'Zone_Labels')
+    zonal_stats.zonal_csv_path = os.path.join(folder, 'crete_zonal_statistics.csv')
+    zonal_stats.dem_path = create_3D.dem_path
+    legend_atlas.atlas_path = os.path.join(folder, 'Legends', 'legend_atlas.png')
+    legend_atlas.data_folder = tif_to_png.data_folder
+    server.DIRECTORY = tif_to_png.overlay_folder
+    server.RASTER_DIRECTORY = tif_to_png.data_folder
+
+    # Every stage is timed doing its full work
+    create_plots.incremental_build = False
+    create_gifs.incremental_build = False
+    create_3D.incremental_build = False
+    climatology.incremental_build = False
+
+    bands = []
+    for band in synthetic_data['bands']:
+        plot_band = next(name for name in create_plots.bands if raster_catalog.band_key(name) == raster_catalog.band_key(band))
+        folder_name = next(name for name, path in create_3D.folders.items() if path == os.path.basename(create_plots.base_paths[plot_band]))
+        create_plots.base_paths[plot_band] = os.path.join(folder, create_3D.folders[folder_name])
+        bands.append({
+            'band': band,
+            'plot_band': plot_band,
+            'folder_name': folder_name,
+            'folder_path': create_plots.base_paths[plot_band],
+            'output_folder': os.path.join(folder, f"{create_3D.folders[folder_name]}_Output"),
+            'data_paths': {},
+            'band_paths': {}
+        })
+    create_plots.bands = [band['plot_band'] for band in bands]
+    create_gifs.bands = list(create_plots.bands)
+    raster_catalog.catalog_folders = [tif_to_png.data_folder] + [band['folder_path'] for band in bands]
+    return bands
+
+# Function to remove the on-disk and in-memory reprojection caches, so the next resampling starts cold
+def clear_resample_cache():
+    shutil.rmtree(raster_cache.cache_folder, ignore_errors=True)
+    reproject_index._index_memo.clear()
+    reproject_index._subset_memo.clear()
+
+# Function to remove the pixel-major copies of the cubes, so the next update builds them again
+def clear_series():
+    timeseries._series.clear()
+    for band in timeseries.list_bands():
+        for name in ('series.json', 'series.npy', 'box_sums.npy', 'box_counts.npy'):
+            path = os.path.join(band_store.cube_folder(band), name)
+            if os.path.exists(path):
+                os.remove(path)
+
+# Function to run a stage repeatedly and summarize its wall-clock times
+# setup runs before every repetition and is not timed
+def time_stage(name, run, items, setup=None):
+    seconds = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        with contextlib.redirect_stdout(io.StringIO()) if quiet_stages else contextlib.nullcontext():
+            start = time.perf_counter()
+            run()
+            seconds.append(time.perf_counter() - start)
+    median = float(np.median(seconds))
+    print(f"{name}: {median:.3f} s median of {repeats} ({items / median:.1f} items/s)")
+    return {'seconds': seconds, 'median': median, 'min': min(seconds), 'max': max(seconds),
+            'items': items, 'items_per_second': items / median}
+
+# Function to summarize request latencies in milliseconds
+def latency_summary(latencies, elapsed):
+    latencies = np.asarray(latencies) * 1000
+    return {
+        'requests': len(latencies),
+        'requests_per_second': len(latencies) / elapsed,
+        'mean_ms': float(latencies.mean()),
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p90_ms': float(np.percentile(latencies, 90)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'max_ms': float(latencies.max())
+    }
+
+# Request handler of the benchmark, without the log line written for every request
+class QuietHttpRequestHandler(server.CachingHttpRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+# Function to load server.py with concurrent keep-alive clients requesting static overlays and rendered overlays
+def benchmark_server(bands):
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), QuietHttpRequestHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    port = httpd.server_address[1]
+
+    urls = []
+    for band in bands:
+        for year in synthetic_data['years']:
+            urls.append(('static', f"/Crete_{band['band']}_{year}.png"))
+            for width in render_widths:
+                urls.append(('render', f"/render/{band['band']}/{year}.png" + (f"?width={width}" if width else '')))
+
+    # Each client walks the URLs from its own offset, so the caches see both repeated and new keys
+    def client(n_client):
+        connection = http.client.HTTPConnection('127.0.0.1', port)
+        latencies = {'static': [], 'render': []}
+        errors = 0
+        for n_request in range(server_requests_per_client):
+            kind, url = urls[(n_client * 7 + n_request) % len(urls)]
+            start = time.perf_counter()
+            connection.request('GET', url)
+            response = connection.getresponse()
+            response.read()
+            latencies[kind].append(time.perf_counter() - start)
+            errors += response.status != 200
+        connection.close()
+        return latencies, errors
+
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(server_clients) as executor:
+            outcomes = list(executor.map(client, range(server_clients)))
+        elapsed = time.perf_counter() - start
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+    results = {'clients': server_clients, 'errors': sum(errors for _, errors in outcomes)}
+    for kind in ('static', 'render'):
+        latencies = [latency for client_latencies, _ in outcomes for latency in client_latencies[kind]]
+        if latencies:
+            results[kind] = latency_summary(latencies, elapsed)
+    results['all'] = latency_summary([latency for client_latencies, _ in outcomes for kind in client_latencies for latency in client_latencies[kind]], elapsed)
+    print(f"server: {results['all']['requests_per_second']:.0f} requests/s with {server_clients} clients, "
+          f"p50 {results['all']['p50_ms']:.1f} ms, p99 {results['all']['p99_ms']:.1f} ms, {results['errors']} errors")
+    return results
+
+# Function to describe the machine the benchmark ran on
+def machine_info():
+    return {
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'rasterio': rasterio.__version__,
+        'pyvista': pv.__version__
+    }
+
+# Generate the synthetic data, time every stage on it and write the results
+if __name__ == '__main__':
+    tracing.start_trace()
+    shutil.rmtree(benchmark_folder, ignore_errors=True)
+    os.makedirs(benchmark_folder)
+    bands = use_benchmark_folder(benchmark_folder)
+    years = synthetic_data['years']
+    n_rasters = len(bands) * len(years)
+
+    print(f"Generating {n_rasters} rasters and a DEM in {benchmark_folder}...")
+    rng = np.random.default_rng(synthetic_data['seed'])
+    generate_dem(create_3D.dem_path, rng)
+    generate_bands(bands, rng)
+    generate_zones()
+
+    results = {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'machine': machine_info(),
+        'config': {'synthetic_data': synthetic_data, 'repeats': repeats, 'render_frames': render_frames,
+                   'server_clients': server_clients, 'server_requests_per_client': server_requests_per_client,
+                   'terrain_lod': create_3D.terrain_lod, 'triangle_budget': create_3D.triangle_budget,
+                   'resampling_method': create_3D.resampling_method},
+        'stages': {}
+    }
+    stages = results['stages']
+
+    # The catalog is refreshed once even when its stage is skipped, every limit comes from it
+    if run_stages['catalog_refresh']:
+        stages['catalog_refresh'] = time_stage('catalog_refresh', raster_catalog.refresh_catalog, 2 * n_rasters,
+                                               setup=lambda: os.remove(raster_catalog.catalog_path) if os.path.exists(raster_catalog.catalog_path) else None)
+    else:
+        raster_catalog.refresh_catalog()
+
+    if run_stages['get_global_min_max']:
+        stages['get_global_min_max'] = time_stage('get_global_min_max', lambda: [create_3D.get_global_min_max(band['folder_path']) for band in bands], len(bands))
+
+    # Ingested cubes are read by every later stage, as in the pipeline
+    if run_stages['band_store']:
+        stages['band_store_ingest'] = time_stage('band_store_ingest', band_store.ingest_bands, n_rasters,
+                                                 setup=lambda: shutil.rmtree(band_store.store_folder, ignore_errors=True))
+        cubes = [band_store.open_cube(band['band']) for band in bands]
+        stages['band_store_read_year'] = time_stage('band_store_read_year', lambda: [cube.read_year(year) for cube in cubes for year in years], n_rasters)
+        _, height, width = cubes[0].shape
+        pixels = [(row, col) for row in range(0, height, max(1, height // 8)) for col in range(0, width, max(1, width // 8))]
+        stages['band_store_read_history'] = time_stage('band_store_read_history', lambda: [cube.read_history(row, col) for cube in cubes for row, col in pixels],
+                                                       len(cubes) * len(pixels))
+
+    # Point and box queries of the pixel-major copies behind /timeseries, built from the cubes, on a grid of points over the extent
+    if run_stages['band_store'] and run_stages['timeseries']:
+        stages['timeseries_build'] = time_stage('timeseries_build', lambda: [timeseries.update_series(band['band']) for band in bands], len(bands),
+                                                setup=clear_series)
+        west, south, east, north = synthetic_data['extent']
+        points = [(lat, lon) for lat in np.linspace(south, north, 10) for lon in np.linspace(west, east, 10)]
+        stages['timeseries_point'] = time_stage('timeseries_point', lambda: [timeseries.point_series(lat, lon) for lat, lon in points], len(points))
+        boxes = [(lon, lat, lon + (east - west) / 4, lat + (north - south) / 4) for lat, lon in points]
+        stages['timeseries_box'] = time_stage('timeseries_box', lambda: [timeseries.box_mean(box) for box in boxes], len(boxes))
+
+    # Per-pixel climatology of every band from its cube, in one worker and in the default pool
+    if run_stages['band_store'] and run_stages['climatology']:
+        stages['climatology_serial'] = time_stage('climatology_serial', lambda: climatology.process_bands(workers=1), n_rasters)
+        stages['climatology'] = time_stage('climatology', climatology.process_bands, n_rasters)
+
+    # Zonal statistics from cold label rasters, then from the cached ones
+    if run_stages['zonal_statistics']:
+        clear_labels = lambda: (shutil.rmtree(zonal_stats.label_folder, ignore_errors=True), zonal_stats._labels_memo.clear())
+        stages['zonal_statistics_cold'] = time_stage('zonal_statistics_cold', zonal_stats.compute_zonal_statistics, n_rasters, setup=clear_labels)
+        stages['zonal_statistics_warm'] = time_stage('zonal_statistics_warm', zonal_stats.compute_zonal_statistics, n_rasters)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        dem_data = create_3D.load_dem(create_3D.dem_path)
+    band_paths = [band['band_paths'][year] for band in bands for year in years]
+    if run_stages['load_and_resample']:
+        resample_all = lambda: [create_3D.load_and_resample(path, dem_data) for path in band_paths]
+        stages['load_and_resample_cold'] = time_stage('load_and_resample_cold', resample_all, len(band_paths), setup=clear_resample_cache)
+        stages['load_and_resample_warm'] = time_stage('load_and_resample_warm', resample_all, len(band_paths))
+
+    if run_stages['colormap_png']:
+        os.makedirs(tif_to_png.overlay_folder, exist_ok=True)
+        overlays = []
+        overlay_keys = []
+        for band in bands:
+            limits = raster_catalog.get_band_limits(band['band'], folder=tif_to_png.data_folder)
+            for year in years:
+                overlay_keys.append((band, year))
+                overlays.append((band['data_paths'][year], os.path.join(tif_to_png.overlay_folder, f"Crete_{band['band']}_{year}.png"),
+                                 tif_to_png.color_maps[band['band']], limits['min'], limits['max']))
+        arrays = [tif_to_png.read_band_array(tif_path)[0] for tif_path, _, _, _, _ in overlays]
+        rgba = [tif_to_png.apply_color_map_with_transparency(array, cmap, vmin, vmax) for array, (_, _, cmap, vmin, vmax) in zip(arrays, overlays)]
+        stages['colormap'] = time_stage('colormap', lambda: [tif_to_png.apply_color_map_with_transparency(array, cmap, vmin, vmax)
+                                                             for array, (_, _, cmap, vmin, vmax) in zip(arrays, overlays)], len(overlays))
+        stages['png_encoding'] = time_stage('png_encoding', lambda: [Image.fromarray(image, 'RGBA').save(io.BytesIO(), format='PNG') for image in rgba], len(overlays))
+        stages['tif_to_png'] = time_stage('tif_to_png', lambda: [tif_to_png.convert_tif_to_png(*overlay) for overlay in overlays], len(overlays))
+
+        # Each encoding one file at a time with the size of its overlays, then the default encoding in the worker pool
+        default_encoding = tif_to_png.overlay_encoding
+        encoding_jobs = lambda: [(band['band'], year, tif_path, os.path.join(tif_to_png.overlay_folder, tif_to_png.overlay_file_name(band['band'], year)),
+                                  cmap, vmin, vmax, tif_to_png.overlay_settings()) for (band, year), (tif_path, _, cmap, vmin, vmax) in zip(overlay_keys, overlays)]
+        for encoding in overlay_encodings:
+            tif_to_png.overlay_encoding = encoding
+            jobs = encoding_jobs()
+            stages[f'tif_to_png_{encoding}'] = time_stage(f'tif_to_png_{encoding}', lambda: [tif_to_png.overlay_job(job) for job in jobs], len(jobs))
+            stages[f'tif_to_png_{encoding}']['bytes'] = sum(os.path.getsize(job[3]) for job in jobs)
+            print(f"  {encoding}: {stages[f'tif_to_png_{encoding}']['bytes'] / len(jobs) / 1024:.1f} KB per overlay")
+        tif_to_png.overlay_encoding = default_encoding
+        jobs = encoding_jobs()
+        stages['tif_to_png_pool'] = time_stage('tif_to_png_pool', lambda: tif_to_png.convert_overlays(jobs), len(jobs))
+
+    # Every band's legend at every preset height into an empty atlas, then read back by a fresh process
+    if run_stages['legend_atlas']:
+        def clear_atlas():
+            legend_atlas._atlas.update(legends=None, added=None, dirty=False)
+            if os.path.exists(legend_atlas.atlas_path):
+                os.remove(legend_atlas.atlas_path)
+        n_legends = len(legend_atlas.band_legends) * len(legend_atlas.legend_heights)
+        stages['legend_atlas_build'] = time_stage('legend_atlas_build', legend_atlas.build_atlas, n_legends, setup=clear_atlas)
+        stages['legend_atlas_load'] = time_stage('legend_atlas_load', legend_atlas.load_atlas, n_legends,
+                                                 setup=lambda: legend_atlas._atlas.update(legends=None, added=None, dirty=False))
+
+    if run_stages['plot_and_save_data']:
+        statistics = {}
+        with contextlib.redirect_stdout(io.StringIO()):
+            for band in bands:
+                statistics[band['plot_band']] = create_plots.collect_band_statistics(band['plot_band'])
+        plot_args = [(df, band, data_paths, create_plots.cmap_dict[band], stats['min'], stats['max'], create_plots.units[band])
+                     for band, (df, data_paths, stats) in statistics.items()]
+        stages['plot_and_save_data'] = time_stage('plot_and_save_data', lambda: [create_plots.plot_and_save_data(*args) for args in plot_args], n_rasters)
+        stages['plot_and_save_data_fast'] = time_stage('plot_and_save_data_fast', lambda: [create_plots.plot_and_save_data_fast(*args) for args in plot_args], n_rasters)
+
+    if run_stages['plot_data']:
+        band = bands[0]
+        stages['build_terrain'] = time_stage('build_terrain', lambda: create_3D.build_terrain(dem_data), 1, setup=clear_resample_cache)
+        with contextlib.redirect_stdout(io.StringIO()):
+            topo = create_3D.build_terrain(dem_data)
+            vertices = create_3D.terrain_vertices(topo)
+            gmin, gmax = create_3D.get_global_min_max(band['folder_path'])
+            frames = [(create_3D.load_and_resample(band['band_paths'][year], dem_data, vertices), f"Crete_{band['band']}_{year}")
+                      for year in years[:render_frames]]
+        cmap = create_3D.color_maps[band['folder_name']]
+        unit = create_3D.units[band['folder_name']]
+        os.makedirs(band['output_folder'], exist_ok=True)
+        stages['plot_data'] = time_stage('plot_data', lambda: [create_3D.plot_data(topo, data, title, cmap, band['output_folder'], gmin, gmax, unit)
+                                                               for data, title in frames], len(frames))
+
+        # Frames of one persistent plotter, as create_3D.py renders with batch_rendering
+        def render_session():
+            p = create_3D.create_render_session(topo, cmap, unit, gmin, gmax)
+            for data, title in frames:
+                create_3D.render_session_frame(p, topo, data, title, band['output_folder'], unit)
+            p.close()
+        stages['render_session_frame'] = time_stage('render_session_frame', render_session, len(frames))
+
+    if run_stages['gif_assembly']:
+        os.makedirs(create_gifs.output_gif_path, exist_ok=True)
+        stages['gif_assembly'] = time_stage('gif_assembly', lambda: [create_gifs.create_gif(band['plot_band']) for band in bands], n_rasters)
+
+    if run_stages['server']:
+        results['server'] = benchmark_server(bands)
+
+    with open(results_path, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Benchmark results saved to {results_path}")
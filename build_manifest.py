@@ -0,0 +1,71 @@
+import os
+import json
+import hashlib
+import threading
+from raster_cache import file_hash
+
+# Record of the inputs and parameters every output was last built from
+manifest_path = 'C:/Users/nboub/Pictures/build_manifest.json'
+
+# Manifest of this run, loaded on first use, and the lock guarding it when stages run in threads
+_manifest = None
+_manifest_lock = threading.RLock()
+
+# Function to normalize a path into a manifest key
+def manifest_key(path):
+    return os.path.abspath(path).replace('\\', '/')
+
+# Function to load the manifest, an empty one if it does not exist yet
+def load_manifest():
+    global _manifest
+    with _manifest_lock:
+        if _manifest is None:
+            _manifest = {'hashes': {}, 'outputs': {}}
+            if os.path.exists(manifest_path):
+                with open(manifest_path) as f:
+                    _manifest = json.load(f)
+        return _manifest
+
+# Function to save the manifest, written to a temporary file first so an interrupted run never breaks it
+def save_manifest():
+    with _manifest_lock:
+        manifest = load_manifest()
+        os.makedirs(os.path.dirname(manifest_path) or '.', exist_ok=True)
+        tmp_path = f"{manifest_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, manifest_path)
+
+# Function to get the content hash of an input
+# Hashes are remembered with the size and modification time, so unchanged files are not read again
+def input_hash(path):
+    hashes = load_manifest()['hashes']
+    key = manifest_key(path)
+    stat = os.stat(path)
+    known = hashes.get(key)
+    if known is not None and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+        return known[2]
+    digest = file_hash(path)
+    with _manifest_lock:
+        hashes[key] = [stat.st_size, stat.st_mtime_ns, digest]
+    return digest
+
+# Function to combine the hashes of the inputs and the rendering parameters into one signature
+def build_signature(inputs, params):
+    description = {
+        'inputs': {manifest_key(path): input_hash(path) for path in inputs},
+        'params': params
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+# Function to check whether an output exists and was built from the same inputs and parameters
+def is_up_to_date(output_path, inputs, params):
+    if not os.path.exists(output_path):
+        return False
+    return load_manifest()['outputs'].get(manifest_key(output_path)) == build_signature(inputs, params)
+
+# Function to record the inputs and parameters an output was just built from
+def record_output(output_path, inputs, params):
+    signature = build_signature(inputs, params)
+    with _manifest_lock:
+        load_manifest()['outputs'][manifest_key(output_path)] = signature
@@ -0,0 +1,283 @@
+import os
+import json
+import math
+import warnings
+from multiprocessing import Pool
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+from rasterio.warp import transform_bounds
+from fast_render import build_lut, quantize, save_indexed_png
+from raster_catalog import refresh_catalog, get_entries, band_key
+from build_manifest import is_up_to_date, record_output, save_manifest
+from tracing import span, log, file_size, start_trace
+from band_store import open_cube, ingest_band, cube_folder, store_params
+import band_store
+
+# Folder of the per-pixel GeoTIFF layers, one subfolder per band
+climatology_folder = 'C:/Users/nboub/Pictures/Climatology'
+
+# Folder of the colormapped PNG layers and of climatology.json listing them, served by server.py to the map
+layer_folder = 'C:/Users/nboub/Pictures/Data1/climatology'
+
+# Percentiles of each pixel's years
+percentiles = [10, 50, 90]
+
+# Trends with a two-sided p-value below this are marked significant
+significance_level = 0.05
+
+# Rows of the cube processed at once by a worker, a multiple of the cube's chunk rows reads each chunk once
+rows_per_block = 128
+
+# Number of worker processes, each handles one block of rows at a time
+climatology_workers = os.cpu_count() or 1
+
+# Color maps of the PNG layers, the anomalies and trends are centred on zero
+layer_color_maps = {
+    'mean': 'viridis',
+    'std': 'magma',
+    'percentile': 'viridis',
+    'anomaly': 'RdBu_r',
+    'slope': 'RdBu_r',
+    'p_value': 'Greys_r'
+}
+
+# Only recompute bands whose cube or parameters changed since the last run
+incremental_build = True
+
+# Iterations of the continued fraction of the incomplete beta function, far more than converging needs for these sample sizes
+max_beta_iterations = 200
+
+# Function to compute the log-gamma function elementwise, once per distinct value since they come from a few sample sizes
+def log_gamma(values):
+    unique, inverse = np.unique(values, return_inverse=True)
+    return np.array([math.lgamma(value) for value in unique])[inverse].reshape(np.shape(values))
+
+# Function to compute the regularized incomplete beta function I_x(a, b) elementwise
+# Continued fraction evaluated with the modified Lentz method, on the side of x where it converges fast
+def incomplete_beta(a, b, x):
+    a, b, x = np.broadcast_arrays(np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64), np.asarray(x, dtype=np.float64))
+    result = np.where(x <= 0, 0.0, 1.0)
+    inside = (x > 0) & (x < 1)
+    if not inside.any():
+        return result
+    a, b, x = a[inside], b[inside], x[inside]
+    log_beta = log_gamma(a + b) - log_gamma(a) - log_gamma(b)
+    front = np.exp(log_beta + a * np.log(x) + b * np.log1p(-x))
+    flip = x >= (a + 1) / (a + b + 2)
+    a, b, x = np.where(flip, b, a), np.where(flip, a, b), np.where(flip, 1 - x, x)
+
+    tiny = 1e-300
+    qab, qap, qam = a + b, a + 1, a - 1
+    c = np.ones_like(x)
+    d = 1 - qab * x / qap
+    d = 1 / np.where(np.abs(d) < tiny, tiny, d)
+    h = d.copy()
+    for m in range(1, max_beta_iterations + 1):
+        m2 = 2 * m
+        for aa in (m * (b - m) * x / ((qam + m2) * (a + m2)), -(a + m) * (qab + m) * x / ((a + m2) * (qap + m2))):
+            d = 1 + aa * d
+            d = 1 / np.where(np.abs(d) < tiny, tiny, d)
+            c = 1 + aa / c
+            c = np.where(np.abs(c) < tiny, tiny, c)
+            delta = d * c
+            h *= delta
+        if np.all(np.abs(delta - 1) < 1e-12):
+            break
+    fraction = front * h / a
+    result[inside] = np.where(flip, 1 - fraction, fraction)
+    return result
+
+# Function to get the two-sided p-value of Student's t statistics with the given degrees of freedom
+def t_test_p_value(t, df):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        p = incomplete_beta(df / 2, 0.5, df / (df + t * t))
+    return np.where(df > 0, p, np.nan)
+
+# Function to compute the statistics of a block of years, (years, rows, cols), in vectorized passes over the year axis
+# Each pixel uses only its valid years, statistics needing more years than a pixel has are NaN
+def block_statistics(block, years):
+    block = block.astype(np.float64)
+    valid = ~np.isnan(block)
+    n = valid.sum(axis=0)
+    values = np.where(valid, block, 0)
+    stats = {}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = values.sum(axis=0) / n
+        stats['mean'] = mean
+        stats['anomaly'] = block - mean
+        squares = np.where(valid, stats['anomaly'] ** 2, 0).sum(axis=0)
+        stats['std'] = np.where(n > 1, np.sqrt(squares / (n - 1)), np.nan)
+
+        # Least-squares trend against the year, per pixel, then the t statistic of its slope
+        x = (np.asarray(years, dtype=np.float64) - np.mean(years))[:, None, None]
+        xv = np.where(valid, x, 0)
+        sx, sxx, sxy = xv.sum(axis=0), (xv * xv).sum(axis=0), (xv * values).sum(axis=0)
+        sxx_centred = sxx - sx * sx / n
+        slope = (sxy - sx * values.sum(axis=0) / n) / sxx_centred
+        intercept = mean - slope * sx / n
+        residuals = np.where(valid, block - intercept - slope * x, 0)
+        df = n - 2
+        standard_error = np.sqrt((residuals * residuals).sum(axis=0) / df / sxx_centred)
+        t = np.where(standard_error > 0, slope / standard_error, np.where(slope != 0, np.inf, 0))
+        stats['slope'] = np.where(df > 0, slope, np.nan)
+        stats['p_value'] = np.where(df > 0, t_test_p_value(t, np.maximum(df, 1)), np.nan)
+
+    # Percentiles by linear interpolation between the sorted valid years, NaN sorts last
+    ordered = np.sort(block, axis=0)
+    for q in percentiles:
+        position = q / 100 * np.maximum(n - 1, 0)
+        low = np.floor(position).astype(np.int64)
+        high = np.minimum(low + 1, np.maximum(n - 1, 0))
+        low_values = np.take_along_axis(ordered, low[None], axis=0)[0]
+        high_values = np.take_along_axis(ordered, high[None], axis=0)[0]
+        stats[f"p{q}"] = np.where(n > 0, low_values + (high_values - low_values) * (position - low), np.nan)
+    return stats
+
+# Function run by the workers: statistics of one block of rows of a band's cube
+def climatology_job(job):
+    band, row_start, row_stop, store_folder = job
+    band_store.store_folder = store_folder  # Spawned workers start from the module defaults
+    with span('climatology_block', band=band_key(band), rows=row_stop - row_start) as args:
+        cube = open_cube(band)
+        block = cube.read(rows=slice(row_start, row_stop))
+        args['pixels'] = block.shape[1] * block.shape[2]
+        return row_start, row_stop, block_statistics(block, cube.years)
+
+# Function to get the GeoTIFF layers written for a band, name -> (path, number of bands)
+def layer_paths(band, years):
+    folder = os.path.join(climatology_folder, band_key(band))
+    names = ['mean', 'std', 'slope', 'p_value'] + [f"p{q}" for q in percentiles]
+    layers = {name: (os.path.join(folder, f"{name}.tif"), 1) for name in names}
+    layers['anomaly'] = (os.path.join(folder, 'anomaly.tif'), len(years))
+    return layers
+
+# Function to compute every layer of one band in blocks of rows, written to the GeoTIFFs as the blocks arrive
+def compute_climatology(band, workers=None):
+    cube = open_cube(band)
+    _, height, width = cube.shape
+    layers = layer_paths(band, cube.years)
+    os.makedirs(os.path.dirname(layers['mean'][0]), exist_ok=True)
+    profile = {'driver': 'GTiff', 'dtype': 'float32', 'width': width, 'height': height, 'crs': cube.crs,
+               'transform': cube.transform, 'nodata': np.nan, 'compress': 'deflate', 'predictor': 3,
+               'tiled': True, 'blockxsize': 256, 'blockysize': 256}
+    outputs = {name: rasterio.open(f"{path}.tmp", 'w', count=count, **profile) for name, (path, count) in layers.items()}
+    # Range of every layer, for the colormaps of the PNGs
+    limits = {name: [np.inf, -np.inf] for name in layers}
+    jobs = [(band, row_start, min(row_start + rows_per_block, height), band_store.store_folder)
+            for row_start in range(0, height, rows_per_block)]
+    workers = min(workers or climatology_workers, len(jobs))
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            if workers > 1:
+                pool = Pool(workers)
+                results = pool.imap_unordered(climatology_job, jobs)
+            else:
+                pool = None
+                results = map(climatology_job, jobs)
+            try:
+                for row_start, row_stop, stats in results:
+                    window = Window(0, row_start, width, row_stop - row_start)
+                    with span('write', band=band_key(band), rows=row_stop - row_start):
+                        for name, output in outputs.items():
+                            data = stats[name].astype(np.float32)
+                            if np.isfinite(data).any():
+                                limits[name][0] = min(limits[name][0], float(np.nanmin(data)))
+                                limits[name][1] = max(limits[name][1], float(np.nanmax(data)))
+                            output.write(data if data.ndim == 3 else data[None], window=window)
+            finally:
+                if pool is not None:
+                    pool.close()
+                    pool.join()
+    finally:
+        for output in outputs.values():
+            output.close()
+    for name, (path, _) in layers.items():
+        os.replace(f"{path}.tmp", path)
+    with rasterio.open(layers['anomaly'][0], 'r+') as dst:
+        for position, year in enumerate(cube.years, 1):
+            dst.set_band_description(position, str(year))
+    return layers, {name: value if np.isfinite(value[0]) else [np.nan, np.nan] for name, value in limits.items()}
+
+# Function to get the colormap and range of a PNG layer, anomalies and trends are symmetric around zero
+def layer_style(name, limits):
+    kind = 'percentile' if name.startswith('p') and name[1:].isdigit() else name
+    vmin, vmax = limits
+    if kind in ('anomaly', 'slope'):
+        extent = max(abs(vmin), abs(vmax))
+        vmin, vmax = -extent, extent
+    elif kind == 'p_value':
+        vmin, vmax = 0.0, 1.0
+    return layer_color_maps[kind], vmin, vmax
+
+# Function to write the colormapped PNG layers of a band with a transparent nodata index, and describe them for the map
+def write_png_layers(band, layers, limits, years):
+    folder = os.path.join(layer_folder, band_key(band))
+    os.makedirs(folder, exist_ok=True)
+    described = {}
+    for name, (path, count) in layers.items():
+        cmap, vmin, vmax = layer_style(name, limits[name])
+        lut = build_lut(cmap)
+        with rasterio.open(path) as src:
+            west, south, east, north = transform_bounds(src.crs, 'EPSG:4326', *src.bounds)
+            for position in range(1, count + 1):
+                png_name = f"{name}_{years[position - 1]}.png" if count > 1 else f"{name}.png"
+                with span('encode', band=band_key(band), layer=name) as args:
+                    save_indexed_png(quantize(src.read(position), vmin, vmax), lut, os.path.join(folder, png_name))
+                    args['bytes_written'] = file_size(os.path.join(folder, png_name))
+                described.setdefault(name, {'cmap': cmap, 'vmin': vmin, 'vmax': vmax, 'files': []})
+                described[name]['files'].append(f"climatology/{band_key(band)}/{png_name}")
+    # Significant trends: the slope where the p-value is below the significance level
+    with rasterio.open(layers['slope'][0]) as slope_src, rasterio.open(layers['p_value'][0]) as p_src:
+        slope = slope_src.read(1)
+        slope[~(p_src.read(1) < significance_level)] = np.nan
+    cmap, vmin, vmax = layer_style('slope', limits['slope'])
+    save_indexed_png(quantize(slope, vmin, vmax), build_lut(cmap), os.path.join(folder, 'significant_slope.png'))
+    described['significant_slope'] = {'cmap': cmap, 'vmin': vmin, 'vmax': vmax,
+                                      'files': [f"climatology/{band_key(band)}/significant_slope.png"]}
+    return {'bounds': [[south, west], [north, east]], 'years': years, 'layers': described}
+
+# Function to compute and write the climatology of one band, only if its cube or the parameters changed
+def process_band(band, workers=None):
+    params = {'percentiles': percentiles, 'significance_level': significance_level, 'store': store_params()}
+    meta_path = os.path.join(cube_folder(band), 'meta.json')
+    index_path = os.path.join(layer_folder, band_key(band), 'layers.json')
+    # Ingesting is incremental, so a changed GeoTIFF updates the cube here instead of leaving the climatology on the old one
+    ingest_band(band)
+    if open_cube(band) is None:
+        log(f"No cube of {band} to compute its climatology from")
+        return None
+    if incremental_build and is_up_to_date(index_path, [meta_path], params):
+        log(f"Climatology of {band} is up to date")
+        with open(index_path) as f:
+            return json.load(f)
+    with span('climatology', band=band_key(band)):
+        cube = open_cube(band)
+        layers, limits = compute_climatology(band, workers)
+        description = write_png_layers(band, layers, limits, cube.years)
+    with open(index_path, 'w') as f:
+        json.dump(description, f)
+    record_output(index_path, [meta_path], params)
+    log(f"Climatology of {band} over {cube.years[0]}-{cube.years[-1]} written to {os.path.dirname(layers['mean'][0])}")
+    return description
+
+# Function to compute the climatology of every band of the source folder and list every PNG layer for the map
+def process_bands(workers=None):
+    bands = sorted({band_key(entry['band']) for entry in get_entries(folder=band_store.source_folder)})
+    index = {}
+    for band in bands:
+        description = process_band(band, workers)
+        if description is not None:
+            index[band] = description
+    save_manifest()
+    os.makedirs(layer_folder, exist_ok=True)
+    with open(os.path.join(layer_folder, 'climatology.json'), 'w') as f:
+        json.dump(index, f)
+    return index
+
+# Compute the climatology of every band
+if __name__ == '__main__':
+    start_trace()
+    refresh_catalog()
+    process_bands()
@@ -1,8 +1,19 @@
 import os
+import hashlib
 import numpy as np
 import rioxarray as riox
 import pyvista as pv
 import time
+from multiprocessing import Pool, shared_memory, util
+from PIL import Image
+from raster_cache import load_cached, store_cached
+from reproject_index import resample_file, resample_files
+from raster_catalog import refresh_catalog, get_entries, get_band_limits
+from build_manifest import is_up_to_date, record_output, save_manifest
+from terrain_lod import simplify_terrain
+from tracing import span, log, file_size, start_trace
+from fast_render import compose_frame
+from legend_atlas import get_legend, save_atlas
 
 # Paths to your data files
 base_folder = 'C:/Users/nboub/Pictures'
@@ -32,98 +43,382 @@ units = {
     'Crete_Surface_Pressure': 'Pa'
 }
 
-# Load the DEM data
-print("Loading DEM data...")
+# Resampling onto the DEM grid: 'nearest' or 'bilinear'
+resampling_method = 'nearest'
+
+# Render each band with one persistent plotter instead of a new plotter per frame
+batch_rendering = True
+
+# Number of worker processes rendering frames in parallel with batch rendering, 1 renders everything in this process
+# Set it to os.cpu_count() to use every core
+render_workers = 1
+
+# Vertical exaggeration of the terrain and the camera angles of every frame
+warp_factor = 0.00005
+camera_angles = {'azimuth': 320, 'elevation': 20, 'roll': 0}
+
+# Simplify the terrain to about triangle_budget triangles, refined where the relief needs it, instead of one vertex per DEM pixel
+# The budget is about one triangle per two pixels of the 1024x768 screenshots, finer detail is not visible
+terrain_lod = True
+triangle_budget = 1024 * 768 // 2
+
+# Place the band's colorbar from the legend atlas beside each batch-rendered frame, with the title above it,
+# instead of drawing a VTK scalar bar in every frame
+atlas_legend = True
+
+# Only render frames whose input raster, DEM or rendering parameters changed since the last run
+incremental_build = True
+
 dem_path = 'C:/Users/nboub/Desktop/crete_dem.tif'
-dem_data = riox.open_rasterio(dem_path)
-dem_data = dem_data[0]  # Select the first band
-print(f"DEM data shape: {dem_data.shape}")
+
+# Function to load the DEM data
+def load_dem(dem_path):
+    log("Loading DEM data...")
+    with span('read', path=dem_path, bytes_read=file_size(dem_path)):
+        dem_data = riox.open_rasterio(dem_path)
+        dem_data = dem_data[0]  # Select the first band
+    log(f"DEM data shape: {dem_data.shape}")
+    return dem_data
+
+# Function to name the cache entries of data resampled onto the full DEM grid or onto the vertices of a simplified terrain
+def resample_variant(vertices):
+    if vertices is None:
+        return resampling_method
+    return f"{resampling_method}_lod{hashlib.sha1(np.ascontiguousarray(vertices)).hexdigest()[:12]}"
 
 # Function to load and resample data
-def load_and_resample(path, dem_data):
-    print(f"Loading data from {path}...")
-    data = riox.open_rasterio(path)
-    data = data[0]  # Select the first band
-    print(f"Original data shape: {data.shape}")
-    data = data.rio.reproject_match(dem_data)
-    print(f"Resampled data shape: {data.shape}")
-    return np.asarray(data)
-
-# Create a mesh grid for the DEM
-print("Creating mesh grid...")
-x, y = np.meshgrid(dem_data['x'], dem_data['y'])
-print(f"Mesh grid shapes - x: {x.shape}, y: {y.shape}")
-
-# Set the z values and create a StructuredGrid
-print("Creating StructuredGrid...")
-z = np.zeros_like(x)
-mesh = pv.StructuredGrid(x.astype(np.float32), y.astype(np.float32), z.astype(np.float32))
-print(f"StructuredGrid created with {mesh.n_points} points.")
-
-# Assign Elevation Values
-print("Assigning elevation values...")
-mesh["Elevation"] = np.asarray(dem_data).ravel(order='F')
-print("Elevation values assigned.")
-
-# Warp the mesh by scalar to visualize the terrain
-print("Warping the mesh by scalar...")
-topo = mesh.warp_by_scalar(scalars="Elevation", factor=0.00005)  # Adjust the factor as needed
-print("Mesh warped by scalar.")
-
-# Function to get global min and max values for each data type
+# Reprojected arrays are cached on disk, so each file is only reprojected once across passes and runs
+# The source->DEM pixel mapping is computed once per source grid and reused for every year
+# With a simplified terrain only its vertices are resampled
+def load_and_resample(path, dem_data, vertices=None):
+    variant = resample_variant(vertices)
+    with span('load_and_resample', path=path) as args:
+        cached = load_cached(path, dem_data, variant)
+        args['cached'] = cached is not None
+        if cached is not None:
+            log(f"Loaded resampled data for {path} from cache.")
+            return cached
+        log(f"Loading data from {path}...")
+        data = resample_file(path, dem_data, resampling_method, vertices)
+        log(f"Resampled data shape: {data.shape}")
+        return store_cached(path, dem_data, data, variant)
+
+# Function to build the warped terrain mesh from the DEM
+def build_terrain(dem_data):
+    with span('build_terrain', terrain_lod=terrain_lod):
+        return build_terrain_mesh(dem_data)
+
+# Function to build the full resolution or simplified terrain mesh
+def build_terrain_mesh(dem_data):
+    if terrain_lod:
+        return build_terrain_lod(dem_data)
+    # Create a mesh grid for the DEM
+    log("Creating mesh grid...")
+    x, y = np.meshgrid(dem_data['x'], dem_data['y'])
+    log(f"Mesh grid shapes - x: {x.shape}, y: {y.shape}")
+
+    # Set the z values and create a StructuredGrid
+    log("Creating StructuredGrid...")
+    z = np.zeros_like(x)
+    mesh = pv.StructuredGrid(x.astype(np.float32), y.astype(np.float32), z.astype(np.float32))
+    log(f"StructuredGrid created with {mesh.n_points} points.")
+
+    # Assign Elevation Values
+    log("Assigning elevation values...")
+    mesh["Elevation"] = np.asarray(dem_data).ravel(order='F')
+    log("Elevation values assigned.")
+
+    # Warp the mesh by scalar to visualize the terrain
+    log("Warping the mesh by scalar...")
+    topo = mesh.warp_by_scalar(scalars="Elevation", factor=warp_factor)  # Adjust the factor as needed
+    log("Mesh warped by scalar.")
+    return topo
+
+# Function to build the simplified terrain mesh, with the DEM pixel of each vertex kept as 'DEM_Index'
+# The vertex selection is cached next to the resampled data, keyed by the DEM and the budget
+def build_terrain_lod(dem_data):
+    log(f"Simplifying terrain to about {triangle_budget} triangles...")
+    elevation = np.nan_to_num(np.asarray(dem_data, dtype=np.float32))
+    vertices = load_cached(dem_path, dem_data, f"lod{triangle_budget}_vertices")
+    faces = load_cached(dem_path, dem_data, f"lod{triangle_budget}_faces")
+    if vertices is None or faces is None:
+        vertices, faces = simplify_terrain(elevation, triangle_budget)
+        vertices = store_cached(dem_path, dem_data, vertices, f"lod{triangle_budget}_vertices")
+        faces = store_cached(dem_path, dem_data, faces, f"lod{triangle_budget}_faces")
+
+    # Vertices are placed directly at their warped height, as warp_by_scalar does on the full grid
+    rows, cols = np.divmod(np.asarray(vertices), elevation.shape[1])
+    heights = elevation[rows, cols]
+    points = np.column_stack([np.asarray(dem_data['x'])[cols], np.asarray(dem_data['y'])[rows], heights * warp_factor]).astype(np.float32)
+    topo = pv.PolyData(points, np.column_stack([np.full(len(faces), 3), faces]).ravel())
+    topo['Elevation'] = heights
+    topo['DEM_Index'] = np.asarray(vertices)
+    log(f"Terrain with {topo.n_points} points and {topo.n_cells} triangles instead of {elevation.size} points.")
+    return topo
+
+# Function to get the DEM pixels of the terrain vertices, None for the full resolution grid
+def terrain_vertices(topo):
+    if 'DEM_Index' not in topo.point_data:
+        return None
+    return np.asarray(topo.point_data['DEM_Index'])
+
+# Function to get global min and max values for each data type from the raster catalog, None if the folder has no valid rasters
 def get_global_min_max(folder_full_path):
-    global_min = np.inf
-    global_max = -np.inf
-    for file_name in os.listdir(folder_full_path):
-        if file_name.endswith('.tif'):
-            file_path = os.path.join(folder_full_path, file_name)
-            data = load_and_resample(file_path, dem_data)
-            global_min = min(global_min, np.nanmin(data))
-            global_max = max(global_max, np.nanmax(data))
-    return global_min, global_max
+    limits = get_band_limits(folder=folder_full_path)
+    if limits is None:
+        return None
+    return limits['min'], limits['max']
+
+# Function to resample the files missing from the cache with one batched gather per source grid
+def warm_resample_cache(file_paths, dem_data, vertices=None):
+    variant = resample_variant(vertices)
+    missing = [file_path for file_path in file_paths if load_cached(file_path, dem_data, variant) is None]
+    if missing:
+        log(f"Resampling {len(missing)} files...")
+        for file_path, data in resample_files(missing, dem_data, resampling_method, vertices=vertices):
+            store_cached(file_path, dem_data, data, variant)
 
 # Function to plot data and save the output
 def plot_data(topo, data, title, cmap, output_folder, global_min, global_max, unit):
-    print(f"Overlaying {title} data...")
+    log(f"Overlaying {title} data...")
     raveled_data = data.ravel(order='F')
     topo[title] = raveled_data
-    print(f"{title} data overlayed.")
+    log(f"{title} data overlayed.")
    
-    print(f"Plotting the 3D terrain with {title} overlay...")
+    log(f"Plotting the 3D terrain with {title} overlay...")
+    with span('render', title=title, points=topo.n_points):
+        p = pv.Plotter(off_screen=True)
+        p.add_mesh(topo, scalars=title, cmap=cmap, clim=[global_min, global_max], scalar_bar_args={'title': f'{title} ({unit})', 'label_font_size': 10})
+        p.set_background(color='white')
+        p.show_bounds(grid='back', location='outer', ticks='both', font_size=7)  # Move the grid to the back
+
+        # Adjust the camera position
+        p.camera_position = 'xy'
+        p.camera.azimuth = camera_angles['azimuth']  # Rotate around the vertical axis
+        p.camera.elevation = camera_angles['elevation']  # Rotate around the horizontal axis to view from above
+        p.camera.roll = camera_angles['roll'] # Adjust roll to ensure north is up
+
+
+        # Ensure the plot is fully rendered before taking the screenshot
+        p.show(auto_close=False)
+        time.sleep(1)  # Add a short delay to ensure the render window is updated
+    output_path = os.path.join(output_folder, f"{title}.png")
+    with span('encode', path=output_path) as args:
+        p.screenshot(output_path)
+        args['bytes_written'] = file_size(output_path)
+    p.close()
+    log(f"Plot saved for {title} at {output_path}.")
+
+# Function to set up one off-screen plotter and camera for all frames of a band
+def create_render_session(topo, cmap, unit, global_min, global_max):
+    topo['Overlay'] = np.full(topo.n_points, np.nan, dtype=np.float32)
     p = pv.Plotter(off_screen=True)
-    p.add_mesh(topo, scalars=title, cmap=cmap, scalar_bar_args={'title': f'{title} ({unit})', 'label_font_size': 10})
+    p.add_mesh(topo, scalars='Overlay', cmap=cmap, clim=[global_min, global_max], show_scalar_bar=not atlas_legend,
+               scalar_bar_args={'title': f'Overlay ({unit})', 'label_font_size': 10})
+    # Plotters refuse new attributes unless they are declared through pyvista
+    pv.set_new_attribute(p, 'frame_colorbar', frame_legend(cmap, unit, global_min, global_max) if atlas_legend else None)
     p.set_background(color='white')
     p.show_bounds(grid='back', location='outer', ticks='both', font_size=7)  # Move the grid to the back
 
     # Adjust the camera position
     p.camera_position = 'xy'
-    p.camera.azimuth = 320  # Rotate around the vertical axis
-    p.camera.elevation = 20  # Rotate around the horizontal axis to view from above
-    p.camera.roll = 0 # Adjust roll to ensure north is up
-
+    p.camera.azimuth = camera_angles['azimuth']  # Rotate around the vertical axis
+    p.camera.elevation = camera_angles['elevation']  # Rotate around the horizontal axis to view from above
+    p.camera.roll = camera_angles['roll'] # Adjust roll to ensure north is up
 
-    # Ensure the plot is fully rendered before taking the screenshot
     p.show(auto_close=False)
-    time.sleep(1)  # Add a short delay to ensure the render window is updated
+    return p
+
+# Function to render one frame in an existing session and save the output
+def render_session_frame(p, topo, data, title, output_folder, unit):
+    # Only the scalar values change between frames, the mesh and camera stay on the GPU
+    with span('render', title=title, points=topo.n_points):
+        topo.point_data['Overlay'][:] = data.ravel(order='F')
+        if p.frame_colorbar is None:
+            p.scalar_bar.SetTitle(f'{title} ({unit})')
+        p.render()
     output_path = os.path.join(output_folder, f"{title}.png")
-    p.screenshot(output_path)
-    p.close()
-    print(f"Plot saved for {title} at {output_path}.")
-
-# Process each folder and file
-for folder_name, folder_path in folders.items():
-    folder_full_path = os.path.join(base_folder, folder_path)
-    output_folder = os.path.join(base_folder, f"{folder_path}_Output")
-    os.makedirs(output_folder, exist_ok=True)
-    cmap = color_maps[folder_name]
-    unit = units[folder_name]
-   
-    # Get global min and max values for consistent color bar
-    global_min, global_max = get_global_min_max(folder_full_path)
-   
-    for file_name in os.listdir(folder_full_path):
-        if file_name.endswith('.tif'):
-            file_path = os.path.join(folder_full_path, file_name)
-            data = load_and_resample(file_path, dem_data)
-            title = os.path.splitext(file_name)[0]
-            plot_data(topo, data, title, cmap, output_folder, global_min, global_max, unit)
+    with span('encode', path=output_path) as args:
+        if p.frame_colorbar is None:
+            p.screenshot(output_path)
+        else:
+            rgb = p.screenshot(return_img=True)
+            rgba = np.dstack([rgb, np.full(rgb.shape[:2], 255, dtype=np.uint8)])
+            Image.fromarray(compose_frame(rgba, p.frame_colorbar, f'{title} ({unit})')).save(output_path, compress_level=1)
+        args['bytes_written'] = file_size(output_path)
+    log(f"Plot saved for {title} at {output_path}.")
+
+# Function to get the colorbar of a band's 3D frames from the legend atlas, as tall as the screenshots
+def frame_legend(cmap, unit, global_min, global_max):
+    return get_legend(cmap, global_min, global_max, f'Unit: {unit}', pv.global_theme.window_size[1])
+
+# Function to describe everything a frame of a band depends on besides its input files
+def frame_params(folder_name, global_min, global_max):
+    return {
+        'cmap': color_maps[folder_name],
+        'unit': units[folder_name],
+        'vmin': global_min,
+        'vmax': global_max,
+        'resampling_method': resampling_method,
+        'warp_factor': warp_factor,
+        'camera_angles': camera_angles,
+        'triangle_budget': triangle_budget if terrain_lod else None,
+        'atlas_legend': atlas_legend
+    }
+
+# Function to publish the terrain through shared memory for the render workers
+# A simplified terrain also shares its triangles and the DEM pixels of its vertices
+def share_terrain(topo):
+    arrays = {'points': np.asarray(topo.points, dtype=np.float32)}
+    if isinstance(topo, pv.PolyData):
+        arrays['faces'] = np.asarray(topo.faces)
+        arrays['vertices'] = terrain_vertices(topo)
+    shms = []
+    terrain_info = {'arrays': {}, 'dimensions': None if isinstance(topo, pv.PolyData) else topo.dimensions}
+    for name, array in arrays.items():
+        shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+        shms.append(shm)
+        terrain_info['arrays'][name] = (shm.name, array.shape, array.dtype.str)
+    log(f"Terrain with {topo.n_points} points shared.")
+    return shms, terrain_info
+
+# State of a render worker process: shared terrain, DEM and the current band's plotter
+_worker = {}
+
+# Function to set up a render worker with its own off-screen VTK context
+def init_render_worker(terrain_info, dem_path):
+    shms, arrays = [], {}
+    for name, (shm_name, shape, dtype) in terrain_info['arrays'].items():
+        shms.append(shared_memory.SharedMemory(name=shm_name))
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=shms[-1].buf)
+    if 'faces' in arrays:
+        topo = pv.PolyData(arrays['points'], arrays['faces'])
+    else:
+        topo = pv.StructuredGrid()
+        topo.points = arrays['points']
+        topo.dimensions = terrain_info['dimensions']
+    _worker.update({'shms': shms, 'topo': topo, 'vertices': arrays.get('vertices'), 'dem_data': riox.open_rasterio(dem_path)[0], 'band': None, 'plotter': None})
+    util.Finalize(None, close_render_worker, exitpriority=10)
+
+# Function to close the plotter and the shared terrain of a render worker when it exits
+def close_render_worker():
+    if _worker.get('plotter') is not None:
+        _worker['plotter'].close()
+        _worker['plotter'] = None
+    for shm in _worker.get('shms', []):
+        shm.close()
+
+# Function to render one (band, year) job in a worker
+def render_job(job):
+    folder_name, file_path, title, output_folder, global_min, global_max = job
+    with span('frame', band=folder_name, title=title):
+        if _worker['band'] != folder_name:
+            if _worker['plotter'] is not None:
+                _worker['plotter'].close()
+            with span('render_session'):
+                _worker['plotter'] = create_render_session(_worker['topo'], color_maps[folder_name], units[folder_name], global_min, global_max)
+            _worker['band'] = folder_name
+        data = load_and_resample(file_path, _worker['dem_data'], _worker['vertices'])
+        render_session_frame(_worker['plotter'], _worker['topo'], data, title, output_folder, units[folder_name])
+    return title
+
+# Function to render all jobs in a pool of worker processes sharing one terrain mesh
+def render_parallel(topo, jobs, workers):
+    shms, terrain_info = share_terrain(topo)
+    jobs_by_title = {job[2]: job for job in jobs}
+    start_time = time.perf_counter()
+    try:
+        # Jobs are ordered by band, so chunks keep each worker on one band's plotter
+        chunksize = max(1, len(jobs) // (workers * 4))
+        with Pool(workers, initializer=init_render_worker, initargs=(terrain_info, dem_path)) as pool:
+            for n_done, title in enumerate(pool.imap_unordered(render_job, jobs, chunksize=chunksize), 1):
+                log(f"[{n_done}/{len(jobs)}] Rendered {title}.")
+                # Frames are recorded here, the workers never write to the build manifest
+                folder_name, file_path, _, output_folder, global_min, global_max = jobs_by_title[title]
+                record_output(os.path.join(output_folder, f"{title}.png"), [file_path, dem_path], frame_params(folder_name, global_min, global_max))
+            # Let the workers exit on their own so their finalizers close the plotters
+            pool.close()
+            pool.join()
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+    elapsed = time.perf_counter() - start_time
+    log(f"Rendered {len(jobs)} frames in {elapsed:.1f} s with {workers} workers ({len(jobs) / elapsed:.2f} frames/s).")
+
+if __name__ == '__main__':
+    start_trace()
+    refresh_catalog()
+    dem_data = load_dem(dem_path)
+    topo = None  # Built on the first band with frames to render
+    jobs = []
+    n_frames = 0
+    start_time = time.perf_counter()
+    parallel = batch_rendering and render_workers > 1
+
+    # Process each folder and file
+    for folder_name, folder_path in folders.items():
+        folder_full_path = os.path.join(base_folder, folder_path)
+        output_folder = os.path.join(base_folder, f"{folder_path}_Output")
+        os.makedirs(output_folder, exist_ok=True)
+        cmap = color_maps[folder_name]
+        unit = units[folder_name]
+
+        # Get global min and max values for consistent color bar
+        limits = get_global_min_max(folder_full_path)
+        if limits is None:
+            log(f"{folder_name}: no valid rasters in {folder_full_path}, skipping it")
+            continue
+        global_min, global_max = limits
+
+        file_paths = [entry['path'] for entry in get_entries(folder=folder_full_path)]
+        params = frame_params(folder_name, global_min, global_max)
+        if incremental_build:
+            stale = [file_path for file_path in file_paths
+                     if not is_up_to_date(os.path.join(output_folder, f"{os.path.splitext(os.path.basename(file_path))[0]}.png"), [file_path, dem_path], params)]
+            log(f"{folder_name}: {len(file_paths) - len(stale)} frames up to date, {len(stale)} to render.")
+            file_paths = stale
+        if not file_paths:
+            continue
+        if topo is None:
+            topo = build_terrain(dem_data)
+            vertices = terrain_vertices(topo)
+        with span('warm_resample_cache', band=folder_name, files=len(file_paths)):
+            warm_resample_cache(file_paths, dem_data, vertices)
+        if atlas_legend:
+            # Rendered here once and saved, so the render workers find it in the atlas
+            frame_legend(cmap, unit, global_min, global_max)
+            save_atlas()
+        if parallel:
+            for file_path in file_paths:
+                title = os.path.splitext(os.path.basename(file_path))[0]
+                jobs.append((folder_name, file_path, title, output_folder, global_min, global_max))
+            continue
+
+        if batch_rendering:
+            with span('render_session', band=folder_name):
+                p = create_render_session(topo, cmap, unit, global_min, global_max)
+
+        for file_path in file_paths:
+            title = os.path.splitext(os.path.basename(file_path))[0]
+            with span('frame', band=folder_name, title=title):
+                data = load_and_resample(file_path, dem_data, vertices)
+                if batch_rendering:
+                    render_session_frame(p, topo, data, title, output_folder, unit)
+                else:
+                    plot_data(topo, data, title, cmap, output_folder, global_min, global_max, unit)
+            record_output(os.path.join(output_folder, f"{title}.png"), [file_path, dem_path], params)
+            n_frames += 1
+
+        if batch_rendering:
+            p.close()
+        save_manifest()
+
+    if parallel:
+        if jobs:
+            render_parallel(topo, jobs, render_workers)
+        save_manifest()
+    else:
+        elapsed = time.perf_counter() - start_time
+        log(f"Rendered {n_frames} frames in {elapsed:.1f} s ({n_frames / elapsed:.2f} frames/s).")
@@ -1,34 +1,196 @@
 import os
-from PIL import Image
+import subprocess
+from collections import deque
+from multiprocessing import Pool
+from PIL import Image, GifImagePlugin
+from build_manifest import is_up_to_date, record_output, save_manifest
+from tracing import span, log, file_size, start_trace
 
 # Define paths
 base_plot_path = 'C:/Users/nboub/Desktop/Plots'
 output_gif_path = 'C:/Users/nboub/Desktop/GIFs'
 
-# Ensure the output directory exists
-os.makedirs(output_gif_path, exist_ok=True)
-
 # Define the bands
 bands = ['temperature_2m', 'total_Precipitation', 'soil_Moisture', 'surface_Pressure', 'wind_U']
 
 # Define the speed of the GIF (duration in milliseconds between frames)
 frame_duration = 400 # 1 second per frame
 
-# Function to create a GIF for a given band
+# Animations written for each band: 'gif', 'webp' and/or 'mp4' (webp and mp4 need ffmpeg)
+output_formats = ['gif']
+ffmpeg_path = 'ffmpeg'
+
+# Number of frames sampled to build the shared palette of a band
+palette_sample_frames = 8
+
+# Only encode animations whose frames or encoding parameters changed since the last run
+incremental_build = True
+
+# Number of worker processes decoding and quantizing frames
+frame_workers = os.cpu_count() or 1
+
+# ffmpeg arguments for the formats that are encoded through a pipe of raw RGB frames
+ffmpeg_codecs = {
+    'webp': ['-c:v', 'libwebp', '-lossless', '0', '-quality', '80', '-loop', '0'],
+    'mp4': ['-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-c:v', 'libx264', '-pix_fmt', 'yuv420p']
+}
+
+# Function to compute one palette for a band from a sample of its frames
+def build_global_palette(image_files):
+    step = max(1, len(image_files) // palette_sample_frames)
+    samples = []
+    for image_file in image_files[::step][:palette_sample_frames]:
+        with Image.open(image_file) as img:
+            sample = img.convert('RGB')
+        sample.thumbnail((256, 256))
+        samples.append(sample)
+    return build_palette(samples)
+
+# Function to compute one palette covering the colors of a few sample images
+def build_palette(samples):
+    # Quantize a montage of the samples so the palette covers the colors of the whole animation
+    montage = Image.new('RGB', (max(sample.width for sample in samples), sum(sample.height for sample in samples)), 'white')
+    y = 0
+    for sample in samples:
+        montage.paste(sample, (0, y))
+        y += sample.height
+    return montage.quantize(colors=256, method=Image.Quantize.MEDIANCUT).getpalette()
+
+# State of a frame worker: the shared palette and whether raw RGB frames are needed
+_worker = {}
+
+def init_frame_worker(palette, keep_rgb):
+    palette_image = None
+    if palette is not None:
+        palette_image = Image.new('P', (1, 1))
+        palette_image.putpalette(palette)
+    _worker.update({'palette_image': palette_image, 'keep_rgb': keep_rgb})
+
+# Function to decode one frame and quantize it against the shared palette
+def process_frame(image_file, band=None):
+    with span('read', band=band, path=image_file, bytes_read=file_size(image_file)), Image.open(image_file) as img:
+        rgb = img.convert('RGB')
+    indexed = None
+    if _worker['palette_image'] is not None:
+        with span('quantize', band=band):
+            indexed = rgb.quantize(palette=_worker['palette_image'], dither=Image.Dither.NONE).tobytes()
+    return rgb.size, rgb.tobytes() if _worker['keep_rgb'] else None, indexed
+
+# Function to yield processed frames in order, with only a few frames in flight at any time
+def stream_frames(image_files, palette, keep_rgb, band=None):
+    with Pool(frame_workers, initializer=init_frame_worker, initargs=(palette, keep_rgb)) as pool:
+        pending = deque()
+        for image_file in image_files:
+            pending.append(pool.apply_async(process_frame, (image_file, band)))
+            if len(pending) >= 2 * frame_workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+# Function to describe the encoding parameters of one output format
+def animation_params(output_format):
+    params = {'format': output_format, 'frame_duration': frame_duration}
+    if output_format == 'gif':
+        params['palette_sample_frames'] = palette_sample_frames
+    else:
+        params['codec'] = ffmpeg_codecs[output_format]
+    return params
+
+# Function to append one palette frame to an open GIF, writing the header before the first frame
+def write_gif_frame(gif_file, frame, n_frame):
+    if n_frame == 0:
+        header, _ = GifImagePlugin.getheader(frame, info={'loop': 0, 'duration': frame_duration})
+        gif_file.writelines(header)
+    gif_file.writelines(GifImagePlugin.getdata(frame, duration=frame_duration))
+
+# Function to get the temporary file an animation is encoded to, replacing the output only once it is complete
+# The extension is kept so ffmpeg still picks the container from it
+def temp_path(output_file):
+    root, extension = os.path.splitext(output_file)
+    return f"{root}.tmp{extension}"
+
+# Function to remove the temporary files of animations that were not completed
+def remove_temp_files(temp_files):
+    for temp_file in temp_files:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+
+# Function to start an ffmpeg process that encodes raw RGB frames from its stdin
+def start_ffmpeg(output_file, output_format, size):
+    command = [ffmpeg_path, '-y', '-loglevel', 'error',
+               '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{size[0]}x{size[1]}', '-r', str(1000 / frame_duration),
+               '-i', '-'] + ffmpeg_codecs[output_format] + [output_file]
+    return subprocess.Popen(command, stdin=subprocess.PIPE)
+
+# Function to create the animations for a given band
+# Frames are streamed: memory stays constant whatever the number of frames
 def create_gif(band):
     plot_dir = os.path.join(base_plot_path, band)
-    output_gif_file = os.path.join(output_gif_path, f'{band}.gif')
 
     # Get all PNG files in the directory and sort them
     image_files = sorted([os.path.join(plot_dir, file) for file in os.listdir(plot_dir) if file.endswith('.png')])
+    if not image_files:
+        log(f'No frames found for {band} in {plot_dir}')
+        return
+
+    output_files = {output_format: os.path.join(output_gif_path, f'{band}.{output_format}') for output_format in output_formats}
+    if incremental_build:
+        output_files = {output_format: output_file for output_format, output_file in output_files.items()
+                        if not is_up_to_date(output_file, image_files, animation_params(output_format))}
+        if not output_files:
+            log(f'Animations for {band} are up to date')
+            return
+    with span('palette', band=band):
+        palette = build_global_palette(image_files) if 'gif' in output_files else None
+    keep_rgb = any(output_format in ffmpeg_codecs for output_format in output_files)
+
+    # Encoded to temporary files, so a failure leaves the previous animations in place
+    temp_files = {output_format: temp_path(output_file) for output_format, output_file in output_files.items()}
+    gif_file = open(temp_files['gif'], 'wb') if 'gif' in output_files else None
+    encoders = {}
+    complete = False
+    try:
+        for n_frame, (size, rgb, indexed) in enumerate(stream_frames(image_files, palette, keep_rgb, band)):
+            if gif_file is not None:
+                with span('encode', band=band, format='gif'):
+                    frame = Image.frombytes('P', size, indexed)
+                    frame.putpalette(palette)
+                    write_gif_frame(gif_file, frame, n_frame)
+            for output_format in output_files:
+                if output_format not in ffmpeg_codecs:
+                    continue
+                if output_format not in encoders:
+                    encoders[output_format] = start_ffmpeg(temp_files[output_format], output_format, size)
+                # ffmpeg encodes in its own process, this is the time spent waiting for it to take the frame
+                with span('encode', band=band, format=output_format):
+                    encoders[output_format].stdin.write(rgb)
+        if gif_file is not None:
+            gif_file.write(b';')  # GIF trailer
+        complete = True
+    finally:
+        if gif_file is not None:
+            gif_file.close()
+        for encoder in encoders.values():
+            encoder.stdin.close()
+            encoder.wait()
+        if not complete:
+            remove_temp_files(temp_files.values())
 
-    # Load images
-    images = [Image.open(image_file) for image_file in image_files]
+    for output_format, output_file in output_files.items():
+        if output_format in encoders and encoders[output_format].returncode != 0:
+            log(f'ffmpeg failed to encode {output_format.upper()} for {band}')
+            remove_temp_files([temp_files[output_format]])
+            continue
+        os.replace(temp_files[output_format], output_file)
+        record_output(output_file, image_files, animation_params(output_format))
+        log(f'Saved {output_format.upper()} for {band} to {output_file}')
+    save_manifest()
 
-    # Save as GIF
-    images[0].save(output_gif_file, save_all=True, append_images=images[1:], duration=frame_duration, loop=0)
-    print(f'Saved GIF for {band} to {output_gif_file}')
+if __name__ == '__main__':
+    start_trace()
+    # Ensure the output directory exists
+    os.makedirs(output_gif_path, exist_ok=True)
 
-# Create GIFs for each band
-for band in bands:
-    create_gif(band)
+    # Create GIFs for each band
+    for band in bands:
+        create_gif(band)
@@ -1,4 +1,8 @@
+import os
+import json
 import folium
+import tif_to_png
+from build_manifest import is_up_to_date, record_output, save_manifest
 
 # Coordinates for Greece and Crete
 greece_coords = [39.0742, 21.8243]
@@ -132,20 +136,319 @@ folium.Marker(
 # Get the map ID
 map_id = m.get_name()
 
+# Show the overlays as XYZ tile pyramids built by tif_to_png.py instead of one full-extent image
+use_tiles = True
+tile_min_zoom = 6
+tile_max_zoom = 10
+
+# Extension of the full-extent overlays, following the overlay_encoding of tif_to_png.py
+overlay_extension = tif_to_png.overlay_extension()
+
+# Performance mode: debounce the slider, prefetch neighbouring years and cancel stale downloads
+performance_mode = True
+prefetch_years = 3
+slider_debounce_ms = 60
+
+# In performance mode, load each band once as a packed uint8 cube written by tif_to_png.py
+# and colormap the selected year in the browser, so scrubbing needs no request per year
+# Packed cubes replace the tile layer and the full-extent overlays, so those are not used while this is on
+use_packed_cubes = False
+
+# Take the colorbars from the legend atlas through the /legend endpoint of server.py instead of the colorbar_{band}.png files
+# The height must be one of the preset sizes in legend_atlas.legend_heights
+use_legend_endpoint = True
+legend_height = 600
+
+# Clicking the map shows every year of every band at that point, queried from the /timeseries endpoint of server.py
+show_timeseries = True
+timeseries_url = 'http://localhost:8000/timeseries'
+
+# Per-pixel climatology layers written by climatology.py, listed in the layer control when they exist
+show_climatology_layers = True
+climatology_index = 'C:/Users/nboub/Pictures/Data1/climatology/climatology.json'
+climatology_layers = ['mean', 'std', 'p50', 'significant_slope']
+
+# Only rewrite the page when this script or its settings changed since the last run
+incremental_build = True
+
 # Add custom JavaScript to handle the zoom and interactions
 zoom_js = f"""
 <script>
     var overlayLayer;
     var colorbarLayer;
+    var colorbarBand;
+    var useTiles = {str(use_tiles).lower()};
+    var performanceMode = {str(performance_mode).lower()};
+    var usePackedCubes = {str(use_packed_cubes).lower()};
+    var overlayExtension = '{overlay_extension}';
+    var useLegendEndpoint = {str(use_legend_endpoint).lower()};
+    var legendHeight = {legend_height};
+    var prefetchYears = {prefetch_years};
+    var sliderDebounceMs = {slider_debounce_ms};
+    var showTimeseries = {str(show_timeseries).lower()};
+    var timeseriesUrl = '{timeseries_url}';
+    var timeseriesRequest = null;
+
+    var updateTimer = null;
+    var overlayRequest = 0;
+    var imageCache = {{}};
+    var cubeCache = {{}};
+    var cubeDownload = null;
+    var cubeCanvas = null;
+
+    // Image overlay drawing a canvas, used for years colormapped in the browser
+    var CanvasOverlay = L.ImageOverlay.extend({{
+        _initImage: function() {{
+            var canvas = this._image = this._url;
+            L.DomUtil.addClass(canvas, 'leaflet-image-layer');
+            if (this._zoomAnimated) {{
+                L.DomUtil.addClass(canvas, 'leaflet-zoom-animated');
+            }}
+            canvas.onselectstart = L.Util.falseFn;
+            canvas.onmousemove = L.Util.falseFn;
+        }}
+    }});
 
     document.addEventListener('DOMContentLoaded', function() {{
         window.map = {map_id};  // Ensure the map is available in the global scope
+        if (showTimeseries) {{
+            map.on('click', showPointTimeseries);
+        }}
     }});
 
+    // Show the history of every band at the clicked point in a popup
+    function showPointTimeseries(e) {{
+        if (timeseriesRequest) {{
+            timeseriesRequest.abort();  // Only the latest click is answered
+        }}
+        var controller = timeseriesRequest = new AbortController();
+        var lat = e.latlng.lat.toFixed(5);
+        var lon = e.latlng.lng.toFixed(5);
+        var popup = L.popup({{ maxWidth: 400 }})
+            .setLatLng(e.latlng)
+            .setContent('<div class="popup-content">Loading time series...</div>')
+            .openOn(map);
+        fetch(timeseriesUrl + '?lat=' + lat + '&lon=' + lon, {{ signal: controller.signal }})
+            .then(function(response) {{
+                if (response.status === 404) {{
+                    throw new Error('No data at ' + lat + ', ' + lon);
+                }}
+                if (!response.ok) {{
+                    throw new Error('Time series request failed (' + response.status + ')');
+                }}
+                return response.json();
+            }})
+            .then(function(result) {{
+                popup.setContent(timeseriesHtml(result));
+            }})
+            .catch(function(error) {{
+                if (error.name !== 'AbortError') {{
+                    popup.setContent('<div class="popup-content">' + error.message + '</div>');
+                }}
+            }});
+    }}
+
+    // Popup content: one small line chart per band, with its range and last value
+    function timeseriesHtml(result) {{
+        var html = '<div class="popup-content"><b>' + result.lat + ', ' + result.lon + '</b>';
+        Object.keys(result.bands).forEach(function(band) {{
+            var series = result.bands[band];
+            var values = series.values.filter(function(value) {{ return value !== null; }});
+            html += '<div><label>' + band.replace(/_/g, ' ') + '</label>';
+            if (values.length === 0) {{
+                html += 'No data</div>';
+                return;
+            }}
+            var last = series.values[series.values.length - 1];
+            html += sparkline(series.years, series.values, Math.min.apply(null, values), Math.max.apply(null, values))
+                + '<br>' + series.years[0] + '-' + series.years[series.years.length - 1]
+                + ': ' + Math.min.apply(null, values).toPrecision(4) + ' to ' + Math.max.apply(null, values).toPrecision(4)
+                + (last !== null ? ', last ' + last.toPrecision(4) : '') + '</div>';
+        }});
+        return html + '</div>';
+    }}
+
+    // Inline SVG line chart, missing years break the line
+    function sparkline(years, values, low, high) {{
+        var width = 360, height = 60;
+        var span = years[years.length - 1] - years[0] || 1;
+        var range = high - low || 1;
+        var path = '';
+        var drawing = false;
+        for (var i = 0; i < values.length; i++) {{
+            if (values[i] === null) {{
+                drawing = false;
+                continue;
+            }}
+            var x = (years[i] - years[0]) / span * (width - 4) + 2;
+            var y = height - 2 - (values[i] - low) / range * (height - 4);
+            path += (drawing ? 'L' : 'M') + x.toFixed(1) + ',' + y.toFixed(1);
+            drawing = true;
+        }}
+        return '<svg width="' + width + '" height="' + height + '"><path d="' + path
+            + '" fill="none" stroke="#d9534f" stroke-width="1.5"/></svg>';
+    }}
+
     function zoomToCrete() {{
         map.setView([35.2401, 24.8093], 8);  // Adjusted zoom level
         document.getElementById('bandSelect').addEventListener('change', updateMap);
-        document.getElementById('yearSlider').addEventListener('input', updateMap);
+        document.getElementById('yearSlider').addEventListener('input', performanceMode ? scheduleUpdate : updateMap);
+    }}
+
+    // Update the map once the slider has settled for a moment
+    function scheduleUpdate() {{
+        clearTimeout(updateTimer);
+        updateTimer = setTimeout(updateMap, sliderDebounceMs);
+    }}
+
+    function overlayUrlFor(band, year) {{
+        return `http://localhost:8000/Crete_${{band}}_${{year}}.${{overlayExtension}}`;
+    }}
+
+    // Download and decode an overlay image once, later calls reuse it
+    function loadImage(url) {{
+        if (imageCache[url]) {{
+            return imageCache[url].promise;
+        }}
+        var entry = {{ image: new Image(), done: false }};
+        entry.promise = new Promise(function(resolve, reject) {{
+            entry.image.onload = function() {{
+                entry.done = true;
+                var decoded = entry.image.decode ? entry.image.decode() : Promise.resolve();
+                decoded.then(function() {{ resolve(url); }}, function() {{ resolve(url); }});
+            }};
+            entry.image.onerror = function() {{
+                delete imageCache[url];
+                reject(new Error('Failed to load ' + url));
+            }};
+        }});
+        imageCache[url] = entry;
+        entry.image.src = url;
+        return entry.promise;
+    }}
+
+    // Preload the years around the selected one and cancel downloads far from it
+    function prefetchNeighbours(band, year) {{
+        var slider = document.getElementById('yearSlider');
+        var keep = [];
+        for (var offset = -prefetchYears; offset <= prefetchYears; offset++) {{
+            var neighbour = Number(year) + offset;
+            if (neighbour < Number(slider.min) || neighbour > Number(slider.max)) {{
+                continue;
+            }}
+            var url = overlayUrlFor(band, neighbour);
+            keep.push(url);
+            loadImage(url).catch(function() {{}});
+        }}
+        Object.keys(imageCache).forEach(function(url) {{
+            var entry = imageCache[url];
+            if (keep.indexOf(url) < 0 && !entry.done) {{
+                entry.image.onerror = null;
+                entry.image.src = '';
+                delete imageCache[url];
+            }}
+        }});
+    }}
+
+    // Download a band's packed cube once: JSON metadata plus one uint8 index per pixel and year
+    function loadCube(band) {{
+        if (cubeCache[band]) {{
+            return cubeCache[band];
+        }}
+        if (cubeDownload) {{
+            cubeDownload.abort();  // Stop downloading the cube of the previously selected band
+        }}
+        var controller = cubeDownload = new AbortController();
+        var base = `http://localhost:8000/Crete_${{band}}_cube`;
+        function fetchChecked(url) {{
+            return fetch(url, {{ signal: controller.signal }}).then(function(response) {{
+                if (!response.ok) {{
+                    throw new Error('Failed to load ' + url + ': ' + response.status);
+                }}
+                return response;
+            }});
+        }}
+        var promise = Promise.all([
+            fetchChecked(base + '.json').then(function(response) {{ return response.json(); }}),
+            fetchChecked(base + '.bin').then(function(response) {{ return response.arrayBuffer(); }})
+        ]).then(function(results) {{
+            var meta = results[0];
+            return {{ meta: meta, data: new Uint8Array(results[1]), lut: new Uint32Array(new Uint8Array(meta.lut).buffer) }};
+        }});
+        promise.catch(function() {{
+            if (cubeCache[band] === promise) {{
+                delete cubeCache[band];
+            }}
+        }});
+        cubeCache[band] = promise;
+        return promise;
+    }}
+
+    // Colormap one year of a cube into the overlay canvas through the lookup table
+    function showCubeYear(cube, year) {{
+        var meta = cube.meta;
+        var index = meta.years.indexOf(Number(year));
+        if (index < 0) {{
+            return;
+        }}
+        var size = meta.width * meta.height;
+        var frame = cube.data.subarray(index * size, (index + 1) * size);
+        if (!cubeCanvas) {{
+            cubeCanvas = document.createElement('canvas');
+            cubeCanvas.style.imageRendering = 'pixelated';
+        }}
+        if (cubeCanvas.width !== meta.width || cubeCanvas.height !== meta.height) {{
+            cubeCanvas.width = meta.width;
+            cubeCanvas.height = meta.height;
+        }}
+        var context = cubeCanvas.getContext('2d');
+        var imageData = context.createImageData(meta.width, meta.height);
+        var pixels = new Uint32Array(imageData.data.buffer);
+        for (var i = 0; i < size; i++) {{
+            pixels[i] = cube.lut[frame[i]];
+        }}
+        context.putImageData(imageData, 0, 0);
+
+        if (overlayLayer && overlayLayer.isCanvas) {{
+            overlayLayer.setBounds(L.latLngBounds(meta.bounds));
+            return;
+        }}
+        if (overlayLayer) {{
+            map.removeLayer(overlayLayer);
+        }}
+        overlayLayer = new CanvasOverlay(cubeCanvas, meta.bounds, {{ opacity: 0.6 }});
+        overlayLayer.isCanvas = true;
+        overlayLayer.addTo(map);
+    }}
+
+    // Swap the overlay without flicker: the new year is shown only once it is decoded
+    function updateOverlayFast(band, year, bounds) {{
+        var request = ++overlayRequest;
+        if (usePackedCubes) {{
+            loadCube(band).then(function(cube) {{
+                if (request === overlayRequest) {{
+                    showCubeYear(cube, year);
+                }}
+            }}).catch(function(error) {{ console.log('Cube not loaded:', error); }});
+            return;
+        }}
+        var url = overlayUrlFor(band, year);
+        loadImage(url).then(function() {{
+            if (request !== overlayRequest) {{
+                return;  // A newer year was selected meanwhile
+            }}
+            if (overlayLayer && overlayLayer.isImage) {{
+                overlayLayer.setUrl(url);
+                return;
+            }}
+            if (overlayLayer) {{
+                map.removeLayer(overlayLayer);
+            }}
+            overlayLayer = L.imageOverlay(url, bounds, {{ opacity: 0.6 }});
+            overlayLayer.isImage = true;
+            overlayLayer.addTo(map);
+        }}).catch(function(error) {{ console.log('Overlay not loaded:', error); }});
+        prefetchNeighbours(band, year);
     }}
 
     function updateMap() {{
@@ -154,26 +457,51 @@ zoom_js = f"""
         console.log('Selected Band:', band, 'Selected Year:', year);
 
         // Example: Update the overlay layer (Assuming you have a server to serve .png files)
-        var overlayUrl = `http://localhost:8000/Crete_${{band}}_${{year}}.png`;
+        var overlayUrl = overlayUrlFor(band, year);
         console.log('Overlay URL:', overlayUrl);
-        
-        // Remove the existing overlay layer if it exists
-        if (overlayLayer) {{
-            map.removeLayer(overlayLayer);
-        }}
-        
-        // Add the new overlay layer
         var bounds = [[34.8, 23.3], [35.8, 26.7]];
-        overlayLayer = L.imageOverlay(overlayUrl, bounds, {{ opacity: 0.6 }});
-        overlayLayer.addTo(map);
 
+        if (performanceMode && (usePackedCubes || !useTiles)) {{
+            updateOverlayFast(band, year, bounds);
+        }} else {{
+            // Remove the existing overlay layer if it exists
+            if (overlayLayer) {{
+                map.removeLayer(overlayLayer);
+            }}
+
+            // Add the new overlay layer
+            if (useTiles) {{
+                // Only the tiles visible at the current zoom are downloaded
+                var tileUrl = `http://localhost:8000/tiles/Crete_${{band}}_${{year}}/{{z}}/{{x}}/{{y}}.png`;
+                overlayLayer = L.tileLayer(tileUrl, {{
+                    opacity: 0.6,
+                    bounds: bounds,
+                    minNativeZoom: {tile_min_zoom},
+                    maxNativeZoom: {tile_max_zoom}
+                }});
+            }} else {{
+                overlayLayer = L.imageOverlay(overlayUrl, bounds, {{ opacity: 0.6 }});
+            }}
+            overlayLayer.addTo(map);
+        }}
+
+        // The color bar only changes with the band
+        if (!performanceMode || band !== colorbarBand) {{
+            colorbarBand = band;
+            updateColorbar(band);
+        }}
+    }}
+
+    function updateColorbar(band) {{
         // Update the color bar
         if (colorbarLayer) {{
             map.removeLayer(colorbarLayer);
         }}
 
         var colorbarUrl;
-        switch(band) {{
+        if (useLegendEndpoint) {{
+            colorbarUrl = `http://localhost:8000/legend/${{band}}.png?height=${{legendHeight}}`;
+        }} else switch(band) {{
             case 'Temperature_2m':
                 colorbarUrl = 'http://localhost:8000/colorbar_Temperature_2m.png';
                 break;
@@ -201,7 +529,48 @@ zoom_js = f"""
 # Add the JavaScript to the map
 m.get_root().html.add_child(folium.Element(zoom_js))
 
-# Save the map
-m.save("C:/Users/nboub/Pictures/Data1/greece_map.html")
+# Add the climatology layers, hidden until chosen in the layer control
+page_inputs = [__file__]
+if show_climatology_layers and os.path.exists(climatology_index):
+    page_inputs.append(climatology_index)
+    with open(climatology_index) as f:
+        climatology = json.load(f)
+    for band, description in sorted(climatology.items()):
+        for layer in climatology_layers:
+            if layer not in description['layers']:
+                continue
+            style = description['layers'][layer]
+            folium.raster_layers.ImageOverlay(
+                image=f"http://localhost:8000/{style['files'][0]}",
+                bounds=description['bounds'],
+                opacity=0.6,
+                name=f"{band.replace('_', ' ').capitalize()} {layer.replace('_', ' ')} ({style['vmin']:.4g} to {style['vmax']:.4g}, {style['cmap']})",
+                show=False
+            ).add_to(m)
+    folium.LayerControl(collapsed=True).add_to(m)
 
-print("Map saved as greece_map.html. Open this file in a web browser to view it.")
+# Save the map
+html_path = "C:/Users/nboub/Pictures/Data1/greece_map.html"
+html_params = {
+    'folium': folium.__version__,
+    'use_tiles': use_tiles,
+    'tile_zoom': [tile_min_zoom, tile_max_zoom],
+    'overlay_extension': overlay_extension,
+    'use_legend_endpoint': use_legend_endpoint,
+    'legend_height': legend_height,
+    'performance_mode': performance_mode,
+    'prefetch_years': prefetch_years,
+    'slider_debounce_ms': slider_debounce_ms,
+    'use_packed_cubes': use_packed_cubes,
+    'show_timeseries': show_timeseries,
+    'timeseries_url': timeseries_url,
+    'show_climatology_layers': show_climatology_layers,
+    'climatology_layers': climatology_layers
+}
+if incremental_build and is_up_to_date(html_path, page_inputs, html_params):
+    print("greece_map.html is up to date.")
+else:
+    m.save(html_path)
+    record_output(html_path, page_inputs, html_params)
+    save_manifest()
+    print("Map saved as greece_map.html. Open this file in a web browser to view it.")
@@ -5,6 +5,13 @@ import rasterio
 import matplotlib.pyplot as plt
 from matplotlib.colors import Normalize
 from rasterio.plot import show
+from PIL import Image
+from fast_render import build_lut, quantize, upscale, render_rgba, compose_frame
+from raster_catalog import refresh_catalog, get_entries, get_band_limits
+from build_manifest import is_up_to_date, record_output, save_manifest
+from tracing import span, log, file_size, start_trace
+from band_store import read_stored
+from legend_atlas import get_legend, save_atlas
 
 # Define paths
 base_paths = {
@@ -15,6 +22,20 @@ base_paths = {
     'wind_U': 'C:/Users/nboub/Pictures/Crete_Wind_U'
 }
 dem_path = 'C:/Users/nboub/Desktop/crete_dem.tif'
+plot_folder = 'C:/Users/nboub/Desktop/Plots'
+csv_folder = 'C:/Users/nboub/Desktop'
+
+# Bands to process
+bands = ['temperature_2m', 'total_Precipitation', 'soil_Moisture', 'surface_Pressure', 'wind_U']
+
+# Render plots through the lookup table renderer instead of one matplotlib figure per year
+fast_rendering = True
+
+# Approximate width in pixels of the map part of each plot in fast rendering
+plot_width = 800
+
+# Only redraw plots whose input raster or plot parameters changed since the last run
+incremental_build = True
 
 # Define units for each band
 units = {
@@ -25,109 +46,141 @@ units = {
     'wind_U': 'm/s'
 }
 
-# Load the DEM file
-print(f"Loading DEM file from {dem_path}")
-with rasterio.open(dem_path) as dem_data:
-    dem_array = dem_data.read(1)
-    dest_crs = dem_data.crs
-    dest_transform = dem_data.transform
-print(f"Destination CRS: {dest_crs}")
-
-# Function to read and verify each year's data for a given band
-def process_yearly_data(year, band, base_path):
-    try:
-        # Define file path for the data
-        data_path = os.path.join(base_path, f'Crete_{band.capitalize()}_{year}.tif')
-
-        # Check if file exists
-        if not os.path.exists(data_path):
-            print(f"File not found: {data_path}")
-            return {'year': year, band: np.nan, f'{band}_array': np.nan}
-
-        # Load the data
-        print(f"Loading {band} data from {data_path}")
-        with rasterio.open(data_path) as data:
-            data_array = data.read(1)
-            metadata = data.meta
-
-            # Debugging: Check the metadata and some data values
-            print(f"Metadata for {year} {band}: {metadata}")
-            print(f"{band.capitalize()} data sample for {year}: {data_array[0:5, 0:5]}")
-
-            # Debugging: Check the data
-            min_val = np.nanmin(data_array)
-            max_val = np.nanmax(data_array)
-            mean_val = np.nanmean(data_array)
-            print(f"{band.capitalize()} data for {year}: min={min_val}, max={max_val}, mean={mean_val}")
-
-            # Return the processed data
-            return {
-                'year': year,
-                band: mean_val,
-                f'{band}_array': data_array  # Store the array for later plotting
-            }
-    except Exception as e:
-        print(f"Error processing data for year {year} band {band}: {e}")
-        return {
-            'year': year,
-            band: np.nan,
-            f'{band}_array': np.nan
-        }
-
-# Bands to process
-bands = ['temperature_2m', 'total_Precipitation', 'soil_Moisture', 'surface_Pressure', 'wind_U']
-
-# Process data for all years and all bands
-all_data = {band: [] for band in bands}
-global_min_max = {band: {'min': np.inf, 'max': -np.inf} for band in bands}
-
-for year in range(1990, 2021):
-    for band in bands:
-        data = process_yearly_data(year, band, base_paths[band])
-        all_data[band].append(data)
-        
-        # Update global min and max for the band
-        if not np.isnan(data[f'{band}_array']).all():
-            global_min_max[band]['min'] = min(global_min_max[band]['min'], np.nanmin(data[f'{band}_array']))
-            global_min_max[band]['max'] = max(global_min_max[band]['max'], np.nanmax(data[f'{band}_array']))
+# Function to read one year's data with nodata set to NaN, from its band cube when it was ingested
+def read_data_array(data_path):
+    stored = read_stored(data_path)
+    if stored is not None:
+        return stored[0]
+    with span('read', path=data_path, bytes_read=file_size(data_path)), rasterio.open(data_path) as data:
+        data_array = data.read(1).astype(np.float32)
+        if data.nodata is not None:
+            data_array[data_array == data.nodata] = np.nan
+    return data_array
+
+# First pass: yearly and global statistics come from the raster catalog, no raster is opened
+def collect_band_statistics(band):
+    rows = []
+    data_paths = {}
+    entries = {entry['year']: entry for entry in get_entries(band, folder=base_paths[band])}
+    for year in range(1990, 2021):
+        entry = entries.get(year)
+        if entry is None or not entry['valid_count']:
+            log(f"No {band} data for {year} in {base_paths[band]}")
+            rows.append({'year': year, band: np.nan})
+            continue
+        log(f"{band.capitalize()} data for {year}: min={entry['min']}, max={entry['max']}, mean={entry['mean']}")
+        rows.append({'year': year, band: entry['mean']})
+        data_paths[year] = entry['path']
 
-# Convert results to DataFrames
-df_all = {band: pd.DataFrame(all_data[band]) for band in bands}
+    stats = get_band_limits(band, folder=base_paths[band]) or {'min': np.nan, 'max': np.nan, 'mean': np.nan}
+    log(f"Global {band} statistics: min={stats['min']}, max={stats['max']}, mean={stats['mean']}")
+    return pd.DataFrame(rows), data_paths, stats
 
 # Normalize the data
 def normalize_data(df):
     df_normalized = df.copy()
     for column in df.columns:
-        if column != 'year' and not column.endswith('_array'):
+        if column != 'year':
             df_normalized[column] = (df[column] - df[column].min()) / (df[column].max() - df[column].min())
     return df_normalized
 
-df_all_normalized = {band: normalize_data(df_all[band]) for band in bands}
+# Function to describe the parameters of a band's plots for the build manifest
+def plot_params(renderer, cmap, global_min, global_max, unit):
+    params = {'renderer': renderer, 'cmap': cmap, 'vmin': global_min, 'vmax': global_max, 'unit': unit}
+    if renderer == 'fast':
+        params['plot_width'] = plot_width
+    return params
+
+# Function to get the path of one year's plot
+def plot_path_for(band, year):
+    return os.path.join(plot_folder, band, f'{band}_data_{year}.png')
+
+# Function to get the path of a band's normalized statistics
+def csv_path_for(band):
+    return os.path.join(csv_folder, f'normalized_crete_{band}_data.csv')
+
+# Function to render one year's plot as an RGBA frame with the lookup table renderer
+# The colorbar of the band comes from the legend atlas and is returned too, so callers only look it up once
+def render_plot_frame(data_array, band, year, cmap, global_min, global_max, unit, colorbar=None):
+    factor = max(1, plot_width // data_array.shape[1])
+    indices = upscale(quantize(data_array, global_min, global_max), factor)
+    if colorbar is None:
+        colorbar = get_legend(cmap, global_min, global_max, f'Unit: {unit}', indices.shape[0])
+    frame = compose_frame(render_rgba(indices, build_lut(cmap)), colorbar, f'{band.capitalize()} Data for {year}')
+    return frame, colorbar
 
 # Save the normalized data
-for band, df in df_all_normalized.items():
-    output_csv_path = os.path.join('C:/Users/nboub/Desktop', f'normalized_crete_{band}_data.csv')
-    df.to_csv(output_csv_path, index=False)
-    print(f"Normalized {band} data saved to {output_csv_path}")
-
-# Plotting the data and saving to files
-def plot_and_save_data(df, band, cmap, global_min, global_max, unit):
-    plot_dir = os.path.join('C:/Users/nboub/Desktop/Plots', band)
+def save_normalized_csv(band, df, data_paths):
+    output_csv_path = csv_path_for(band)
+    csv_inputs = list(data_paths.values())
+    if incremental_build and is_up_to_date(output_csv_path, csv_inputs, {}):
+        log(f"Normalized {band} data is up to date in {output_csv_path}")
+        return
+    with span('normalize', band=band, rows=len(df)):
+        df_normalized = normalize_data(df)
+    with span('write', band=band, path=output_csv_path) as args:
+        df_normalized.to_csv(output_csv_path, index=False)
+        args['bytes_written'] = file_size(output_csv_path)
+    record_output(output_csv_path, csv_inputs, {})
+    log(f"Normalized {band} data saved to {output_csv_path}")
+
+# Second pass: plotting the data and saving to files, reading one raster at a time
+def plot_and_save_data(df, band, data_paths, cmap, global_min, global_max, unit):
+    plot_dir = os.path.join(plot_folder, band)
+    os.makedirs(plot_dir, exist_ok=True)
+    params = plot_params('matplotlib', cmap, global_min, global_max, unit)
+    for year, mean_val in zip(df['year'], df[band]):
+        if np.isnan(mean_val):
+            log(f"Skipping plot for {band} in {year} due to all NaN values")
+            continue
+        plot_path = plot_path_for(band, year)
+        if incremental_build and is_up_to_date(plot_path, [data_paths[year]], params):
+            log(f'Plot for {band} in {year} is up to date')
+            continue
+        with span('plot', band=band, year=year):
+            data_array = read_data_array(data_paths[year])
+            with span('render'):
+                plt.figure(figsize=(10, 6))
+                plt.imshow(data_array, cmap=cmap, norm=Normalize(vmin=global_min, vmax=global_max))
+                cbar = plt.colorbar()
+                cbar.set_label(f'Unit: {unit}')
+                plt.title(f'{band.capitalize()} Data for {year}')
+            # Matplotlib only draws the figure when saving it, so this span holds most of the drawing
+            with span('encode', path=plot_path) as args:
+                plt.savefig(plot_path)
+                plt.close()
+                args['bytes_written'] = file_size(plot_path)
+        del data_array
+        record_output(plot_path, [data_paths[year]], params)
+        log(f'Saved plot to {plot_path}')
+    save_manifest()
+
+# Second pass with the lookup table renderer: the colorbar comes from the legend atlas, rendered at most once
+def plot_and_save_data_fast(df, band, data_paths, cmap, global_min, global_max, unit):
+    plot_dir = os.path.join(plot_folder, band)
     os.makedirs(plot_dir, exist_ok=True)
-    for index, row in df.iterrows():
-        data_array = row[f'{band}_array']  # Access the stored data array
-        if np.isnan(data_array).all():
-            print(f"Skipping plot for {band} in {row['year']} due to all NaN values")
+    colorbar = None
+    params = plot_params('fast', cmap, global_min, global_max, unit)
+    for year, mean_val in zip(df['year'], df[band]):
+        if np.isnan(mean_val):
+            log(f"Skipping plot for {band} in {year} due to all NaN values")
+            continue
+        plot_path = plot_path_for(band, year)
+        if incremental_build and is_up_to_date(plot_path, [data_paths[year]], params):
+            log(f'Plot for {band} in {year} is up to date')
             continue
-        plt.figure(figsize=(10, 6))
-        plt.imshow(data_array, cmap=cmap, norm=Normalize(vmin=global_min, vmax=global_max))
-        cbar = plt.colorbar()
-        cbar.set_label(f'Unit: {unit}')
-        plt.title(f'{band.capitalize()} Data for {row["year"]}')
-        plot_path = os.path.join(plot_dir, f'{band}_data_{row["year"]}.png')
-        plt.savefig(plot_path)
-        plt.close()
-        print(f'Saved plot to {plot_path}')
+        with span('plot', band=band, year=year):
+            data_array = read_data_array(data_paths[year])
+            with span('render'):
+                frame, colorbar = render_plot_frame(data_array, band, year, cmap, global_min, global_max, unit, colorbar)
+            with span('encode', path=plot_path) as args:
+                Image.fromarray(frame).save(plot_path, compress_level=1)
+                args['bytes_written'] = file_size(plot_path)
+        del data_array
+        record_output(plot_path, [data_paths[year]], params)
+        log(f'Saved plot to {plot_path}')
+    save_manifest()
+    save_atlas()
 
 # Define color maps for each band
 cmap_dict = {
@@ -138,6 +191,24 @@ cmap_dict = {
     'wind_U': 'Purples'
 }
 
-# Plot the data for each band and save to files
-for band in bands:
-    plot_and_save_data(df_all[band], band, cmap_dict[band], global_min_max[band]['min'], global_min_max[band]['max'], units[band])
+if __name__ == '__main__':
+    start_trace()
+    # Load the DEM file
+    log(f"Loading DEM file from {dem_path}")
+    with span('read', path=dem_path, bytes_read=file_size(dem_path)), rasterio.open(dem_path) as dem_data:
+        dem_array = dem_data.read(1)
+        dest_crs = dem_data.crs
+        dest_transform = dem_data.transform
+    log(f"Destination CRS: {dest_crs}")
+
+    refresh_catalog()
+    df_all, data_paths, global_stats = {}, {}, {}
+    for band in bands:
+        df_all[band], data_paths[band], global_stats[band] = collect_band_statistics(band)
+        save_normalized_csv(band, df_all[band], data_paths[band])
+    save_manifest()
+
+    # Plot the data for each band and save to files
+    for band in bands:
+        plot_function = plot_and_save_data_fast if fast_rendering else plot_and_save_data
+        plot_function(df_all[band], band, data_paths[band], cmap_dict[band], global_stats[band]['min'], global_stats[band]['max'], units[band])
@@ -0,0 +1,93 @@
+from functools import lru_cache
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+import matplotlib
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.cm import ScalarMappable
+from matplotlib.colors import Normalize
+from matplotlib.figure import Figure
+
+# The lookup table has 255 colours and one transparent entry for NaN/nodata
+n_colors = 255
+nodata_index = 255
+
+# Function to build the 256-entry uint8 RGBA lookup table of a colormap
+@lru_cache(maxsize=None)
+def build_lut(cmap_name):
+    lut = np.zeros((256, 4), dtype=np.uint8)
+    colors = matplotlib.colormaps[cmap_name](np.linspace(0, 1, n_colors))
+    lut[:n_colors] = np.round(colors * 255).astype(np.uint8)
+    lut[nodata_index] = (0, 0, 0, 0)  # Transparent for NaN/nodata
+    lut.setflags(write=False)
+    return lut
+
+# Function to quantize a raster against fixed limits into lookup table indices
+def quantize(array, vmin, vmax, nodata=None):
+    scale = n_colors / (vmax - vmin) if vmax > vmin else 0.0
+    work = np.subtract(array, vmin, dtype=np.float32)
+    work *= scale
+    np.clip(work, 0, n_colors - 1, out=work)
+    invalid = np.isnan(array)
+    if nodata is not None:
+        invalid |= array == nodata
+    work[invalid] = nodata_index
+    return work.astype(np.uint8)
+
+# Function to enlarge an index array by an integer factor without interpolation
+def upscale(indices, factor):
+    if factor <= 1:
+        return indices
+    return np.repeat(np.repeat(indices, factor, axis=0), factor, axis=1)
+
+# Function to turn lookup table indices into an RGBA image array
+def render_rgba(indices, lut):
+    return np.take(lut, indices, axis=0)
+
+# Function to write lookup table indices straight to a palette PNG with a transparent nodata entry
+def save_indexed_png(indices, lut, path, compress_level=6):
+    img = Image.fromarray(indices, 'P')
+    img.putpalette(lut[:, :3].tobytes())
+    img.save(path, format='PNG', compress_level=compress_level, transparency=lut[:, 3].tobytes())
+
+# Function to render a vertical colorbar once as an RGBA image array of the given height
+# Uses the Agg canvas directly, so it does not depend on the pyplot backend or thread
+def render_colorbar(cmap_name, vmin, vmax, label, height, dpi=100, transparent=False):
+    fig = Figure(figsize=(1.2, height / dpi), dpi=dpi)
+    if transparent:
+        fig.patch.set_alpha(0.0)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_axes([0.15, 0.05, 0.2, 0.9])
+    cb = fig.colorbar(ScalarMappable(norm=Normalize(vmin=vmin, vmax=vmax), cmap=cmap_name), cax=ax)
+    cb.set_label(label)
+    canvas.draw()
+    return np.asarray(canvas.buffer_rgba()).copy()
+
+# Function to render a title line as an RGBA image array
+def render_title(text, width, height=32, font_size=18):
+    img = Image.new('RGBA', (width, height), (255, 255, 255, 255))
+    draw = ImageDraw.Draw(img)
+    font = ImageFont.load_default(size=font_size)
+    text_width = draw.textlength(text, font=font)
+    draw.text(((width - text_width) / 2, (height - font_size) / 2), text, fill=(0, 0, 0, 255), font=font)
+    return np.asarray(img)
+
+# Function to place the map, an optional colorbar and an optional title on one white frame
+def compose_frame(rgba, colorbar=None, title=None):
+    height, width = rgba.shape[:2]
+    bar_width = colorbar.shape[1] if colorbar is not None else 0
+    bar_height = colorbar.shape[0] if colorbar is not None else 0
+    title_height = 0
+    if title is not None:
+        title_strip = render_title(title, width + bar_width)
+        title_height = title_strip.shape[0]
+    frame = np.full((title_height + max(height, bar_height), width + bar_width, 3), 255, dtype=np.uint8)
+    if title is not None:
+        frame[:title_height] = title_strip[:, :, :3]
+
+    # Blend the map over the white background using its alpha channel
+    alpha = rgba[:, :, 3:4].astype(np.uint32)
+    frame[title_height:title_height + height, :width] = (rgba[:, :, :3] * alpha + 255 * (255 - alpha)) // 255
+    if colorbar is not None:
+        bar_alpha = colorbar[:, :, 3:4].astype(np.uint32)
+        frame[title_height:title_height + bar_height, width:] = (colorbar[:, :, :3] * bar_alpha + 255 * (255 - bar_alpha)) // 255
+    return frame
@@ -1,28 +1,21 @@
-import matplotlib.pyplot as plt
-import numpy as np
+import os
+from PIL import Image
+from raster_catalog import refresh_catalog
+from tracing import start_trace
+from legend_atlas import band_legends, band_legend, build_atlas, save_atlas
 
-# Define the color maps and their ranges for each band
-color_maps = {
-    'Temperature_2m': ('hot', 270, 310, 'K'),
-    'Total_Precipitation': ('Blues', 0, 300, 'mm'),
-    'Soil_Moisture': ('Greens', 0, 1, 'm³/m³'),
-    'Surface_Pressure': ('Oranges', 950, 1050, 'hPa'),
-    'Wind_U': ('Purples', 0, 15, 'm/s')
-}
+# Folder the colorbars of the map are written to, served by server.py
+output_folder = 'C:/Users/nboub/Pictures/Data1'
 
-def create_colorbar(cmap_name, vmin, vmax, label, filename):
-    fig, ax = plt.subplots(figsize=(2, 8), dpi=100, subplot_kw={'frame_on': False})  # Increased height to make it longer
-    norm = plt.Normalize(vmin=vmin, vmax=vmax)
-    fig.patch.set_alpha(0.0)  # Set figure background to transparent
-    fig.subplots_adjust(left=0.3, right=0.8, top=0.9, bottom=0.1)
+# Height in pixels of the colorbars shown on the map
+map_legend_height = 600
 
-    cb = plt.colorbar(plt.cm.ScalarMappable(norm=norm, cmap=cmap_name), cax=ax, orientation='vertical')
-    cb.set_label(label, fontsize=12)
-    cb.outline.set_visible(False)
-    cb.ax.yaxis.set_tick_params(color='black')
-
-    plt.savefig(filename, transparent=True, bbox_inches='tight', pad_inches=0)
-    plt.close()
-
-for band, (cmap, vmin, vmax, unit) in color_maps.items():
-    create_colorbar(cmap, vmin, vmax, f'{band} ({unit})', f'colorbar_{band}.png')
+# Every band's legend is rendered once into the legend atlas, at every preset size, with the range of the band's data
+# The map's colorbar_{band}.png files are cut out of the atlas
+start_trace()
+refresh_catalog()
+build_atlas()
+os.makedirs(output_folder, exist_ok=True)
+for band in band_legends:
+    Image.fromarray(band_legend(band, map_legend_height), 'RGBA').save(os.path.join(output_folder, f'colorbar_{band}.png'))
+save_atlas()
@@ -0,0 +1,156 @@
+import os
+import json
+import threading
+import time
+import numpy as np
+import matplotlib
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+from fast_render import render_colorbar
+from raster_catalog import cached_band_limits
+from tracing import span, log, file_size
+
+# Sprite atlas of every rendered colorbar, shared by the plots, the 3D frames and the map
+# The position of each legend is stored in the PNG itself, so the atlas is replaced in one step
+atlas_path = 'C:/Users/nboub/Pictures/Legends/legend_atlas.png'
+
+# Color map and unit of each band, and the range used when the band is not in the raster catalog yet
+band_legends = {
+    'Temperature_2m': ('hot', 'K', (270, 310)),
+    'Total_Precipitation': ('Blues', 'm', (0, 0.01)),
+    'Soil_Moisture': ('Greens', 'm³/m³', (0, 1)),
+    'Surface_Pressure': ('Oranges', 'Pa', (95000, 105000)),
+    'Wind_U': ('Purples', 'm/s', (0, 15))
+}
+
+# Folder of the GeoTIFFs whose global limits set the range of each band's legend
+data_folder = 'C:/Users/nboub/Pictures/Data'
+
+# Heights in pixels every band's legend is rendered at ahead of time, other heights are rendered once when first asked for
+legend_heights = [256, 480, 600, 768]
+
+# Width in pixels of the atlas image, legends are packed in shelves left to right
+atlas_width = 2048
+
+# Legends of the atlas: key -> RGBA array and key -> time it was rendered, loaded on first use,
+# and whether new ones were rendered since the last save
+_atlas = {'legends': None, 'added': None, 'dirty': False}
+_atlas_lock = threading.RLock()
+
+# Function to name a legend in the atlas by everything that changes its pixels
+def legend_key(cmap, vmin, vmax, label, height):
+    return json.dumps([cmap, float(vmin), float(vmax), label, int(height)], ensure_ascii=False)
+
+# Function to name the slot of a legend: a legend of the same colormap, label and height with a newer range replaces it
+def legend_slot(key):
+    cmap, _, _, label, height = json.loads(key)
+    return json.dumps([cmap, label, height], ensure_ascii=False)
+
+# Function to read the legends of the atlas file and when each was rendered,
+# none if it does not exist or was rendered by another matplotlib version
+def read_atlas():
+    if not os.path.exists(atlas_path):
+        return {}, {}
+    with span('read', path=atlas_path, bytes_read=file_size(atlas_path)), Image.open(atlas_path) as img:
+        index = json.loads(img.text.get('legends', '{}'))
+        if index.get('matplotlib') != matplotlib.__version__:
+            return {}, {}
+        sprite = np.asarray(img.convert('RGBA'))
+    legends = {key: sprite[y:y + height, x:x + width] for key, (x, y, width, height) in index['positions'].items()}
+    return legends, {key: index.get('added', {}).get(key, 0) for key in legends}
+
+# Function to get the legends of the atlas, read from disk on first use
+def load_atlas():
+    with _atlas_lock:
+        if _atlas['legends'] is None:
+            _atlas['legends'], _atlas['added'] = read_atlas()
+        return _atlas['legends']
+
+# Function to get a colorbar as an RGBA array from the atlas, rendered and added to it on first use
+def get_legend(cmap, vmin, vmax, label, height):
+    key = legend_key(cmap, vmin, vmax, label, height)
+    legends = load_atlas()
+    with _atlas_lock:
+        legend = legends.get(key)
+        if legend is None:
+            with span('render_legend', cmap=cmap, height=height):
+                legend = render_colorbar(cmap, vmin, vmax, label, height, transparent=True)
+            legends[key] = legend
+            _atlas['added'][key] = time.time()
+            _atlas['dirty'] = True
+        return legend
+
+# Function to get the global range of a band from the raster catalog, or its default range
+def band_range(band, folder=None):
+    limits = cached_band_limits(band, folder=folder or data_folder)
+    if limits is None:
+        return band_legends[band][2]
+    return limits['min'], limits['max']
+
+# Function to get the legend of a band as shown on the map, labelled with the band and its unit
+def band_legend(band, height, folder=None):
+    cmap, unit, _ = band_legends[band]
+    vmin, vmax = band_range(band, folder)
+    return get_legend(cmap, vmin, vmax, f'{band} ({unit})', height)
+
+# Function to pack the legends into shelves, tallest first, returns the atlas size and the position of each legend
+def pack_legends(legends):
+    positions = {}
+    x = y = shelf_height = used_width = 0
+    for key, legend in sorted(legends.items(), key=lambda item: -item[1].shape[0]):
+        height, width = legend.shape[:2]
+        if x + width > atlas_width and x > 0:
+            x, y, shelf_height = 0, y + shelf_height, 0
+        positions[key] = (x, y, width, height)
+        x += width
+        shelf_height = max(shelf_height, height)
+        used_width = max(used_width, x)
+    return max(used_width, 1), max(y + shelf_height, 1), positions
+
+# Function to keep only the newest legend of each slot, so legends of old catalog limits do not pile up in the atlas
+def prune_legends(legends, added):
+    newest = {}
+    for key in legends:
+        slot = legend_slot(key)
+        if slot not in newest or added[key] > added[newest[slot]]:
+            newest[slot] = key
+    for key in set(legends) - set(newest.values()):
+        del legends[key]
+        del added[key]
+
+# Function to save the atlas if legends were added, written to a temporary file first so readers never see half an atlas
+def save_atlas():
+    with _atlas_lock:
+        if not _atlas['dirty']:
+            return
+        legends = load_atlas()
+        added = _atlas['added']
+        # Keep the legends another process added since this one read the atlas
+        disk_legends, disk_added = read_atlas()
+        for key, legend in disk_legends.items():
+            if key not in legends:
+                legends[key] = legend
+                added[key] = disk_added[key]
+        prune_legends(legends, added)
+        width, height, positions = pack_legends(legends)
+        sprite = np.zeros((height, width, 4), dtype=np.uint8)
+        for key, (x, y, legend_width, legend_height) in positions.items():
+            sprite[y:y + legend_height, x:x + legend_width] = legends[key]
+        info = PngInfo()
+        index = {'matplotlib': matplotlib.__version__, 'positions': positions, 'added': {key: added[key] for key in positions}}
+        info.add_itxt('legends', json.dumps(index, ensure_ascii=False))
+        os.makedirs(os.path.dirname(atlas_path) or '.', exist_ok=True)
+        tmp_path = f"{atlas_path}.{os.getpid()}.tmp"
+        with span('encode', path=atlas_path) as args:
+            Image.fromarray(sprite, 'RGBA').save(tmp_path, format='PNG', pnginfo=info)
+            args['bytes_written'] = file_size(tmp_path)
+        os.replace(tmp_path, atlas_path)
+        _atlas['dirty'] = False
+        log(f"Saved {len(legends)} legends to {atlas_path}")
+
+# Function to render every band's legend at every preset height
+def build_atlas():
+    for band in band_legends:
+        for height in legend_heights:
+            band_legend(band, height)
+    save_atlas()
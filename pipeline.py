@@ -0,0 +1,414 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import rasterio
+import numpy as np
+from PIL import Image
+import tif_to_png
+import create_plots
+import create_3D
+import create_gifs
+from raster_catalog import refresh_catalog, get_entries, get_band_limits, band_key
+from build_manifest import is_up_to_date, record_output, save_manifest
+from legend_atlas import save_atlas
+from reproject_index import resample_array
+from tracing import span, log, annotate, file_size, start_trace
+import band_store
+import timeseries
+
+# Number of threads running the 2D stages, and how many rasters may be decoded and waiting for their stages
+pipeline_workers = os.cpu_count() or 1
+max_rasters_in_flight = 2 * pipeline_workers
+
+# Stages run by the pipeline
+run_stages = {
+    'overlay': True,
+    'tiles': tif_to_png.build_tiles,
+    'cube': tif_to_png.build_packed_cubes,
+    'plot': True,
+    'frame_3d': True,
+    'animation': True
+}
+
+# The DAG of one raster: each stage and the stage whose result it consumes, 'read' decodes the raster once
+stage_inputs = {
+    'overlay': 'read',
+    'tiles': 'read',
+    'cube': 'read',
+    'plot': 'read',
+    'frame_3d': 'read',
+    'animation': 'plot'
+}
+
+# Source of each stage: the GeoTIFFs of tif_to_png.py or the band folders of create_plots.py and create_3D.py
+stage_sources = {'overlay': 'overlay', 'tiles': 'overlay', 'cube': 'overlay', 'plot': 'plot', 'frame_3d': 'plot'}
+
+# Stages on their own single thread: VTK keeps its context on one thread and animation frames are written in order
+serial_stages = ['frame_3d', 'animation']
+
+# State of the 3D stage thread: DEM, terrain and the current band's plotter
+_session = {'dem_data': None, 'topo': None, 'band': None, 'plotter': None}
+
+# Function to read the first band of a raster as float32 with nodata set to NaN, with its georeferencing
+def read_raster(path):
+    cube, year = band_store.find_stored(path)
+    if cube is not None:
+        return {'path': path, 'array': cube.read_year(year), 'crs': cube.crs, 'transform': cube.transform, 'bounds': cube.bounds()}
+    annotate(bytes_read=file_size(path))
+    with rasterio.open(path) as src:
+        array = src.read(1).astype(np.float32)
+        if src.nodata is not None:
+            array[array == src.nodata] = np.nan
+        return {'path': path, 'array': array, 'crs': src.crs, 'transform': src.transform, 'bounds': src.bounds}
+
+# Function to work out which outputs of a band are missing or out of date, and which stages each year needs
+def plan_band(band):
+    overlay_band = next(name for name in tif_to_png.color_maps if band_key(name) == band_key(band))
+    folder_name = next(name for name, path in create_3D.folders.items() if path == os.path.basename(create_plots.base_paths[band]))
+    folder_full_path = os.path.join(create_3D.base_folder, create_3D.folders[folder_name])
+    df, plot_sources, plot_stats = create_plots.collect_band_statistics(band)
+    overlay_entries = {entry['year']: entry for entry in get_entries(band, folder=tif_to_png.data_folder)
+                       if entry['valid_count'] and entry['year'] in tif_to_png.years}
+    plot_entries = {entry['year']: entry for entry in get_entries(band, folder=create_plots.base_paths[band]) if entry['year'] in plot_sources}
+
+    overlay_limits = get_band_limits(band, folder=tif_to_png.data_folder) or {'min': None, 'max': None}
+    frame_min, frame_max = (create_3D.get_global_min_max(folder_full_path) if plot_entries else None) or (None, None)
+    plan = {
+        'band': band,
+        'overlay_band': overlay_band,
+        'overlay_cmap': tif_to_png.color_maps[overlay_band],
+        'overlay_limits': (overlay_limits['min'], overlay_limits['max']),
+        'overlay_entries': overlay_entries,
+        'plot_cmap': create_plots.cmap_dict[band],
+        'plot_limits': (plot_stats['min'], plot_stats['max']),
+        'plot_entries': plot_entries,
+        'unit': create_plots.units[band],
+        'folder_name': folder_name,
+        'frame_params': create_3D.frame_params(folder_name, frame_min, frame_max),
+        'frame_folder': os.path.join(create_3D.base_folder, f"{create_3D.folders[folder_name]}_Output"),
+        'df': df,
+        'plot_sources': plot_sources,
+        'colorbar': None,
+        'cube': None,
+        'animation': None,
+        'years': {}
+    }
+    vmin, vmax = plan['overlay_limits']
+    overlay_params = tif_to_png.overlay_params(plan['overlay_cmap'], vmin, vmax)
+    encoding_params = tif_to_png.overlay_encoding_params(plan['overlay_cmap'], vmin, vmax)
+    tile_params = tif_to_png.tile_params(plan['overlay_cmap'], vmin, vmax)
+    plot_params = create_plots.plot_params('fast', plan['plot_cmap'], *plan['plot_limits'], plan['unit'])
+
+    for year, entry in overlay_entries.items():
+        stages = plan['years'].setdefault(year, set())
+        if run_stages['overlay'] and not is_up_to_date(overlay_path(plan, year), [entry['path']], encoding_params):
+            stages.add('overlay')
+        if run_stages['tiles'] and not is_up_to_date(tile_dir(plan, year), [entry['path']], tile_params):
+            stages.add('tiles')
+
+    cube_years = sorted(overlay_entries)
+    cube_inputs = [overlay_entries[year]['path'] for year in cube_years]
+    if run_stages['cube'] and cube_years and not is_up_to_date(f"{cube_prefix(plan)}.json", cube_inputs, overlay_params):
+        # Written to a temporary file opened by the first year, which replaces the cube only once every year is in it
+        plan['cube'] = {'years': cube_years, 'inputs': cube_inputs, 'path': f"{cube_prefix(plan)}.bin.tmp", 'file': None,
+                        'lock': threading.Lock(), 'grid': None, 'n_written': 0}
+        for year in cube_years:
+            plan['years'][year].add('cube')
+
+    plot_years = sorted(plot_entries)
+    stale_plots = [year for year in plot_years if not is_up_to_date(create_plots.plot_path_for(band, year), [plot_entries[year]['path']], plot_params)]
+    animation_files = {output_format: os.path.join(create_gifs.output_gif_path, f'{band}.{output_format}') for output_format in create_gifs.output_formats}
+    plot_paths = [create_plots.plot_path_for(band, year) for year in plot_years]
+    # Animations are fed from the plot frames, so they need the plot stage
+    make_animations = run_stages['plot'] and run_stages['animation'] and plot_years
+    if make_animations and not stale_plots:
+        # The plots are current, so an animation is only rebuilt if it is older than them
+        animation_files = {output_format: output_file for output_format, output_file in animation_files.items()
+                           if not is_up_to_date(output_file, plot_paths, create_gifs.animation_params(output_format))}
+    if make_animations and animation_files:
+        plan['animation'] = {'files': animation_files, 'plot_paths': plot_paths, 'expected': plot_years, 'pending': {},
+                             'n_written': 0, 'palette': None, 'gif_file': None, 'encoders': {}}
+
+    for year in plot_years:
+        stages = plan['years'].setdefault(year, set())
+        if run_stages['plot'] and (year in stale_plots or plan['animation'] is not None):
+            stages.add('plot')
+        if plan['animation'] is not None:
+            stages.add('animation')
+        frame_path = os.path.join(plan['frame_folder'], f"{os.path.splitext(os.path.basename(plot_entries[year]['path']))[0]}.png")
+        if run_stages['frame_3d'] and not is_up_to_date(frame_path, [plot_entries[year]['path'], create_3D.dem_path], plan['frame_params']):
+            stages.add('frame_3d')
+
+    n_stale = sum(len(stages) for stages in plan['years'].values())
+    log(f"{band}: {n_stale} stage runs over {sum(1 for stages in plan['years'].values() if stages)} years to do.")
+    return plan
+
+# Functions to get the output paths of tif_to_png.py for a band
+def overlay_path(plan, year):
+    return f"{tif_to_png.overlay_folder}/{tif_to_png.overlay_file_name(plan['overlay_band'], year)}"
+
+def tile_dir(plan, year):
+    return f"{tif_to_png.overlay_folder}/tiles/Crete_{plan['overlay_band']}_{year}"
+
+def cube_prefix(plan):
+    return f"{tif_to_png.overlay_folder}/Crete_{plan['overlay_band']}_cube"
+
+# Stage: decode the rasters a year needs, once per distinct file content
+def run_read(task, upstream):
+    plan, year, stages = task['plan'], task['year'], task['stages']
+    entries = {'overlay': plan['overlay_entries'].get(year), 'plot': plan['plot_entries'].get(year)}
+    rasters, by_hash = {}, {}
+    for source, entry in entries.items():
+        if entry is None or not any(stage_sources.get(stage) == source for stage in stages):
+            continue
+        # The same GeoTIFF copied into two folders is only decoded once
+        if entry['sha256'] not in by_hash:
+            by_hash[entry['sha256']] = read_raster(entry['path'])
+        rasters[source] = dict(by_hash[entry['sha256']], path=entry['path'])
+    return rasters
+
+# Stage: colormapped overlay PNG of tif_to_png.py
+def run_overlay(task, rasters):
+    plan, raster = task['plan'], rasters['overlay']
+    vmin, vmax = plan['overlay_limits']
+    png_path = overlay_path(plan, task['year'])
+    os.makedirs(os.path.dirname(png_path), exist_ok=True)
+    tif_to_png.save_overlay_png(raster['array'], png_path, plan['overlay_cmap'], vmin, vmax)
+    record_output(png_path, [raster['path']], tif_to_png.overlay_encoding_params(plan['overlay_cmap'], vmin, vmax))
+
+# Stage: XYZ tile pyramid of tif_to_png.py
+def run_tiles(task, rasters):
+    plan, raster = task['plan'], rasters['overlay']
+    vmin, vmax = plan['overlay_limits']
+    tile_path = tile_dir(plan, task['year'])
+    tif_to_png.build_tile_pyramid_from_array(raster['array'], raster['crs'], raster['transform'], raster['bounds'], tile_path, plan['overlay_cmap'], vmin, vmax)
+    record_output(tile_path, [raster['path']], tif_to_png.tile_params(plan['overlay_cmap'], vmin, vmax))
+
+# Stage: one year of the packed cube of tif_to_png.py
+def run_cube(task, rasters):
+    cube, raster = task['plan']['cube'], rasters['overlay']
+    vmin, vmax = task['plan']['overlay_limits']
+    with cube['lock']:
+        if cube['file'] is None:
+            os.makedirs(os.path.dirname(cube['path']), exist_ok=True)
+            cube['file'] = open(cube['path'], 'wb')
+        if cube['grid'] is None:
+            cube['grid'] = (raster['array'].shape, raster['crs'], raster['bounds'])
+        tif_to_png.write_cube_year(cube['file'], cube['years'].index(task['year']), raster['array'], vmin, vmax)
+        cube['n_written'] += 1
+
+# Stage: 2D plot of create_plots.py, the frame is also passed on to the animation
+def run_plot(task, rasters):
+    plan, year, raster = task['plan'], task['year'], rasters['plot']
+    vmin, vmax = plan['plot_limits']
+    with span('render'):
+        frame, plan['colorbar'] = create_plots.render_plot_frame(raster['array'], plan['band'], year, plan['plot_cmap'], vmin, vmax, plan['unit'], plan['colorbar'])
+    plot_path = create_plots.plot_path_for(plan['band'], year)
+    params = create_plots.plot_params('fast', plan['plot_cmap'], vmin, vmax, plan['unit'])
+    if not is_up_to_date(plot_path, [raster['path']], params):
+        os.makedirs(os.path.dirname(plot_path), exist_ok=True)
+        with span('encode', path=plot_path) as args:
+            Image.fromarray(frame).save(plot_path, compress_level=1)
+            args['bytes_written'] = file_size(plot_path)
+        record_output(plot_path, [raster['path']], params)
+    return frame
+
+# Stage: 3D frame of create_3D.py, always on the same thread
+def run_frame_3d(task, rasters):
+    plan, raster = task['plan'], rasters['plot']
+    if _session['topo'] is None:
+        with span('terrain', band='run'):
+            _session['dem_data'] = create_3D.load_dem(create_3D.dem_path)
+            _session['topo'] = create_3D.build_terrain(_session['dem_data'])
+    params = plan['frame_params']
+    if _session['band'] != plan['band']:
+        if _session['plotter'] is not None:
+            _session['plotter'].close()
+        with span('render_session'):
+            _session['plotter'] = create_3D.create_render_session(_session['topo'], params['cmap'], params['unit'], params['vmin'], params['vmax'])
+        _session['band'] = plan['band']
+    data = resample_array(raster['array'], raster['crs'], raster['transform'], _session['dem_data'], create_3D.resampling_method,
+                          create_3D.terrain_vertices(_session['topo']))
+    title = os.path.splitext(os.path.basename(raster['path']))[0]
+    os.makedirs(plan['frame_folder'], exist_ok=True)
+    create_3D.render_session_frame(_session['plotter'], _session['topo'], data, title, plan['frame_folder'], params['unit'])
+    record_output(os.path.join(plan['frame_folder'], f"{title}.png"), [raster['path'], create_3D.dem_path], params)
+
+# Function to close the 3D plotter, run on the 3D stage thread
+def close_session():
+    if _session['plotter'] is not None:
+        _session['plotter'].close()
+    _session.update({'band': None, 'plotter': None})
+
+# Stage: feed a plot frame to the band's animations, frames are buffered until every earlier year is written
+def run_animation(task, frame):
+    animation = task['plan']['animation']
+    animation['pending'][task['year']] = frame
+    expected = animation['expected']
+    while animation['n_written'] < len(expected) and expected[animation['n_written']] in animation['pending']:
+        rgb = Image.fromarray(animation['pending'].pop(expected[animation['n_written']])).convert('RGB')
+        with span('encode', formats=list(animation['files'])):
+            write_animation_frame(animation, rgb)
+        animation['n_written'] += 1
+
+# Function to write one RGB frame to every animation format of a band
+def write_animation_frame(animation, rgb):
+    for output_format, output_file in animation['files'].items():
+        if output_format == 'gif':
+            if animation['gif_file'] is None:
+                # Every frame shows the full colorbar, so the first frame's palette covers the whole animation
+                animation['palette'] = create_gifs.build_palette([rgb])
+                palette_image = Image.new('P', (1, 1))
+                palette_image.putpalette(animation['palette'])
+                animation['palette_image'] = palette_image
+                os.makedirs(os.path.dirname(output_file), exist_ok=True)
+                animation['gif_file'] = open(create_gifs.temp_path(output_file), 'wb')
+            frame = rgb.quantize(palette=animation['palette_image'], dither=Image.Dither.NONE)
+            create_gifs.write_gif_frame(animation['gif_file'], frame, animation['n_written'])
+        else:
+            if output_format not in animation['encoders']:
+                os.makedirs(os.path.dirname(output_file), exist_ok=True)
+                animation['encoders'][output_format] = create_gifs.start_ffmpeg(create_gifs.temp_path(output_file), output_format, rgb.size)
+            animation['encoders'][output_format].stdin.write(rgb.tobytes())
+
+stage_functions = {
+    'read': run_read,
+    'overlay': run_overlay,
+    'tiles': run_tiles,
+    'cube': run_cube,
+    'plot': run_plot,
+    'frame_3d': run_frame_3d,
+    'animation': run_animation
+}
+
+# Function to run the stages of every task, each stage as soon as the stage it consumes is done
+# At most max_rasters_in_flight rasters are held in memory, a raster is dropped once all its stages are done
+def run_tasks(tasks):
+    pool = ThreadPoolExecutor(pipeline_workers)
+    executors = {stage: ThreadPoolExecutor(1) for stage in serial_stages}
+    slots = threading.Semaphore(max_rasters_in_flight)
+    lock = threading.Lock()
+    stage_seconds = {}
+    errors = []
+
+    def descendants(stage, task):
+        return [downstream for downstream in task['stages'] if stage_inputs[downstream] == stage]
+
+    def finish(task, n_stages):
+        with lock:
+            task['remaining'] -= n_stages
+            done = task['remaining'] == 0
+        if done:
+            task['results'].clear()
+            slots.release()
+
+    def skip(stage, task):
+        # A failed stage skips everything downstream of it
+        n_skipped = 0
+        for downstream in descendants(stage, task):
+            n_skipped += 1 + skip(downstream, task)
+        return n_skipped
+
+    def run(stage, task, upstream):
+        start_time = time.perf_counter()
+        with span(stage, band=task['plan']['band'], year=task['year']):
+            result = stage_functions[stage](task, upstream)
+        with lock:
+            stage_seconds[stage] = stage_seconds.get(stage, 0) + time.perf_counter() - start_time
+        return result
+
+    def submit(stage, task, upstream):
+        future = executors.get(stage, pool).submit(run, stage, task, upstream)
+        future.add_done_callback(lambda future: done(stage, task, future))
+
+    def done(stage, task, future):
+        try:
+            task['results'][stage] = future.result()
+        except Exception as e:
+            log(f"Stage {stage} failed for {task['plan']['band']} {task['year']}: {e!r}")
+            with lock:
+                errors.append((stage, task['plan']['band'], task['year'], e))
+            finish(task, 1 + skip(stage, task))
+            return
+        for downstream in descendants(stage, task):
+            submit(downstream, task, task['results'][stage])
+        finish(task, 1)
+
+    start_time = time.perf_counter()
+    for task in tasks:
+        slots.acquire()
+        task['remaining'] = 1 + len(task['stages'])
+        submit('read', task, None)
+    # Wait for the last rasters in flight
+    for _ in range(max_rasters_in_flight):
+        slots.acquire()
+    if 'frame_3d' in executors:
+        executors['frame_3d'].submit(close_session).result()
+    pool.shutdown()
+    for executor in executors.values():
+        executor.shutdown()
+
+    elapsed = time.perf_counter() - start_time
+    log(f"Processed {len(tasks)} rasters in {elapsed:.1f} s.")
+    for stage, seconds in sorted(stage_seconds.items(), key=lambda item: -item[1]):
+        log(f"  {stage}: {seconds:.1f} s busy")
+    return errors
+
+# Function to finish the outputs that need every year of a band: cube metadata, animations and statistics
+def finish_band(plan):
+    cube = plan['cube']
+    if cube is not None:
+        if cube['file'] is not None:
+            cube['file'].close()
+        if cube['n_written'] == len(cube['years']):
+            os.replace(cube['path'], f"{cube_prefix(plan)}.bin")
+            (height, width), crs, bounds = cube['grid']
+            vmin, vmax = plan['overlay_limits']
+            tif_to_png.finish_packed_cube(cube_prefix(plan), cube['years'], width, height, crs, bounds, plan['overlay_cmap'], vmin, vmax)
+            record_output(f"{cube_prefix(plan)}.json", cube['inputs'], tif_to_png.overlay_params(plan['overlay_cmap'], vmin, vmax))
+        else:
+            create_gifs.remove_temp_files([cube['path']])
+            log(f"Packed cube of {plan['band']} is incomplete and was not recorded, the previous cube is kept")
+
+    animation = plan['animation']
+    if animation is not None:
+        complete = animation['n_written'] == len(animation['expected'])
+        if animation['gif_file'] is not None:
+            animation['gif_file'].write(b';')  # GIF trailer
+            animation['gif_file'].close()
+        for encoder in animation['encoders'].values():
+            encoder.stdin.close()
+            encoder.wait()
+        for output_format, output_file in animation['files'].items():
+            encoder = animation['encoders'].get(output_format)
+            if not complete or (encoder is not None and encoder.returncode != 0):
+                create_gifs.remove_temp_files([create_gifs.temp_path(output_file)])
+                log(f"{output_format.upper()} for {plan['band']} is incomplete and was not recorded, the previous one is kept")
+                continue
+            os.replace(create_gifs.temp_path(output_file), output_file)
+            record_output(output_file, animation['plot_paths'], create_gifs.animation_params(output_format))
+            log(f"Saved {output_format.upper()} for {plan['band']} to {output_file}")
+
+    create_plots.save_normalized_csv(plan['band'], plan['df'], plan['plot_sources'])
+    save_manifest()
+    save_atlas()
+
+if __name__ == '__main__':
+    start_trace()
+    start_time = time.perf_counter()
+    refresh_catalog()
+    # Every band is read from its cube, GeoTIFFs changed since the last ingest are read directly until ingested
+    if band_store.use_store:
+        band_store.ingest_bands()
+        # The /timeseries endpoint only reads the pixel-major copies, they are rebuilt here when a cube changed
+        for band in timeseries.list_bands():
+            timeseries.update_series(band)
+    plans = [plan_band(band) for band in create_plots.bands]
+    # Rasters are processed band by band, so the 3D stage rarely has to switch plotters
+    tasks = [{'plan': plan, 'year': year, 'stages': stages, 'results': {}}
+             for plan in plans for year, stages in sorted(plan['years'].items()) if stages]
+    errors = run_tasks(tasks)
+    for plan in plans:
+        finish_band(plan)
+    log(f"Pipeline finished in {time.perf_counter() - start_time:.1f} s with {len(errors)} failed stages.")
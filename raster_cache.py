@@ -0,0 +1,57 @@
+import os
+import hashlib
+import numpy as np
+from tracing import span
+
+# Folder where the reprojected arrays are stored as memory-mappable .npy files
+cache_folder = 'C:/Users/nboub/Pictures/Reprojection_Cache'
+
+# Hashes already computed in this run, so each file is only read once for hashing
+_hash_memo = {}
+
+# Function to compute the content hash of a file
+def file_hash(path, chunk_size=1 << 20):
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if memo_key in _hash_memo:
+        return _hash_memo[memo_key]
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    digest = sha.hexdigest()
+    _hash_memo[memo_key] = digest
+    return digest
+
+# Function to describe the DEM grid the data is reprojected onto
+def grid_key(dem_data):
+    sha = hashlib.sha256()
+    sha.update(str(dem_data.rio.crs).encode())
+    sha.update(str(tuple(dem_data.rio.transform())).encode())
+    sha.update(str(dem_data.shape).encode())
+    return sha.hexdigest()[:16]
+
+# Function to build the cache file path for a source file on a given grid
+# The variant separates entries produced with different settings, e.g. the resampling method
+def cache_path(path, dem_data, variant=''):
+    suffix = f"_{variant}" if variant else ''
+    return os.path.join(cache_folder, f"{file_hash(path)[:32]}_{grid_key(dem_data)}{suffix}.npy")
+
+# Function to load a cached reprojected array, returns None on a cache miss
+def load_cached(path, dem_data, variant=''):
+    cached_path = cache_path(path, dem_data, variant)
+    if not os.path.exists(cached_path):
+        return None
+    return np.load(cached_path, mmap_mode='r')
+
+# Function to store a reprojected array and return it memory-mapped from the cache
+def store_cached(path, dem_data, data, variant=''):
+    os.makedirs(cache_folder, exist_ok=True)
+    cached_path = cache_path(path, dem_data, variant)
+    # Write to a temporary file first so an interrupted run never leaves a broken entry
+    tmp_path = f"{cached_path}.{os.getpid()}.tmp"
+    with span('write', path=cached_path, bytes_written=data.nbytes):
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.ascontiguousarray(data))
+        os.replace(tmp_path, cached_path)
+    return np.load(cached_path, mmap_mode='r')
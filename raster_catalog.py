@@ -0,0 +1,179 @@
+import os
+import re
+import json
+import sqlite3
+import numpy as np
+import rasterio
+from raster_cache import file_hash
+from tracing import span, log, file_size
+
+# Location of the catalog and the GeoTIFF folders it indexes
+catalog_path = 'C:/Users/nboub/Pictures/raster_catalog.sqlite'
+catalog_folders = [
+    'C:/Users/nboub/Pictures/Data',
+    'C:/Users/nboub/Pictures/Crete_Temperature',
+    'C:/Users/nboub/Pictures/Crete_total_Precipitation',
+    'C:/Users/nboub/Pictures/Crete_Soil_Moisture',
+    'C:/Users/nboub/Pictures/Crete_Wind_U',
+    'C:/Users/nboub/Pictures/Crete_Surface_Pressure'
+]
+
+# Files are named Crete_{Band}_{year}.tif, with inconsistent casing of the band across scripts
+file_name_pattern = re.compile(r'^Crete_(?P<band>.+)_(?P<year>\d{4})\.tif$', re.IGNORECASE)
+
+# Function to normalize a band name, e.g. 'Total_Precipitation' and 'total_Precipitation'
+def band_key(band):
+    return band.lower()
+
+# Function to open the catalog, creating the table on first use
+def connect_catalog():
+    os.makedirs(os.path.dirname(catalog_path) or '.', exist_ok=True)
+    connection = sqlite3.connect(catalog_path)
+    connection.row_factory = sqlite3.Row
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS rasters (
+            path TEXT PRIMARY KEY,
+            folder TEXT,
+            band TEXT,
+            year INTEGER,
+            sha256 TEXT,
+            size INTEGER,
+            mtime_ns INTEGER,
+            width INTEGER,
+            height INTEGER,
+            crs TEXT,
+            transform TEXT,
+            nodata REAL,
+            min REAL,
+            max REAL,
+            mean REAL,
+            valid_count INTEGER
+        )""")
+    connection.execute("CREATE INDEX IF NOT EXISTS rasters_band ON rasters (band, year)")
+    return connection
+
+# Function to read the metadata and statistics of one raster
+def describe_raster(path):
+    with span('read', path=path, bytes_read=file_size(path)), rasterio.open(path) as src:
+        array = src.read(1).astype(np.float64)
+        if src.nodata is not None:
+            array[array == src.nodata] = np.nan
+        valid_count = int(np.count_nonzero(~np.isnan(array)))
+        return {
+            'width': src.width,
+            'height': src.height,
+            'crs': src.crs.to_wkt() if src.crs else None,
+            'transform': json.dumps(list(src.transform)[:6]),
+            'nodata': src.nodata,
+            'min': float(np.nanmin(array)) if valid_count else None,
+            'max': float(np.nanmax(array)) if valid_count else None,
+            'mean': float(np.nansum(array) / valid_count) if valid_count else None,
+            'valid_count': valid_count
+        }
+
+# Function to bring the catalog up to date, only rereading files whose contents changed
+def refresh_catalog(folders=None):
+    with span('catalog_refresh'):
+        refresh_catalog_folders(catalog_folders if folders is None else folders)
+
+# Function to rescan the given folders into the catalog
+def refresh_catalog_folders(folders):
+    connection = connect_catalog()
+    known = {row['path']: row for row in connection.execute("SELECT path, sha256, size, mtime_ns FROM rasters")}
+    seen = set()
+    n_added = n_updated = 0
+    with connection:
+        for folder in folders:
+            if not os.path.isdir(folder):
+                log(f"Catalog folder not found: {folder}")
+                continue
+            for file_name in sorted(os.listdir(folder)):
+                match = file_name_pattern.match(file_name)
+                if not match:
+                    continue
+                path = os.path.join(folder, file_name).replace('\\', '/')
+                seen.add(path)
+                stat = os.stat(path)
+                row = known.get(path)
+                if row is not None and row['size'] == stat.st_size and row['mtime_ns'] == stat.st_mtime_ns:
+                    continue
+                sha256 = file_hash(path)
+                if row is not None and row['sha256'] == sha256:
+                    # Touched but unchanged: only record the new modification time
+                    connection.execute("UPDATE rasters SET size = ?, mtime_ns = ? WHERE path = ?", (stat.st_size, stat.st_mtime_ns, path))
+                    continue
+                entry = describe_raster(path)
+                entry.update({
+                    'path': path,
+                    'folder': folder.replace('\\', '/'),
+                    'band': band_key(match.group('band')),
+                    'year': int(match.group('year')),
+                    'sha256': sha256,
+                    'size': stat.st_size,
+                    'mtime_ns': stat.st_mtime_ns
+                })
+                columns = ', '.join(entry)
+                placeholders = ', '.join(f':{column}' for column in entry)
+                connection.execute(f"INSERT OR REPLACE INTO rasters ({columns}) VALUES ({placeholders})", entry)
+                if row is None:
+                    n_added += 1
+                else:
+                    n_updated += 1
+
+        # Forget files that disappeared from the scanned folders
+        scanned = {folder.replace('\\', '/') for folder in folders if os.path.isdir(folder)}
+        removed = [path for path, row in known.items() if path not in seen and os.path.dirname(path) in scanned]
+        connection.executemany("DELETE FROM rasters WHERE path = ?", [(path,) for path in removed])
+    connection.close()
+    log(f"Catalog refreshed: {n_added} added, {n_updated} updated, {len(removed)} removed, {len(seen)} files indexed.")
+
+# Function to get the catalog entries of a band, optionally restricted to one folder, sorted by year
+def get_entries(band=None, folder=None):
+    query = "SELECT * FROM rasters WHERE 1 = 1"
+    params = []
+    if band is not None:
+        query += " AND band = ?"
+        params.append(band_key(band))
+    if folder is not None:
+        query += " AND folder = ?"
+        params.append(folder.replace('\\', '/'))
+    connection = connect_catalog()
+    rows = [dict(row) for row in connection.execute(query + " ORDER BY band, year", params)]
+    connection.close()
+    return rows
+
+# Function to get the catalog entry of one file, None if it is not indexed
+def get_entry(path):
+    connection = connect_catalog()
+    row = connection.execute("SELECT * FROM rasters WHERE path = ?", (path.replace('\\', '/'),)).fetchone()
+    connection.close()
+    return dict(row) if row is not None else None
+
+# Function to get the global min, max and mean of a band (or of a folder) over all years
+def get_band_limits(band=None, folder=None):
+    entries = [entry for entry in get_entries(band, folder) if entry['valid_count']]
+    if not entries:
+        return None
+    valid_count = sum(entry['valid_count'] for entry in entries)
+    return {
+        'min': min(entry['min'] for entry in entries),
+        'max': max(entry['max'] for entry in entries),
+        'mean': sum(entry['mean'] * entry['valid_count'] for entry in entries) / valid_count,
+        'valid_count': valid_count
+    }
+
+# Limits already computed, keyed by catalog, band and folder, with the modification time of the catalog they were computed from
+_limits_memo = {}
+
+# Function to get the limits of a band like get_band_limits, queried again only when the catalog file changed
+def cached_band_limits(band=None, folder=None):
+    try:
+        mtime_ns = os.stat(catalog_path).st_mtime_ns
+    except OSError:
+        mtime_ns = None
+    key = (catalog_path, band, folder)
+    memo = _limits_memo.get(key)
+    if memo is None or memo[0] != mtime_ns:
+        memo = (mtime_ns, get_band_limits(band, folder))
+        _limits_memo[key] = memo
+    return memo[1]
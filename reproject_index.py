@@ -0,0 +1,186 @@
+import os
+import hashlib
+import numpy as np
+import rasterio
+from pyproj import CRS, Transformer
+from tracing import span, log, file_size
+from band_store import read_stored
+
+# Folder where the source->DEM pixel mappings are stored
+index_folder = 'C:/Users/nboub/Pictures/Reprojection_Cache/index'
+
+# Number of DEM rows processed at once while building a mapping
+rows_per_chunk = 256
+
+# Mappings already loaded in this run, keyed by source grid, DEM grid and method
+_index_memo = {}
+
+# Mappings restricted to the vertices of a simplified terrain, keyed by mapping and vertex set
+_subset_memo = {}
+
+# Function to describe a raster grid by its CRS, transform and shape
+def grid_signature(crs, transform, shape):
+    sha = hashlib.sha256()
+    sha.update(CRS.from_user_input(crs).to_wkt().encode())
+    sha.update(str(tuple(transform)[:6]).encode())
+    sha.update(str(tuple(shape)).encode())
+    return sha.hexdigest()[:16]
+
+# Function to read the first band of a raster as float32 with nodata set to NaN, from its band cube when it was ingested
+def read_source(path):
+    stored = read_stored(path)
+    if stored is not None:
+        return stored
+    with span('read', path=path, bytes_read=file_size(path)), rasterio.open(path) as src:
+        array = src.read(1).astype(np.float32)
+        if src.nodata is not None:
+            array[array == src.nodata] = np.nan
+        return array, src.crs, src.transform
+
+# Function to compute the source pixel mapping for every DEM pixel
+def build_index(src_crs, src_transform, src_shape, dst_crs, dst_transform, dst_shape, method='nearest'):
+    src_height, src_width = src_shape
+    dst_height, dst_width = dst_shape
+    # Index of the NaN padding value appended to the source, used for pixels outside the source
+    outside = src_height * src_width
+    index_dtype = np.int32 if outside < np.iinfo(np.int32).max else np.int64
+    n_taps = 1 if method == 'nearest' else 4
+    idx = np.empty((n_taps, dst_height * dst_width), dtype=index_dtype)
+    weights = None if method == 'nearest' else np.empty((4, dst_height * dst_width), dtype=np.float32)
+
+    src_crs = CRS.from_user_input(src_crs)
+    dst_crs = CRS.from_user_input(dst_crs)
+    transformer = None if src_crs == dst_crs else Transformer.from_crs(dst_crs, src_crs, always_xy=True)
+    inverse_src = ~src_transform
+    cols = np.arange(dst_width) + 0.5
+
+    for row_start in range(0, dst_height, rows_per_chunk):
+        row_stop = min(row_start + rows_per_chunk, dst_height)
+        c, r = np.meshgrid(cols, np.arange(row_start, row_stop) + 0.5)
+        # DEM pixel centres in the DEM CRS, then in the source CRS
+        x = dst_transform.a * c + dst_transform.b * r + dst_transform.c
+        y = dst_transform.d * c + dst_transform.e * r + dst_transform.f
+        if transformer is not None:
+            x, y = transformer.transform(x, y)
+        # Fractional source pixel coordinates
+        col_f = inverse_src.a * x + inverse_src.b * y + inverse_src.c
+        row_f = inverse_src.d * x + inverse_src.e * y + inverse_src.f
+        inside = (col_f >= 0) & (col_f < src_width) & (row_f >= 0) & (row_f < src_height)
+        out = slice(row_start * dst_width, row_stop * dst_width)
+
+        if method == 'nearest':
+            flat = np.floor(row_f).astype(np.int64) * src_width + np.floor(col_f).astype(np.int64)
+            idx[0, out] = np.where(inside, flat, outside).ravel()
+        else:
+            # Bilinear taps between the four surrounding source pixel centres, clamped at the edges
+            col_f = np.clip(col_f - 0.5, 0, src_width - 1)
+            row_f = np.clip(row_f - 0.5, 0, src_height - 1)
+            c0 = np.minimum(np.floor(col_f).astype(np.int64), src_width - 2 if src_width > 1 else 0)
+            r0 = np.minimum(np.floor(row_f).astype(np.int64), src_height - 2 if src_height > 1 else 0)
+            c1 = np.minimum(c0 + 1, src_width - 1)
+            r1 = np.minimum(r0 + 1, src_height - 1)
+            fx = (col_f - c0).astype(np.float32)
+            fy = (row_f - r0).astype(np.float32)
+            taps = [(r0, c0, (1 - fx) * (1 - fy)), (r0, c1, fx * (1 - fy)),
+                    (r1, c0, (1 - fx) * fy), (r1, c1, fx * fy)]
+            for k, (tr, tc, tw) in enumerate(taps):
+                idx[k, out] = np.where(inside, tr * src_width + tc, outside).ravel()
+                weights[k, out] = tw.ravel()
+
+    return {'method': method, 'shape': tuple(dst_shape), 'idx': idx, 'weights': weights}
+
+# Function to get the mapping for a source grid, from memory, disk or by building it
+def get_index(src_crs, src_transform, src_shape, dst_crs, dst_transform, dst_shape, method='nearest'):
+    key = (f"{grid_signature(src_crs, src_transform, src_shape)}_"
+           f"{grid_signature(dst_crs, dst_transform, dst_shape)}_{method}")
+    if key in _index_memo:
+        return _index_memo[key]
+
+    idx_path = os.path.join(index_folder, f"{key}_idx.npy")
+    weights_path = os.path.join(index_folder, f"{key}_weights.npy")
+    if os.path.exists(idx_path) and (method == 'nearest' or os.path.exists(weights_path)):
+        log(f"Loading reprojection index {key}...")
+        index = {
+            'method': method,
+            'shape': tuple(dst_shape),
+            'idx': np.load(idx_path, mmap_mode='r'),
+            'weights': None if method == 'nearest' else np.load(weights_path, mmap_mode='r')
+        }
+    else:
+        log(f"Building reprojection index {key}...")
+        with span('build_index', method=method, pixels=int(np.prod(dst_shape))):
+            index = build_index(src_crs, src_transform, src_shape, dst_crs, dst_transform, dst_shape, method)
+        with span('write', path=idx_path) as args:
+            os.makedirs(index_folder, exist_ok=True)
+            np.save(idx_path, index['idx'])
+            if index['weights'] is not None:
+                np.save(weights_path, index['weights'])
+            args['bytes_written'] = file_size(idx_path) + file_size(weights_path)
+        log(f"Reprojection index {key} saved to {index_folder}.")
+
+    _index_memo[key] = index
+    return index
+
+# Function to resample a source array, or a stack of them, with a precomputed mapping
+def apply_index(index, data):
+    with span('reproject', method=index['method'], rasters=int(np.prod(data.shape[:-2])), pixels=int(np.prod(index['shape']))):
+        return gather_index(index, data)
+
+# Function to gather the resampled values of a mapping
+def gather_index(index, data):
+    leading = data.shape[:-2]
+    flat = data.reshape(leading + (-1,))
+    # Append one NaN column so pixels outside the source gather NaN in the same take
+    padded = np.concatenate([flat, np.full(leading + (1,), np.nan, dtype=flat.dtype)], axis=-1)
+    if index['method'] == 'nearest':
+        out = np.take(padded, index['idx'][0], axis=-1)
+    else:
+        out = np.take(padded, index['idx'][0], axis=-1) * index['weights'][0]
+        for k in range(1, 4):
+            out += np.take(padded, index['idx'][k], axis=-1) * index['weights'][k]
+    return out.reshape(leading + index['shape'])
+
+# Function to restrict a mapping to some DEM pixels, e.g. the vertices of a simplified terrain, given as flat indices
+def subset_index(index, vertices):
+    key = (id(index), hashlib.sha1(np.ascontiguousarray(vertices)).hexdigest())
+    if key not in _subset_memo:
+        _subset_memo[key] = {
+            'method': index['method'],
+            'shape': (len(vertices),),
+            'idx': np.ascontiguousarray(index['idx'][:, vertices]),
+            'weights': None if index['weights'] is None else np.ascontiguousarray(index['weights'][:, vertices])
+        }
+    return _subset_memo[key]
+
+# Function to resample an array already in memory onto the DEM grid, or only onto the given DEM pixels
+def resample_array(array, crs, transform, dem_data, method='nearest', vertices=None):
+    index = get_index(crs, transform, array.shape, dem_data.rio.crs, dem_data.rio.transform(), dem_data.shape, method)
+    if vertices is not None:
+        index = subset_index(index, vertices)
+    return apply_index(index, array)
+
+# Function to resample one file onto the DEM grid
+def resample_file(path, dem_data, method='nearest', vertices=None):
+    array, crs, transform = read_source(path)
+    return resample_array(array, crs, transform, dem_data, method, vertices)
+
+# Function to resample many files onto the DEM grid with one batched gather per source grid
+def resample_files(paths, dem_data, method='nearest', batch_size=8, vertices=None):
+    groups = {}
+    for path in paths:
+        with rasterio.open(path) as src:
+            key = grid_signature(src.crs, src.transform, src.shape)
+        groups.setdefault(key, []).append(path)
+
+    for group_paths in groups.values():
+        for start in range(0, len(group_paths), batch_size):
+            batch_paths = group_paths[start:start + batch_size]
+            sources = [read_source(path) for path in batch_paths]
+            array, crs, transform = sources[0]
+            index = get_index(crs, transform, array.shape, dem_data.rio.crs, dem_data.rio.transform(), dem_data.shape, method)
+            if vertices is not None:
+                index = subset_index(index, vertices)
+            stack = np.stack([source[0] for source in sources])
+            resampled = apply_index(index, stack)
+            for path, data in zip(batch_paths, resampled):
+                yield path, data
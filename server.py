@@ -1,15 +1,496 @@
+import io
+import os
+import json
+import math
+import hashlib
+import threading
+import email.utils
 import http.server
 import socketserver
+from collections import OrderedDict
+from urllib.parse import urlsplit, parse_qs
+import numpy as np
+import rasterio
+import matplotlib
+from PIL import Image
+from rasterio.enums import Resampling
+from fast_render import build_lut, quantize, save_indexed_png
+from raster_catalog import cached_band_limits
+from band_store import find_stored
+from timeseries import point_series, box_mean
+from legend_atlas import band_legends, band_range, band_legend, save_atlas, legend_heights
 
 PORT = 8000
 DIRECTORY = "C:/Users/nboub/Pictures/Data1"
 
+# GeoTIFFs colormapped on request by /render/{band}/{year}.png
+RASTER_DIRECTORY = "C:/Users/nboub/Pictures/Data"
+
+# Default color maps of the rendered overlays, the same as tif_to_png.py
+color_maps = {
+    'Temperature_2m': 'hot',
+    'Total_Precipitation': 'Blues',
+    'Soil_Moisture': 'Greens',
+    'Surface_Pressure': 'Oranges',
+    'Wind_U': 'Purples'
+}
+
+# Threaded server with an in-memory cache, validators and ranges instead of the single-threaded TCPServer
+production_mode = True
+
+# Byte budget of the in-memory file cache, larger files are streamed from disk
+cache_budget_bytes = 256 * 1024 * 1024
+max_cached_file_size = 16 * 1024 * 1024
+
+# How long browsers may reuse a response before revalidating it
+cache_max_age = 3600
+
+# Precompressed variants served when the client accepts them, e.g. overlay.png.br next to overlay.png
+precompressed_extensions = {'br': '.br', 'gzip': '.gz'}
+
+# Thread-safe least-recently-used cache bounded by the total size of its values
+class LRUCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.entries:
+                self.n_bytes -= len(self.entries.pop(key))
+            self.entries[key] = value
+            self.n_bytes += len(value)
+            while self.n_bytes > self.max_bytes and self.entries:
+                _, evicted = self.entries.popitem(last=False)
+                self.n_bytes -= len(evicted)
+
+file_cache = LRUCache(cache_budget_bytes)
+
+# Byte budget of the rendered overlays and the largest output size a request may ask for
+render_cache = LRUCache(64 * 1024 * 1024)
+max_render_size = 4096
+
+# Height of the colorbars served by /legend/{band}.png when the request gives none, one of legend_atlas.legend_heights
+legend_height = 600
+
+# Renders in progress, so concurrent requests for the same key share one render
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+# Function to read a raster at the requested size, from its band cube when it was ingested, and colormap it into a palette PNG
+def render_overlay(tif_path, mtime_ns, cmap, vmin, vmax, width, height):
+    cube, year = find_stored(tif_path)
+    if cube is not None:
+        array = read_stored_overlay(cube, year, width, height)
+    else:
+        array = read_overlay(tif_path, width, height)
+    vmin = np.nanmin(array) if vmin is None else vmin
+    vmax = np.nanmax(array) if vmax is None else vmax
+    buffer = io.BytesIO()
+    save_indexed_png(quantize(array, vmin, vmax), build_lut(cmap), buffer)
+    return buffer.getvalue()
+
+# Function to read a GeoTIFF at the requested size, a missing dimension keeps the aspect ratio
+def read_overlay(tif_path, width, height):
+    with rasterio.open(tif_path) as src:
+        if width is None and height is None:
+            out_shape = src.shape
+        else:
+            # A missing dimension keeps the aspect ratio of the raster
+            height = height or max(1, round(width * src.height / src.width))
+            width = width or max(1, round(height * src.width / src.height))
+            out_shape = (height, width)
+        array = src.read(1, out_shape=out_shape, resampling=Resampling.nearest).astype(np.float32)
+        if src.nodata is not None:
+            array[array == src.nodata] = np.nan
+    return array
+
+# Function to read a year from its band cube at the requested size
+# The smallest overview still at least that size is read, then sampled to the exact size
+def read_stored_overlay(cube, year, width, height):
+    _, full_height, full_width = cube.shape
+    if width is None and height is None:
+        return cube.read_year(year)
+    height = height or max(1, round(width * full_height / full_width))
+    width = width or max(1, round(height * full_width / full_height))
+    array = cube.read_year(year, level=cube.level_for(height, width))
+    rows = ((np.arange(height) + 0.5) * array.shape[0] / height).astype(np.int64)
+    cols = ((np.arange(width) + 0.5) * array.shape[1] / width).astype(np.int64)
+    return array[rows[:, None], cols]
+
+# Function to get a rendered overlay from the cache, joining a render of the same key already in progress
+def get_rendered_overlay(key):
+    body = render_cache.get(key)
+    if body is not None:
+        return body
+    with _inflight_lock:
+        body = render_cache.get(key)
+        if body is not None:
+            return body
+        flight = _inflight.get(key)
+        owner = flight is None
+        if owner:
+            flight = {'done': threading.Event(), 'body': None, 'error': None}
+            _inflight[key] = flight
+    if not owner:
+        flight['done'].wait()
+        if flight['error'] is not None:
+            raise flight['error']
+        return flight['body']
+    try:
+        flight['body'] = render_overlay(*key)
+        render_cache.put(key, flight['body'])
+        return flight['body']
+    except Exception as e:
+        flight['error'] = e
+        raise
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
+        flight['done'].set()
+
 class MyHttpRequestHandler(http.server.SimpleHTTPRequestHandler):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, directory=DIRECTORY, **kwargs)
 
-handler_object = MyHttpRequestHandler
+class CachingHttpRequestHandler(MyHttpRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep connections alive between slider steps
+
+    def do_GET(self):
+        if self.path.startswith('/render/'):
+            self.serve_render(head_only=False)
+        elif self.path.startswith('/legend/'):
+            self.serve_legend(head_only=False)
+        elif urlsplit(self.path).path == '/timeseries':
+            self.serve_timeseries(head_only=False)
+        else:
+            self.serve_file(head_only=False)
+
+    def do_HEAD(self):
+        if self.path.startswith('/render/'):
+            self.serve_render(head_only=True)
+        elif self.path.startswith('/legend/'):
+            self.serve_legend(head_only=True)
+        elif urlsplit(self.path).path == '/timeseries':
+            self.serve_timeseries(head_only=True)
+        else:
+            self.serve_file(head_only=True)
+
+    # Parse /render/{band}/{year}.png?cmap=&vmin=&vmax=&width=&height= into a render cache key
+    def parse_render_request(self):
+        url = urlsplit(self.path)
+        parts = url.path.split('/')
+        if len(parts) != 4 or not parts[3].endswith('.png'):
+            raise ValueError("Expected /render/{band}/{year}.png")
+        band, year = parts[2], parts[3][:-len('.png')]
+        if band not in color_maps or not year.isdigit():
+            raise ValueError(f"Unknown band or year: {band} {year}")
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        cmap = query.get('cmap', color_maps[band])
+        if cmap not in matplotlib.colormaps:
+            raise ValueError(f"Unknown colormap: {cmap}")
+        vmin = float(query['vmin']) if 'vmin' in query else None
+        vmax = float(query['vmax']) if 'vmax' in query else None
+        if vmin is None or vmax is None:
+            # Default to the band's global limits from the raster catalog, so years are comparable
+            # Memoized per catalog change, so 304 and render cache hits do not query the catalog
+            limits = cached_band_limits(band, folder=RASTER_DIRECTORY)
+            if limits is not None:
+                vmin = limits['min'] if vmin is None else vmin
+                vmax = limits['max'] if vmax is None else vmax
+        # A limit still missing means the raster is normalized by its own range
+        for limit in (vmin, vmax):
+            if limit is not None and not math.isfinite(limit):
+                raise ValueError("vmin and vmax must be finite")
+        if vmin is not None and vmax is not None and vmin >= vmax:
+            raise ValueError("vmin must be below vmax")
+        width = int(query['width']) if 'width' in query else None
+        height = int(query['height']) if 'height' in query else None
+        for size in (width, height):
+            if size is not None and not 0 < size <= max_render_size:
+                raise ValueError(f"Output size must be between 1 and {max_render_size}")
+        tif_path = os.path.join(RASTER_DIRECTORY, f"Crete_{band}_{year}.tif")
+        # The modification time is part of the key, so a regenerated GeoTIFF is rendered again
+        mtime_ns = os.stat(tif_path).st_mtime_ns
+        return (tif_path, mtime_ns, cmap, vmin, vmax, width, height)
+
+    def serve_render(self, head_only):
+        try:
+            key = self.parse_render_request()
+        except FileNotFoundError:
+            self.send_error(404, "Raster not found")
+            return
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+
+        etag = f'"{hashlib.sha1(repr(key).encode()).hexdigest()}"'
+        if self.not_modified(etag, key[1] / 1e9):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        try:
+            body = get_rendered_overlay(key)
+        except Exception as e:
+            self.send_error(500, f"Render failed: {e}")
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', f'public, max-age={cache_max_age}')
+        self.end_headers()
+        if not head_only:
+            self.wfile.write(body)
+
+    # Pick a precompressed variant of the file if the client accepts its encoding and it is at least as new as the file
+    def choose_variant(self, path):
+        accepted = [token.split(';')[0].strip() for token in self.headers.get('Accept-Encoding', '').split(',')]
+        for encoding, extension in precompressed_extensions.items():
+            if encoding not in accepted:
+                continue
+            try:
+                if os.stat(path + extension).st_mtime_ns >= os.stat(path).st_mtime_ns:
+                    return encoding, path + extension
+            except OSError:
+                continue
+        return None, path
+
+    # Read an open file through the in-memory cache, keyed by path, modification time and size from its fstat
+    # A file rewritten while it was being read is served as read but not cached
+    def read_cached(self, f, file_path, stat):
+        key = (file_path, stat.st_mtime_ns, stat.st_size)
+        body = file_cache.get(key)
+        if body is None:
+            body = f.read()
+            after = os.fstat(f.fileno())
+            if len(body) == stat.st_size and (after.st_mtime_ns, after.st_size) == (stat.st_mtime_ns, stat.st_size):
+                file_cache.put(key, body)
+        return body
+
+    # Check If-None-Match / If-Modified-Since against the current validators
+    def not_modified(self, etag, mtime):
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            return if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since is not None:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return int(mtime) <= since
+        return False
+
+    # Parse a single "bytes=start-end" range, returns None for a full response and False if unsatisfiable
+    def parse_range(self, size, etag):
+        range_header = self.headers.get('Range')
+        if range_header is None or not range_header.startswith('bytes=') or ',' in range_header:
+            return None
+        if_range = self.headers.get('If-Range')
+        if if_range is not None and if_range.strip() != etag:
+            return None
+        start_text, _, end_text = range_header[len('bytes='):].strip().partition('-')
+        try:
+            if start_text == '':
+                length = int(end_text)
+                if length <= 0:
+                    return False
+                start, end = max(size - length, 0), size - 1
+            else:
+                start = int(start_text)
+                end = int(end_text) if end_text else size - 1
+        except ValueError:
+            return None
+        if start >= size or end < start:
+            return False
+        return start, min(end, size - 1)
+
+    def serve_file(self, head_only):
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            # Directory listings and redirects are left to SimpleHTTPRequestHandler
+            return super().do_HEAD() if head_only else super().do_GET()
+        encoding, file_path = self.choose_variant(path)
+        try:
+            f = open(file_path, 'rb')
+        except OSError:
+            self.send_error(404, "File not found")
+            return
+        # The headers, cache key and body all come from the open file, so a file rewritten meanwhile cannot mix them up
+        with f:
+            stat = os.fstat(f.fileno())
+            etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}{"-" + encoding if encoding else ""}"'
+            common_headers = {
+                'ETag': etag,
+                'Last-Modified': self.date_time_string(stat.st_mtime),
+                'Cache-Control': f'public, max-age={cache_max_age}',
+                'Accept-Ranges': 'bytes',
+                'Vary': 'Accept-Encoding',
+                'Access-Control-Allow-Origin': '*'  # The map may fetch packed cubes from a file:// page
+            }
+            if self.not_modified(etag, stat.st_mtime):
+                self.send_response(304)
+                for name, value in common_headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                return
+
+            # Small files are read before the headers are sent, so Content-Length is the length of the bytes sent
+            body = None
+            if not head_only and stat.st_size <= max_cached_file_size:
+                body = self.read_cached(f, file_path, stat)
+            size = len(body) if body is not None else stat.st_size
+            byte_range = self.parse_range(size, etag)
+            if byte_range is False:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            start, end = byte_range if byte_range else (0, size - 1)
+
+            self.send_response(206 if byte_range else 200)
+            self.send_header('Content-Type', self.guess_type(path))
+            self.send_header('Content-Length', str(end - start + 1))
+            if encoding:
+                self.send_header('Content-Encoding', encoding)
+            if byte_range:
+                self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+            for name, value in common_headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            if head_only or size == 0:
+                return
+
+            if body is not None:
+                self.wfile.write(body[start:end + 1])
+                return
+            # Large files are streamed from disk in chunks
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(remaining, 1 << 20))
+                if not chunk:
+                    # Truncated while streaming, the client must not wait for the missing bytes
+                    self.close_connection = True
+                    break
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+    # Parse /legend/{band}.png?height= into a legend cache key, the range is the band's global data limits
+    def parse_legend_request(self):
+        url = urlsplit(self.path)
+        parts = url.path.split('/')
+        if len(parts) != 3 or not parts[2].endswith('.png') or parts[2][:-len('.png')] not in band_legends:
+            raise ValueError("Expected /legend/{band}.png")
+        band = parts[2][:-len('.png')]
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        height = int(query.get('height', legend_height))
+        # Only the preset sizes of the atlas, so clients cannot make it grow
+        if height not in legend_heights:
+            raise ValueError(f"Height must be one of {', '.join(str(size) for size in legend_heights)}")
+        return ('legend', band, height) + tuple(band_range(band, RASTER_DIRECTORY))
+
+    # Serve a colorbar cut out of the legend atlas, a band whose range changed is rendered once and replaces its old legend
+    def serve_legend(self, head_only):
+        try:
+            key = self.parse_legend_request()
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        etag = f'"{hashlib.sha1(repr(key).encode()).hexdigest()}"'
+        # Only the ETag validates a legend, it holds the band's range
+        if self.headers.get('If-None-Match') is not None and self.not_modified(etag, 0):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        body = render_cache.get(key)
+        if body is None:
+            buffer = io.BytesIO()
+            Image.fromarray(band_legend(key[1], key[2], RASTER_DIRECTORY), 'RGBA').save(buffer, format='PNG')
+            save_atlas()
+            body = buffer.getvalue()
+            render_cache.put(key, body)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', f'public, max-age={cache_max_age}')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        if not head_only:
+            self.wfile.write(body)
+
+    # Parse /timeseries?lat=&lon= or /timeseries?bbox=west,south,east,north, optionally with &bands=a,b
+    def parse_timeseries_request(self):
+        query = {name: values[-1] for name, values in parse_qs(urlsplit(self.path).query).items()}
+        bands = [band.lower() for band in query['bands'].split(',')] if query.get('bands') else None
+        if 'bbox' in query:
+            bbox = [float(value) for value in query['bbox'].split(',')]
+            if len(bbox) != 4 or not all(math.isfinite(value) for value in bbox) or bbox[0] >= bbox[2] or bbox[1] >= bbox[3]:
+                raise ValueError("Expected bbox=west,south,east,north")
+            return 'bbox', bbox, bands
+        if 'lat' in query and 'lon' in query:
+            lat, lon = float(query['lat']), float(query['lon'])
+            if not (math.isfinite(lat) and math.isfinite(lon)):
+                raise ValueError("lat and lon must be finite")
+            return 'point', (lat, lon), bands
+        raise ValueError("Expected lat and lon, or bbox")
+
+    # Answer /timeseries?lat=&lon= with every year of every band at a point,
+    # or /timeseries?bbox=west,south,east,north with the mean of every year over a box
+    # The pixel-major copies are built offline by timeseries.py or pipeline.py, a band without one gives 503
+    def serve_timeseries(self, head_only):
+        try:
+            kind, where, bands = self.parse_timeseries_request()
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        # HEAD runs the lookup too, it only reads the memory-mapped copies, so it answers like GET
+        try:
+            result = box_mean(where, bands) if kind == 'bbox' else point_series(*where, bands)
+        except Exception as e:
+            self.send_error(500, f"Query failed: {e}")
+            return
+        if not result['bands']:
+            if result['stale']:
+                self.send_error(503, f"Time series of {', '.join(result['stale'])} not built yet, run timeseries.py")
+            else:
+                self.send_error(404, "No band has data there")
+            return
+
+        body = json.dumps(result).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', f'public, max-age={cache_max_age}')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        if not head_only:
+            self.wfile.write(body)
+
+if __name__ == '__main__':
+    if production_mode:
+        with http.server.ThreadingHTTPServer(("", PORT), CachingHttpRequestHandler) as httpd:
+            print(f"Serving at port {PORT} (threaded, {cache_budget_bytes // (1024 * 1024)} MB cache)")
+            httpd.serve_forever()
+    else:
+        handler_object = MyHttpRequestHandler
 
-with socketserver.TCPServer(("", PORT), handler_object) as httpd:
-    print(f"Serving at port {PORT}")
-    httpd.serve_forever()
+        with socketserver.TCPServer(("", PORT), handler_object) as httpd:
+            print(f"Serving at port {PORT}")
+            httpd.serve_forever()
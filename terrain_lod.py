@@ -0,0 +1,173 @@
+import numpy as np
+from tracing import span, log
+
+# Number of DEM rows processed at once while measuring block errors
+rows_per_chunk = 256
+
+# Number of bisection steps used to find the error tolerance that fits the triangle budget
+tolerance_steps = 24
+
+# Function to pick the size of the top quadtree blocks, small enough that padding the DEM to whole blocks stays cheap
+def top_block_size(shape):
+    height, width = shape
+    size = 2
+    while size * 2 <= max(2, min(height - 1, width - 1) // 4):
+        size *= 2
+    return size
+
+# Function to measure every quadtree block of every size: the largest deviation of the DEM from the bilinear patch through the block corners
+def quadtree_errors(elevation, top_size):
+    height, width = elevation.shape
+    n_rows = -(-(height - 1) // top_size)
+    n_cols = -(-(width - 1) // top_size)
+    padded = np.pad(elevation, ((0, n_rows * top_size + 1 - height), (0, n_cols * top_size + 1 - width)), mode='edge')
+    errors = {}
+    size = 2
+    while size <= top_size:
+        block_rows = (padded.shape[0] - 1) // size
+        block_cols = (padded.shape[1] - 1) // size
+        fraction = np.arange(size, dtype=np.float32) / size
+        fy = fraction[None, :, None, None]
+        fx = fraction[None, None, None, :]
+        error = np.empty((block_rows, block_cols), dtype=np.float32)
+        chunk = max(1, rows_per_chunk // size)
+        for row_start in range(0, block_rows, chunk):
+            row_stop = min(row_start + chunk, block_rows)
+            window = padded[row_start * size:row_stop * size + 1]
+            corners = window[::size, ::size]
+            top = corners[:-1, None, :-1, None] * (1 - fx) + corners[:-1, None, 1:, None] * fx
+            bottom = corners[1:, None, :-1, None] * (1 - fx) + corners[1:, None, 1:, None] * fx
+            blocks = window[:-1, :-1].reshape(row_stop - row_start, size, block_cols, size)
+            error[row_start:row_stop] = np.abs(blocks - (top * (1 - fy) + bottom * fy)).max(axis=(1, 3))
+        errors[size] = error
+        size *= 2
+    return errors
+
+# Function to split the quadtree top-down until every leaf is within the tolerance
+# Returns the pixel bounds of the leaves, clipped to the DEM, or None as soon as there would be more than max_leaves
+def select_leaves(errors, top_size, shape, tolerance, max_leaves=None):
+    height, width = shape
+    n_rows, n_cols = errors[top_size].shape
+    i, j = np.divmod(np.arange(n_rows * n_cols), n_cols)
+    size = top_size
+    leaves = []
+    n_leaves = 0
+    while size > 1:
+        split = errors[size][i, j] > tolerance
+        leaves.append((i[~split] * size, j[~split] * size, np.full(np.count_nonzero(~split), size)))
+        n_leaves += len(leaves[-1][0])
+        # Every block still to split ends up as at least one leaf
+        if max_leaves is not None and n_leaves + np.count_nonzero(split) > max_leaves:
+            return None
+        i = (2 * i[split, None] + np.array([0, 0, 1, 1])).ravel()
+        j = (2 * j[split, None] + np.array([0, 1, 0, 1])).ravel()
+        size //= 2
+        # Children lying entirely in the padding are dropped
+        inside = (i * size < height - 1) & (j * size < width - 1)
+        i, j = i[inside], j[inside]
+    leaves.append((i, j, np.ones(len(i), dtype=np.int64)))
+    r0 = np.concatenate([leaf[0] for leaf in leaves])
+    c0 = np.concatenate([leaf[1] for leaf in leaves])
+    sizes = np.concatenate([leaf[2] for leaf in leaves])
+    return r0, c0, np.minimum(r0 + sizes, height - 1), np.minimum(c0 + sizes, width - 1)
+
+# Function to find the vertices on the boundary of every leaf, walking it clockwise from the top-left corner
+# Vertices are flat DEM pixel indices, ring_lengths gives how many belong to each leaf
+def leaf_rings(r0, c0, r1, c1, shape, with_ring=True):
+    height, width = shape
+    row_major = np.unique(np.concatenate([r0 * width + c0, r0 * width + c1, r1 * width + c0, r1 * width + c1]))
+    col_major = np.sort((row_major % width) * height + row_major // width)
+
+    # Top edge left to right, right edge downwards, bottom edge right to left, left edge upwards, each without its last corner
+    bounds = [
+        (np.searchsorted(row_major, r0 * width + c0), np.searchsorted(row_major, r0 * width + c1)),
+        (np.searchsorted(col_major, c1 * height + r0), np.searchsorted(col_major, c1 * height + r1)),
+        (np.searchsorted(row_major, r1 * width + c0, 'right'), np.searchsorted(row_major, r1 * width + c1, 'right')),
+        (np.searchsorted(col_major, c0 * height + r0, 'right'), np.searchsorted(col_major, c0 * height + r1, 'right'))
+    ]
+    counts = np.stack([stop - start for start, stop in bounds], axis=1)
+    ring_lengths = counts.sum(axis=1)
+    if not with_ring:
+        return None, ring_lengths
+
+    starts = np.stack([start for start, _ in bounds], axis=1).ravel()
+    counts = counts.ravel()
+    reverse = np.tile([False, False, True, True], len(r0))
+    use_columns = np.tile([False, True, False, True], len(r0))
+    segment = np.repeat(np.arange(len(counts)), counts)
+    offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    position = np.where(reverse[segment], starts[segment] + counts[segment] - 1 - offset, starts[segment] + offset)
+    from_rows = row_major[np.minimum(position, len(row_major) - 1)]
+    from_columns = col_major[np.minimum(position, len(col_major) - 1)]
+    ring = np.where(use_columns[segment], (from_columns % height) * width + from_columns // height, from_rows)
+    return ring, ring_lengths
+
+# Function to count the triangles triangulate_leaves would make
+def count_triangles(ring_lengths):
+    return int(np.where(ring_lengths == 4, 2, ring_lengths).sum())
+
+# Function to triangulate the leaves without cracks
+# A leaf with only its corners becomes two triangles, any other leaf a fan around its centre through every vertex on its edges,
+# so neighbouring leaves of different sizes share the vertices along their common edge
+def triangulate_leaves(r0, c0, r1, c1, shape):
+    height, width = shape
+    ring, ring_lengths = leaf_rings(r0, c0, r1, c1, shape)
+    ring_starts = np.cumsum(ring_lengths) - ring_lengths
+
+    quads = ring_starts[ring_lengths == 4]
+    # Rings run clockwise seen from above, triangles are wound the other way so their normals point up
+    quad_triangles = np.concatenate([
+        np.stack([ring[quads], ring[quads + 2], ring[quads + 1]], axis=1),
+        np.stack([ring[quads], ring[quads + 3], ring[quads + 2]], axis=1)
+    ])
+
+    fans = np.flatnonzero(ring_lengths > 4)
+    # Leaves one pixel thin at the clipped DEM border have no interior centre, their fan starts at a corner instead
+    has_centre = (r1[fans] - r0[fans] >= 2) & (c1[fans] - c0[fans] >= 2)
+    centres = ((r0[fans] + r1[fans]) // 2) * width + (c0[fans] + c1[fans]) // 2
+    apex = np.where(has_centre, centres, ring[ring_starts[fans]])
+    lengths = ring_lengths[fans]
+    fan = np.repeat(np.arange(len(fans)), lengths)
+    m = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    b = ring[ring_starts[fans][fan] + m]
+    c = ring[ring_starts[fans][fan] + (m + 1) % lengths[fan]]
+    a = apex[fan]
+    # Fans around a corner apex also sweep the edges through that corner, whose triangles lie on one row or column
+    rows, cols = np.stack([a, b, c]) // width, np.stack([a, b, c]) % width
+    collinear = ((rows[0] == rows[1]) & (rows[1] == rows[2])) | ((cols[0] == cols[1]) & (cols[1] == cols[2]))
+    keep = (b != a) & (c != a) & ~collinear
+    fan_triangles = np.stack([a[keep], c[keep], b[keep]], axis=1)
+
+    vertices = np.unique(np.concatenate([ring, centres[has_centre]]))
+    faces = np.searchsorted(vertices, np.concatenate([quad_triangles, fan_triangles]))
+    return vertices, faces
+
+# Function to simplify a DEM to about triangle_budget triangles
+# The error tolerance is bisected so flat land and sea stay coarse while the budget goes to the relief
+def simplify_terrain(elevation, triangle_budget):
+    with span('simplify_terrain', pixels=elevation.size, triangle_budget=triangle_budget):
+        return simplify_terrain_leaves(elevation, triangle_budget)
+
+# Function to find the tolerance fitting the budget and triangulate the leaves it selects
+def simplify_terrain_leaves(elevation, triangle_budget):
+    shape = elevation.shape
+    top_size = top_block_size(shape)
+    errors = quadtree_errors(elevation, top_size)
+
+    # Every leaf makes at least two triangles, so candidates with more leaves than half the budget are rejected early
+    max_leaves = triangle_budget // 2
+    if 2 * (shape[0] - 1) * (shape[1] - 1) <= triangle_budget:
+        tolerance = -1.0  # The full resolution DEM fits the budget
+    else:
+        low, high = 0.0, float(max(error.max() for error in errors.values()))
+        for _ in range(tolerance_steps):
+            tolerance = (low + high) / 2
+            leaves = select_leaves(errors, top_size, shape, tolerance, max_leaves)
+            if leaves is None or count_triangles(leaf_rings(*leaves, shape, with_ring=False)[1]) > triangle_budget:
+                low = tolerance
+            else:
+                high = tolerance
+        tolerance = high
+    vertices, faces = triangulate_leaves(*select_leaves(errors, top_size, shape, tolerance), shape)
+    log(f"Terrain simplified to {len(vertices)} vertices and {len(faces)} triangles (max error {max(tolerance, 0):.2f}).")
+    return vertices, faces
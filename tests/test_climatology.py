@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+from climatology import incomplete_beta, t_test_p_value, block_statistics, percentiles
+
+# Two-sided p-values of Student's t distribution from published tables: (t, degrees of freedom, p)
+published_p_values = [
+    (2.0, 10, 0.073388),
+    (1.0, 30, 0.325309),
+    (5.0, 3, 0.015392)
+]
+
+# Function to make a (years, rows, cols) block with a trend, noise and missing years, some pixels with too few years
+def make_block(seed=0):
+    rng = np.random.default_rng(seed)
+    years = list(range(1990, 2021))
+    trend = rng.normal(0, 0.05, (6, 7))
+    block = 280 + trend * (np.array(years) - 2005)[:, None, None] + rng.normal(0, 1, (len(years), 6, 7))
+    block[rng.random(block.shape) < 0.2] = np.nan
+    block[:, 0, 0] = np.nan  # No valid year
+    block[1:, 0, 1] = np.nan  # One valid year
+    block[2:, 0, 2] = np.nan  # Two valid years, no degree of freedom left for the trend
+    return block.astype(np.float32), years
+
+def test_t_test_p_value_matches_published_values():
+    t = np.array([case[0] for case in published_p_values])
+    df = np.array([case[1] for case in published_p_values], dtype=np.float64)
+    expected = np.array([case[2] for case in published_p_values])
+    np.testing.assert_allclose(t_test_p_value(t, df), expected, rtol=1e-4)
+
+def test_t_test_p_value_is_symmetric_and_bounded():
+    t = np.array([-3.0, -0.5, 0.0, 0.5, 3.0, np.inf])
+    p = t_test_p_value(t, np.full(t.shape, 12.0))
+    np.testing.assert_allclose(p[:2], p[[4, 3]])
+    assert p[2] == pytest.approx(1.0)
+    assert p[5] == 0.0
+
+def test_incomplete_beta_edges_and_symmetry():
+    x = np.linspace(0, 1, 11)
+    np.testing.assert_allclose(incomplete_beta(1.0, 1.0, x), x, atol=1e-12)
+    np.testing.assert_allclose(incomplete_beta(2.5, 4.0, x), 1 - incomplete_beta(4.0, 2.5, 1 - x), atol=1e-12)
+    # I_x(a, 1) = x^a
+    np.testing.assert_allclose(incomplete_beta(3.0, 1.0, x), x ** 3, atol=1e-12)
+
+def test_block_statistics_matches_numpy():
+    block, years = make_block()
+    stats = block_statistics(block, years)
+    for row in range(block.shape[1]):
+        for col in range(block.shape[2]):
+            values = block[:, row, col].astype(np.float64)
+            valid = ~np.isnan(values)
+            x, y = np.array(years, dtype=np.float64)[valid], values[valid]
+            if not valid.any():
+                assert np.isnan(stats['mean'][row, col])
+                assert all(np.isnan(stats[f"p{q}"][row, col]) for q in percentiles)
+                continue
+            assert stats['mean'][row, col] == pytest.approx(y.mean())
+            np.testing.assert_allclose(stats['anomaly'][valid, row, col], y - y.mean(), atol=1e-9)
+            for q in percentiles:
+                assert stats[f"p{q}"][row, col] == pytest.approx(np.percentile(y, q))
+            if len(y) < 2:
+                assert np.isnan(stats['std'][row, col])
+            else:
+                assert stats['std'][row, col] == pytest.approx(y.std(ddof=1))
+            if len(y) < 3:
+                assert np.isnan(stats['slope'][row, col])
+                assert np.isnan(stats['p_value'][row, col])
+                continue
+            slope, intercept = np.polyfit(x, y, 1)
+            assert stats['slope'][row, col] == pytest.approx(slope, rel=1e-6, abs=1e-9)
+            residuals = y - (intercept + slope * x)
+            standard_error = np.sqrt((residuals ** 2).sum() / (len(y) - 2) / ((x - x.mean()) ** 2).sum())
+            expected_p = t_test_p_value(np.array([slope / standard_error]), np.array([len(y) - 2.0]))[0]
+            assert stats['p_value'][row, col] == pytest.approx(expected_p, rel=1e-6)
@@ -0,0 +1,21 @@
+import numpy as np
+import pytest
+from terrain_lod import simplify_terrain
+
+# Function to make a DEM with relief and noise, so the simplified terrain mixes leaf sizes up to the clipped border
+def make_dem(shape, seed):
+    rng = np.random.default_rng(seed)
+    rows, cols = np.mgrid[:shape[0], :shape[1]]
+    return (np.sin(cols / 7) * np.cos(rows / 5) * 100 + rng.normal(0, 3, shape)).astype(np.float32)
+
+@pytest.mark.parametrize('shape, budget', [((64, 64), 3000), ((61, 77), 1500), ((100, 37), 2000), ((64, 64), 500)])
+def test_triangles_cover_the_dem_without_degenerate_faces(shape, budget):
+    vertices, faces = simplify_terrain(make_dem(shape, 0), budget)
+    assert len(faces) <= budget
+    rows, cols = vertices // shape[1], vertices % shape[1]
+    corners = np.stack([cols, rows], axis=1).astype(np.float64)[faces]
+    area = ((corners[:, 1, 0] - corners[:, 0, 0]) * (corners[:, 2, 1] - corners[:, 0, 1])
+            - (corners[:, 2, 0] - corners[:, 0, 0]) * (corners[:, 1, 1] - corners[:, 0, 1])) / 2
+    # Every triangle is wound the same way and none is flat, and together they tile the DEM exactly
+    assert np.all(area > 0) or np.all(area < 0)
+    assert np.abs(area).sum() == (shape[0] - 1) * (shape[1] - 1)
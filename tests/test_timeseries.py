@@ -0,0 +1,70 @@
+import json
+import numpy as np
+import pytest
+from rasterio.crs import CRS
+from rasterio.transform import from_origin
+import timeseries
+from timeseries import build_series, BandSeries
+
+# Pixel size in degrees of the test grid, not exactly representable in binary like the real grids
+pixel_size = 0.01
+
+# In-memory cube with the attributes of band_store.BandCube used by the time series
+class ArrayCube:
+    def __init__(self, data, years):
+        self.data = data
+        self.years = years
+        self.shape = data.shape
+        self.crs = CRS.from_epsg(4326)
+        self.transform = from_origin(23.5, 35.7, pixel_size, pixel_size)
+
+    def read(self, rows):
+        return self.data[:, rows]
+
+# Function to build the pixel-major copy of a random cube with missing pixels, in blocks smaller than the grid
+@pytest.fixture
+def series(tmp_path, monkeypatch):
+    rng = np.random.default_rng(1)
+    data = rng.normal(290, 5, (5, 130, 90)).astype(np.float32)
+    data[rng.random(data.shape) < 0.3] = np.nan
+    data[:, 40:60, 10:30] = np.nan  # A box with no valid pixel in any year
+    cube = ArrayCube(data, list(range(2000, 2005)))
+    with open(tmp_path / 'meta.json', 'w') as f:
+        json.dump({'years': cube.years}, f)
+    monkeypatch.setattr(timeseries, 'rows_per_block', 16)
+    build_series('test', cube, str(tmp_path))
+    return BandSeries('test', cube, str(tmp_path)), data
+
+# Function to get the longitude/latitude box whose edges are the given pixel edges
+def pixel_box(series, r0, r1, c0, c1):
+    west, north = series.transform * (c0, r0)
+    east, south = series.transform * (c1, r1)
+    return west, south, east, north
+
+def test_series_is_pixel_major_copy(series):
+    series, data = series
+    np.testing.assert_array_equal(np.asarray(series.series), data.transpose(1, 2, 0))
+
+@pytest.mark.parametrize('window', [(80, 100, 20, 50), (0, 130, 0, 90), (3, 4, 7, 8), (17, 33, 61, 89), (40, 60, 10, 30)])
+def test_box_mean_matches_nansum(series, window):
+    series, data = series
+    r0, r1, c0, c1 = window
+    found_window, means, counts = series.box_mean(*pixel_box(series, r0, r1, c0, c1))
+    assert found_window == window
+    box = data[:, r0:r1, c0:c1].astype(np.float64)
+    expected_counts = (~np.isnan(box)).sum(axis=(1, 2))
+    np.testing.assert_array_equal(counts, expected_counts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        expected = np.where(expected_counts > 0, np.nansum(box, axis=(1, 2)) / expected_counts, np.nan)
+    np.testing.assert_allclose(means, expected, rtol=1e-9, equal_nan=True)
+
+def test_point_and_outside(series):
+    series, data = series
+    west, south, east, north = pixel_box(series, 12, 13, 34, 35)
+    (row, col), values = series.point((south + north) / 2, (west + east) / 2)
+    assert (row, col) == (12, 34)
+    np.testing.assert_array_equal(values, data[:, 12, 34])
+    assert series.point(10.0, 10.0) is None
+    assert series.box_mean(10.0, 10.0, 11.0, 11.0) is None
+    assert series.point(float('nan'), 24.0) is None
+    assert series.box_mean(float('nan'), 35.0, 24.0, 35.5) is None
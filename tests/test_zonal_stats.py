@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+from zonal_stats import zone_index, reduce_zones
+
+# Function to make a label raster of six zones, one zone without pixels, and years with missing pixels
+def make_zones(seed=2):
+    rng = np.random.default_rng(seed)
+    labels = rng.integers(0, 7, (40, 50)).astype(np.int32)
+    labels[labels == 4] = 0  # Zone 4 has no pixel on this grid
+    names = [f"zone {n}" for n in range(1, 7)]
+    values = rng.normal(15, 4, (3, 40, 50)).astype(np.float32)
+    values[rng.random(values.shape) < 0.25] = np.nan
+    values[1][labels == 5] = np.nan  # Zone 5 has no valid pixel in the second year
+    return labels, names, values
+
+def test_zone_index_skips_empty_zones():
+    labels, names, _ = make_zones()
+    index = zone_index(labels, names)
+    assert list(index['zones']) == [0, 1, 2, 4, 5]
+    assert list(index['sizes']) == [int((labels == zone + 1).sum()) for zone in index['zones']]
+
+def test_reduce_zones_matches_masks():
+    labels, names, values = make_zones()
+    index = zone_index(labels, names)
+    stats = reduce_zones(index, values.reshape(len(values), -1))
+    for n_year, year_values in enumerate(values):
+        for n_zone, zone in enumerate(index['zones']):
+            zone_values = year_values[labels == zone + 1].astype(np.float64)
+            zone_values = zone_values[~np.isnan(zone_values)]
+            assert stats['count'][n_year, n_zone] == len(zone_values)
+            if not len(zone_values):
+                for name in ('mean', 'min', 'max', 'std'):
+                    assert np.isnan(stats[name][n_year, n_zone])
+                continue
+            assert stats['mean'][n_year, n_zone] == pytest.approx(zone_values.mean())
+            assert stats['min'][n_year, n_zone] == zone_values.min()
+            assert stats['max'][n_year, n_zone] == zone_values.max()
+            assert stats['std'][n_year, n_zone] == pytest.approx(zone_values.std())
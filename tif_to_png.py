@@ -1,8 +1,19 @@
+import os
+import gzip
+import json
+import math
+import shutil
+from multiprocessing import Pool
 import rasterio
 import numpy as np
 from PIL import Image
-import matplotlib.pyplot as plt
-from matplotlib.colors import Normalize
+from rasterio.transform import from_origin
+from rasterio.warp import reproject, transform_bounds, Resampling
+from fast_render import build_lut, quantize, render_rgba, save_indexed_png, nodata_index
+from raster_catalog import refresh_catalog, get_band_limits
+from build_manifest import is_up_to_date, record_output, save_manifest
+from tracing import span, log, file_size, start_trace
+from band_store import find_stored
 
 # Color maps for each band
 color_maps = {
@@ -13,29 +24,319 @@ color_maps = {
     'Wind_U': 'Purples'
 }
 
-def apply_color_map_with_transparency(array, cmap):
-    norm = Normalize(vmin=np.nanmin(array), vmax=np.nanmax(array))
-    colormap = plt.get_cmap(cmap)
-    rgba_img = colormap(norm(array))
-    rgba_img[:, :, 3] = ~np.isnan(array)  # Set alpha channel: 1 for data, 0 for NaN
-    rgba_img = (rgba_img * 255).astype(np.uint8)  # Convert to 8-bit per channel
-    return rgba_img
+# Folders of the source GeoTIFFs and of the overlays served to the map, and the years converted
+data_folder = "C:/Users/nboub/Pictures/Data"
+overlay_folder = "C:/Users/nboub/Pictures/Data1"
+years = list(range(1990, 2021))
 
-def convert_tif_to_png(tif_path, png_path, cmap):
-    with rasterio.open(tif_path) as src:
-        array = src.read(1)
-        array[array == src.nodata] = np.nan
+# Build web-mercator XYZ tile pyramids next to the full-extent PNGs
+build_tiles = True
+tile_zoom_levels = range(6, 11)
+tile_size = 256
 
-        # Apply color map with transparency
-        color_mapped_array = apply_color_map_with_transparency(array, cmap)
+# Write each band's years as one packed uint8 cube for browser-side colormapping in the map
+build_packed_cubes = True
 
-        # Save the color-mapped array as a PNG file with transparency
-        img = Image.fromarray(color_mapped_array, 'RGBA')
-        img.save(png_path)
+# Encoding of the full-extent overlays: 'palette' for 8-bit PNGs indexed into the colormap with a transparent nodata entry,
+# 'webp' for lossless WebP (.webp files), 'rgba' for 32-bit RGBA PNGs
+overlay_encoding = 'palette'
+
+# zlib level of the overlay PNGs, 0-9, and effort of the lossless WebP encoder, 0-6: higher is smaller and slower
+png_compress_level = 9
+webp_method = 4
+
+# Number of worker processes encoding the overlays of every band, 1 encodes everything in this process
+overlay_workers = os.cpu_count() or 1
+
+# Only rebuild outputs whose input rasters or rendering parameters changed since the last run
+incremental_build = True
+
+# Half the width of the web-mercator world in meters
+mercator_half_width = 20037508.342789244
+
+# Colors come from a precomputed uint8 lookup table, NaN maps to its transparent entry
+# Without limits the array is normalized by its own range
+def apply_color_map_with_transparency(array, cmap, vmin=None, vmax=None):
+    vmin = np.nanmin(array) if vmin is None else vmin
+    vmax = np.nanmax(array) if vmax is None else vmax
+    indices = quantize(array, vmin, vmax)
+    return render_rgba(indices, build_lut(cmap))
+
+# Function to get the encoding settings of the overlays, passed along to the workers so changes made at runtime reach them
+def overlay_settings():
+    return {'encoding': overlay_encoding, 'compress_level': png_compress_level, 'webp_method': webp_method}
+
+# Function to get the file extension of the overlays, which follows the encoding
+def overlay_extension(encoding=None):
+    return 'webp' if (encoding or overlay_encoding) == 'webp' else 'png'
+
+# Function to get the file name of an overlay
+def overlay_file_name(band, year, encoding=None):
+    return f"Crete_{band}_{year}.{overlay_extension(encoding)}"
+
+# Function to save an array already in memory as a colormapped overlay in the chosen encoding
+# Without limits the array is normalized by its own range, callers pass the band's limits so colors compare across years
+def save_overlay_png(array, png_path, cmap, vmin=None, vmax=None, settings=None):
+    settings = settings or overlay_settings()
+    encoding = settings['encoding']
+    vmin = np.nanmin(array) if vmin is None else vmin
+    vmax = np.nanmax(array) if vmax is None else vmax
+    lut = build_lut(cmap)
+    with span('render', pixels=array.size):
+        indices = quantize(array, vmin, vmax)
+        rgba = None if encoding == 'palette' else render_rgba(indices, lut)
+
+    with span('encode', path=png_path, encoding=encoding) as args:
+        if encoding == 'palette':
+            save_indexed_png(indices, lut, png_path, compress_level=settings['compress_level'])
+        elif encoding == 'webp':
+            Image.fromarray(rgba, 'RGBA').save(png_path, format='WEBP', lossless=True, method=settings['webp_method'])
+        else:
+            Image.fromarray(rgba, 'RGBA').save(png_path, format='PNG', compress_level=settings['compress_level'])
+        args['bytes_written'] = file_size(png_path)
+
+def convert_tif_to_png(tif_path, png_path, cmap, vmin=None, vmax=None, settings=None):
+    array = read_band_array(tif_path)[0]
+    save_overlay_png(array, png_path, cmap, vmin, vmax, settings)
+
+# Function to downsample an array by 2 with a NaN-aware mean of each 2x2 block
+def downsample_by_two(array):
+    height, width = array.shape
+    padded = np.full((height + height % 2, width + width % 2), np.nan, dtype=np.float32)
+    padded[:height, :width] = array
+    blocks = padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2)
+    valid = ~np.isnan(blocks)
+    count = valid.sum(axis=(1, 3))
+    total = np.where(valid, blocks, 0).sum(axis=(1, 3))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, total / count, np.nan).astype(np.float32)
+
+# Function to cut one zoom level into tiles and save the non-empty ones as palette PNGs
+def save_zoom_level_tiles(array, pixel_x0, pixel_y0, zoom, tile_dir, lut, vmin, vmax):
+    with span('encode', zoom=zoom) as args:
+        n_saved, args['bytes_written'] = save_tiles(array, pixel_x0, pixel_y0, zoom, tile_dir, lut, vmin, vmax)
+    return n_saved
+
+# Function to save the tiles of one zoom level, returns how many were saved and their size
+def save_tiles(array, pixel_x0, pixel_y0, zoom, tile_dir, lut, vmin, vmax):
+    height, width = array.shape
+    n_saved = n_bytes = 0
+    for tile_y in range(pixel_y0 // tile_size, (pixel_y0 + height - 1) // tile_size + 1):
+        for tile_x in range(pixel_x0 // tile_size, (pixel_x0 + width - 1) // tile_size + 1):
+            # Position of the tile inside the level array, parts outside it stay transparent
+            x0 = tile_x * tile_size - pixel_x0
+            y0 = tile_y * tile_size - pixel_y0
+            tile = np.full((tile_size, tile_size), nodata_index, dtype=np.uint8)
+            src = array[max(y0, 0):y0 + tile_size, max(x0, 0):x0 + tile_size]
+            if src.size == 0 or np.isnan(src).all():
+                continue
+            tile[max(-y0, 0):max(-y0, 0) + src.shape[0], max(-x0, 0):max(-x0, 0) + src.shape[1]] = quantize(src, vmin, vmax)
+            tile_path = os.path.join(tile_dir, str(zoom), str(tile_x), f"{tile_y}.png")
+            os.makedirs(os.path.dirname(tile_path), exist_ok=True)
+            save_indexed_png(tile, lut, tile_path)
+            n_saved += 1
+            n_bytes += file_size(tile_path)
+    return n_saved, n_bytes
+
+# Function to build the XYZ tile pyramid of one raster
+def build_tile_pyramid(tif_path, tile_dir, cmap, vmin=None, vmax=None):
+    cube, year = find_stored(tif_path)
+    if cube is not None:
+        with span('read', path=tif_path, store=True):
+            array, src_crs, src_transform, src_bounds = cube.read_year(year), cube.crs, cube.transform, cube.bounds()
+    else:
+        with span('read', path=tif_path, bytes_read=file_size(tif_path)), rasterio.open(tif_path) as src:
+            array = src.read(1).astype(np.float32)
+            if src.nodata is not None:
+                array[array == src.nodata] = np.nan
+            src_crs, src_transform, src_bounds = src.crs, src.transform, src.bounds
+    build_tile_pyramid_from_array(array, src_crs, src_transform, src_bounds, tile_dir, cmap, vmin, vmax)
+
+# Function to build the XYZ tile pyramid of an array already in memory
+# The array is reprojected once at the highest zoom, every lower level is downsampled from the one above
+# The pyramid is written to a temporary folder and then replaces the old one, so tiles of dropped zoom levels do not linger
+def build_tile_pyramid_from_array(array, src_crs, src_transform, src_bounds, tile_dir, cmap, vmin=None, vmax=None):
+    final_dir, tile_dir = tile_dir, f"{tile_dir}.tmp"
+    shutil.rmtree(tile_dir, ignore_errors=True)
+    left, bottom, right, top = transform_bounds(src_crs, 'EPSG:3857', *src_bounds)
+    vmin = np.nanmin(array) if vmin is None else vmin
+    vmax = np.nanmax(array) if vmax is None else vmax
+    lut = build_lut(cmap)
+
+    # Pixel grid of the highest zoom level covering the raster, in global pixel coordinates
+    max_zoom = max(tile_zoom_levels)
+    resolution = 2 * mercator_half_width / (tile_size * 2 ** max_zoom)
+    pixel_x0 = int(math.floor((left + mercator_half_width) / resolution))
+    pixel_y0 = int(math.floor((mercator_half_width - top) / resolution))
+    pixel_x1 = int(math.ceil((right + mercator_half_width) / resolution))
+    pixel_y1 = int(math.ceil((mercator_half_width - bottom) / resolution))
+    level = np.full((pixel_y1 - pixel_y0, pixel_x1 - pixel_x0), np.nan, dtype=np.float32)
+    level_transform = from_origin(pixel_x0 * resolution - mercator_half_width, mercator_half_width - pixel_y0 * resolution, resolution, resolution)
+    with span('reproject', pixels=level.size):
+        reproject(array, level, src_transform=src_transform, src_crs=src_crs, src_nodata=np.nan,
+                  dst_transform=level_transform, dst_crs='EPSG:3857', dst_nodata=np.nan, resampling=Resampling.nearest)
+
+    n_saved = 0
+    for zoom in range(max_zoom, min(tile_zoom_levels) - 1, -1):
+        n_saved += save_zoom_level_tiles(level, pixel_x0, pixel_y0, zoom, tile_dir, lut, vmin, vmax)
+        # Align the level to even global pixels before halving it for the next zoom
+        if pixel_x0 % 2:
+            level = np.pad(level, ((0, 0), (1, 0)), constant_values=np.nan)
+            pixel_x0 -= 1
+        if pixel_y0 % 2:
+            level = np.pad(level, ((1, 0), (0, 0)), constant_values=np.nan)
+            pixel_y0 -= 1
+        level = downsample_by_two(level)
+        pixel_x0 //= 2
+        pixel_y0 //= 2
+    os.makedirs(tile_dir, exist_ok=True)
+    shutil.rmtree(final_dir, ignore_errors=True)
+    os.replace(tile_dir, final_dir)
+    log(f"Saved {n_saved} tiles to {final_dir}")
+
+# Function to read the first band of a raster as float32 with nodata set to NaN, from its band cube when it was ingested
+def read_band_array(tif_path):
+    cube, year = find_stored(tif_path)
+    if cube is not None:
+        with span('read', path=tif_path, store=True):
+            return cube.read_year(year), cube.crs, cube.bounds()
+    with span('read', path=tif_path, bytes_read=file_size(tif_path)), rasterio.open(tif_path) as src:
+        array = src.read(1).astype(np.float32)
+        if src.nodata is not None:
+            array[array == src.nodata] = np.nan
+        return array, src.crs, src.bounds
+
+# Function to pack all years of a band into one uint8 cube quantized against the band's limits
+# The cube is written one year at a time, with its metadata and lookup table in a JSON file
+def write_packed_cube(tif_paths, years, cmap, output_prefix, vmin, vmax):
+    array, crs, bounds = read_band_array(tif_paths[0])
+    height, width = array.shape
+    with open(f"{output_prefix}.bin", 'wb') as f:
+        for position, tif_path in enumerate(tif_paths):
+            write_cube_year(f, position, read_band_array(tif_path)[0], vmin, vmax)
+    finish_packed_cube(output_prefix, years, width, height, crs, bounds, cmap, vmin, vmax)
+
+# Function to write one quantized year at its position in an open cube file, years may arrive in any order
+def write_cube_year(cube_file, position, array, vmin, vmax):
+    data = quantize(array, vmin, vmax).tobytes()
+    with span('write', bytes_written=len(data)):
+        cube_file.seek(position * len(data))
+        cube_file.write(data)
+
+# Function to write the compressed copy and the metadata of a cube once all its years are written
+def finish_packed_cube(output_prefix, years, width, height, crs, bounds, cmap, vmin, vmax):
+    west, south, east, north = transform_bounds(crs, 'EPSG:4326', *bounds)
+    # Precompressed copy, served by server.py to clients that accept gzip
+    with span('encode', path=f"{output_prefix}.bin.gz") as args:
+        with open(f"{output_prefix}.bin", 'rb') as src, gzip.open(f"{output_prefix}.bin.gz", 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        args['bytes_written'] = file_size(f"{output_prefix}.bin.gz")
+
+    meta = {
+        'years': years,
+        'width': width,
+        'height': height,
+        'vmin': vmin,
+        'vmax': vmax,
+        'bounds': [[south, west], [north, east]],
+        'lut': build_lut(cmap).ravel().tolist()
+    }
+    with open(f"{output_prefix}.json", 'w') as f:
+        json.dump(meta, f)
+    log(f"Saved packed cube of {len(years)} years to {output_prefix}.bin")
+
+# Function to describe the rendering parameters of a band's overlays for the build manifest
+def overlay_params(cmap, vmin, vmax):
+    return {'cmap': cmap, 'vmin': vmin, 'vmax': vmax}
+
+# Function to describe the rendering parameters of a band's full-extent overlays for the build manifest
+# Only the setting of the chosen encoder is recorded, so changing the other one rebuilds nothing
+def overlay_encoding_params(cmap, vmin, vmax, settings=None):
+    settings = settings or overlay_settings()
+    params = dict(overlay_params(cmap, vmin, vmax), encoding=settings['encoding'])
+    if settings['encoding'] == 'webp':
+        params['webp_method'] = settings['webp_method']
+    else:
+        params['compress_level'] = settings['compress_level']
+    return params
+
+# Function run by the overlay workers: convert one GeoTIFF, returns the job for the build manifest
+# A job is (band, year, tif_path, png_path, cmap, vmin, vmax, settings)
+def overlay_job(job):
+    band, year, tif_path, png_path, cmap, vmin, vmax, settings = job
+    with span('overlay', band=band, year=year):
+        convert_tif_to_png(tif_path, png_path, cmap, vmin, vmax, settings)
+    return job
+
+# Function to record a converted overlay in the build manifest
+def record_overlay(job):
+    band, year, tif_path, png_path, cmap, vmin, vmax, settings = job
+    record_output(png_path, [tif_path], overlay_encoding_params(cmap, vmin, vmax, settings))
+
+# Function to convert the overlays of every band in one pool of worker processes, recorded in the build manifest as they finish
+def convert_overlays(jobs, workers=None):
+    workers = min(workers or overlay_workers, len(jobs))
+    if workers <= 1:
+        for job in map(overlay_job, jobs):
+            record_overlay(job)
+        return
+    with Pool(workers) as pool:
+        for job in pool.imap_unordered(overlay_job, jobs):
+            record_overlay(job)
+
+# Function to describe the rendering parameters of a band's tile pyramids for the build manifest
+def tile_params(cmap, vmin, vmax):
+    return dict(overlay_params(cmap, vmin, vmax), zoom_levels=list(tile_zoom_levels), tile_size=tile_size)
 
 # Convert all your TIF files to PNG with color mapping and transparency
-for band, cmap in color_maps.items():
-    for year in range(1990, 2021):
-        tif_path = f"C:/Users/nboub/Pictures/Data/Crete_{band}_{year}.tif"
-        png_path = f"C:/Users/nboub/Pictures/Data1/Crete_{band}_{year}.png"
-        convert_tif_to_png(tif_path, png_path, cmap)
+# Every year of a band is colormapped against the band's limits from the raster catalog, so colors compare across years
+if __name__ == '__main__':
+    start_trace()
+    refresh_catalog()
+    settings = overlay_settings()
+    band_limits = {}
+    n_skipped = {}
+    overlay_jobs = []
+    for band, cmap in color_maps.items():
+        limits = get_band_limits(band, folder=data_folder)
+        if limits is None:
+            log(f"{band}: no valid rasters in {data_folder}, skipping it")
+            continue
+        vmin, vmax = limits['min'], limits['max']
+        band_limits[band] = (vmin, vmax)
+        n_skipped[band] = 0
+        for year in years:
+            tif_path = f"{data_folder}/Crete_{band}_{year}.tif"
+            png_path = f"{overlay_folder}/{overlay_file_name(band, year, settings['encoding'])}"
+            if incremental_build and is_up_to_date(png_path, [tif_path], overlay_encoding_params(cmap, vmin, vmax, settings)):
+                n_skipped[band] += 1
+            else:
+                overlay_jobs.append((band, year, tif_path, png_path, cmap, vmin, vmax, settings))
+
+    # The overlays of every band are encoded in one pool, then the tile pyramids and packed cubes are built band by band
+    convert_overlays(overlay_jobs)
+    save_manifest()
+    for band, (vmin, vmax) in band_limits.items():
+        cmap = color_maps[band]
+        params = overlay_params(cmap, vmin, vmax)
+        if build_tiles:
+            for year in years:
+                tif_path = f"{data_folder}/Crete_{band}_{year}.tif"
+                tile_dir = f"{overlay_folder}/tiles/Crete_{band}_{year}"
+                with span('tiles', band=band, year=year):
+                    if incremental_build and is_up_to_date(tile_dir, [tif_path], tile_params(cmap, vmin, vmax)):
+                        n_skipped[band] += 1
+                    else:
+                        build_tile_pyramid(tif_path, tile_dir, cmap, vmin, vmax)
+                        record_output(tile_dir, [tif_path], tile_params(cmap, vmin, vmax))
+        if build_packed_cubes:
+            tif_paths = [f"{data_folder}/Crete_{band}_{year}.tif" for year in years]
+            cube_prefix = f"{overlay_folder}/Crete_{band}_cube"
+            with span('cube', band=band):
+                if incremental_build and is_up_to_date(f"{cube_prefix}.json", tif_paths, params):
+                    n_skipped[band] += 1
+                else:
+                    write_packed_cube(tif_paths, years, cmap, cube_prefix, vmin, vmax)
+                    record_output(f"{cube_prefix}.json", tif_paths, params)
+        save_manifest()
+        log(f"{band}: {n_skipped[band]} outputs already up to date.")
@@ -0,0 +1,223 @@
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+from numpy.lib.format import open_memmap
+from pyproj import CRS, Transformer
+from band_store import open_cube, cube_folder
+import band_store
+from tracing import span, log, start_trace
+
+# Rows of a band cube copied into the pixel-major layout at once while building it
+rows_per_block = 64
+
+# Pixel-major copies already opened in this run, reopened when their cube changes
+_series = {}
+_series_lock = threading.Lock()
+
+# Transformers from longitude/latitude to the CRS of each cube
+_transformers = {}
+
+# Raised when the pixel-major copy of a band is missing or older than its cube, the copies are only built offline
+class StaleSeriesError(Exception):
+    pass
+
+# Function to get the fingerprint of a cube, the pixel-major copy is rebuilt when it changes
+def cube_signature(folder):
+    with open(os.path.join(folder, 'meta.json'), 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+# Function to write a pixel-major copy of a band cube, (rows, cols, years) so one pixel's history is contiguous,
+# with summed-area tables of the values and of the valid pixels so the mean of any box is four lookups per year
+def build_series(band, cube, folder):
+    n_years, height, width = cube.shape
+    paths = {name: os.path.join(folder, f"{name}.npy") for name in ('series', 'box_sums', 'box_counts')}
+    with span('build_series', band=band, years=n_years, pixels=height * width) as args:
+        series = open_memmap(paths['series'] + '.tmp', mode='w+', dtype=np.float32, shape=(height, width, n_years))
+        box_sums = open_memmap(paths['box_sums'] + '.tmp', mode='w+', dtype=np.float64, shape=(height + 1, width + 1, n_years))
+        box_counts = open_memmap(paths['box_counts'] + '.tmp', mode='w+', dtype=np.int32, shape=(height + 1, width + 1, n_years))
+        box_sums[0] = 0
+        box_counts[0] = 0
+        for row_start in range(0, height, rows_per_block):
+            row_stop = min(row_start + rows_per_block, height)
+            block = cube.read(rows=slice(row_start, row_stop)).transpose(1, 2, 0)
+            series[row_start:row_stop] = block
+            valid = ~np.isnan(block)
+            # Cumulative sums along the columns, then down the rows continuing from the previous block
+            row_sums = np.zeros((row_stop - row_start, width + 1, n_years), dtype=np.float64)
+            row_counts = np.zeros((row_stop - row_start, width + 1, n_years), dtype=np.int32)
+            np.cumsum(np.where(valid, block, 0), axis=1, out=row_sums[:, 1:])
+            np.cumsum(valid, axis=1, out=row_counts[:, 1:])
+            box_sums[row_start + 1:row_stop + 1] = np.cumsum(row_sums, axis=0) + box_sums[row_start]
+            box_counts[row_start + 1:row_stop + 1] = np.cumsum(row_counts, axis=0) + box_counts[row_start]
+        for array in (series, box_sums, box_counts):
+            array.flush()
+        del series, box_sums, box_counts
+        for path in paths.values():
+            os.replace(path + '.tmp', path)
+        args['bytes_written'] = sum(os.path.getsize(path) for path in paths.values())
+    with open(os.path.join(folder, 'series.json'), 'w') as f:
+        json.dump({'cube': cube_signature(folder)}, f)
+    log(f"Built the pixel-major time series of {band} in {folder}")
+
+# Pixel-major copy of a band cube with the grid needed to answer queries in longitude/latitude
+class BandSeries:
+    def __init__(self, band, cube, folder):
+        self.band = band
+        self.years = cube.years
+        self.crs = cube.crs
+        self.transform = cube.transform
+        self.inverse = ~cube.transform
+        self.series = np.load(os.path.join(folder, 'series.npy'), mmap_mode='r')
+        self.box_sums = np.load(os.path.join(folder, 'box_sums.npy'), mmap_mode='r')
+        self.box_counts = np.load(os.path.join(folder, 'box_counts.npy'), mmap_mode='r')
+        self.height, self.width = self.series.shape[:2]
+
+    # Function to convert longitudes and latitudes to fractional (row, col) positions in the grid
+    def to_grid(self, lon, lat):
+        x, y = lonlat_transformer(self.crs).transform(lon, lat)
+        col, row = self.inverse * (np.asarray(x), np.asarray(y))
+        return row, col
+
+    # Function to get the pixel holding a point, None if it is outside the grid or not a finite position
+    def pixel_at(self, lat, lon):
+        row, col = self.to_grid(lon, lat)
+        if not (np.isfinite(row) and np.isfinite(col)):
+            return None
+        row, col = int(np.floor(row)), int(np.floor(col))
+        if not (0 <= row < self.height and 0 <= col < self.width):
+            return None
+        return row, col
+
+    # Function to get every year of the pixel holding a point, None if it is outside the grid
+    def point(self, lat, lon):
+        pixel = self.pixel_at(lat, lon)
+        if pixel is None:
+            return None
+        return pixel, np.array(self.series[pixel])
+
+    # Function to get the rows and columns touched by a longitude/latitude box, None if it misses the grid or is not finite
+    def window(self, west, south, east, north):
+        # Corners and edge midpoints, so the box stays covered when the grid is projected
+        lons = np.array([west, east, west, east, (west + east) / 2, (west + east) / 2, west, east])
+        lats = np.array([south, south, north, north, south, north, (south + north) / 2, (south + north) / 2])
+        rows, cols = self.to_grid(lons, lats)
+        # Rounded first, so a box lying on pixel edges does not take in the pixels beyond them through floating point error
+        rows, cols = np.round(rows, 9), np.round(cols, 9)
+        if not (np.isfinite(rows).all() and np.isfinite(cols).all()):
+            return None
+        r0, r1 = max(int(np.floor(rows.min())), 0), min(int(np.ceil(rows.max())), self.height)
+        c0, c1 = max(int(np.floor(cols.min())), 0), min(int(np.ceil(cols.max())), self.width)
+        if r0 >= r1 or c0 >= c1:
+            return None
+        return r0, r1, c0, c1
+
+    # Function to get the mean of every year over a longitude/latitude box, NaN for years with no valid pixel
+    def box_mean(self, west, south, east, north):
+        window = self.window(west, south, east, north)
+        if window is None:
+            return None
+        r0, r1, c0, c1 = window
+        total = self.box_sums[r1, c1] - self.box_sums[r0, c1] - self.box_sums[r1, c0] + self.box_sums[r0, c0]
+        count = self.box_counts[r1, c1] - self.box_counts[r0, c1] - self.box_counts[r1, c0] + self.box_counts[r0, c0]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return window, np.where(count > 0, total / count, np.nan), count
+
+# Function to get a transformer from longitude/latitude to a CRS
+def lonlat_transformer(crs):
+    key = crs.to_wkt() if crs is not None else None
+    if key not in _transformers:
+        _transformers[key] = Transformer.from_crs(CRS.from_epsg(4326), CRS.from_user_input(crs or 'EPSG:4326'), always_xy=True)
+    return _transformers[key]
+
+# Function to check whether the pixel-major copy of a band matches its cube
+def series_up_to_date(folder):
+    try:
+        with open(os.path.join(folder, 'series.json')) as f:
+            return json.load(f)['cube'] == cube_signature(folder)
+    except (OSError, ValueError, KeyError):
+        return False
+
+# Function to build the pixel-major copy of a band when its cube changed, run offline after the cubes are ingested
+def update_series(band):
+    cube = open_cube(band)
+    if cube is None:
+        return False
+    folder = cube_folder(band)
+    if series_up_to_date(folder):
+        return False
+    build_series(band, cube, folder)
+    return True
+
+# Function to open the pixel-major copy of a band, None if the band was never ingested
+# Raises StaleSeriesError if its copy is missing or older than its cube, queries never build it
+def open_series(band):
+    cube = open_cube(band)
+    if cube is None:
+        return None
+    folder = cube_folder(band)
+    with _series_lock:
+        series, known_cube = _series.get(folder, (None, None))
+        if series is not None and known_cube is cube:
+            return series
+        if not series_up_to_date(folder):
+            raise StaleSeriesError(band)
+        series = BandSeries(band, cube, folder)
+        _series[folder] = (series, cube)
+        return series
+
+# Function to list the bands that have a cube in the store
+def list_bands():
+    if not os.path.isdir(band_store.store_folder):
+        return []
+    return sorted(name for name in os.listdir(band_store.store_folder)
+                  if os.path.isfile(os.path.join(band_store.store_folder, name, 'meta.json')))
+
+# Function to convert an array to a JSON list with None for NaN
+def to_json_values(values):
+    return [None if np.isnan(value) else round(float(value), 6) for value in values]
+
+# Function to get every year of every band at a point: {'lat', 'lon', 'bands': {band: {'years', 'values', 'row', 'col'}}, 'stale'}
+# Bands whose grid does not hold the point are left out, bands whose pixel-major copy is not built yet are listed in 'stale'
+def point_series(lat, lon, bands=None):
+    result = {'lat': lat, 'lon': lon, 'bands': {}, 'stale': []}
+    with span('timeseries_point', lat=lat, lon=lon):
+        for band in bands or list_bands():
+            try:
+                series = open_series(band)
+            except StaleSeriesError:
+                result['stale'].append(band)
+                continue
+            found = series.point(lat, lon) if series is not None else None
+            if found is None:
+                continue
+            (row, col), values = found
+            result['bands'][series.band] = {'years': series.years, 'values': to_json_values(values), 'row': row, 'col': col}
+    return result
+
+# Function to get the mean of every year of every band over a box given as (west, south, east, north) in degrees
+# Each band also gives the number of valid pixels averaged in each year, bands whose copy is not built yet are listed in 'stale'
+def box_mean(bbox, bands=None):
+    west, south, east, north = bbox
+    result = {'bbox': [west, south, east, north], 'bands': {}, 'stale': []}
+    with span('timeseries_box', bbox=list(bbox)):
+        for band in bands or list_bands():
+            try:
+                series = open_series(band)
+            except StaleSeriesError:
+                result['stale'].append(band)
+                continue
+            found = series.box_mean(west, south, east, north) if series is not None else None
+            if found is None:
+                continue
+            (r0, r1, c0, c1), means, counts = found
+            result['bands'][series.band] = {'years': series.years, 'values': to_json_values(means),
+                                            'pixels': [int(count) for count in counts], 'window': [r0, r1, c0, c1]}
+    return result
+
+# Build the pixel-major copy of every ingested band whose cube changed
+if __name__ == '__main__':
+    start_trace()
+    for band in list_bands():
+        update_series(band)
@@ -0,0 +1,194 @@
+import os
+import sys
+import json
+import glob
+import time
+import atexit
+import threading
+import contextlib
+from datetime import datetime
+try:
+    import resource
+except ImportError:  # Not available on Windows, peak RSS is then left out
+    resource = None
+
+# Environment variable giving worker processes the id of the run they belong to
+run_id_variable = 'CRETE_TRACE_RUN'
+
+# Record a span for every read, reprojection, render, encode and write, and every progress message
+# Off until a script run directly calls start_trace(), worker processes of a traced run find its id in the environment
+trace_enabled = run_id_variable in os.environ
+
+# Folder of the traces: one JSON lines file per process, merged into a Chrome trace and a summary at the end of the run
+trace_folder = 'C:/Users/nboub/Pictures/Traces'
+
+# Print progress messages to the console as well
+echo_messages = True
+
+# Number of stages listed for each band in the end-of-run summary
+summary_top_stages = 5
+
+# Trace file of this process, reopened after a fork, and the open spans of each thread
+_state = {'pid': None, 'file': None}
+_lock = threading.Lock()
+_local = threading.local()
+
+# Function to start tracing a run, called from the __main__ block of each script
+# The process starting the run writes the Chrome trace and summary when it exits
+def start_trace():
+    global trace_enabled
+    trace_enabled = True
+    if run_id_variable not in os.environ:
+        script = os.path.splitext(os.path.basename(sys.argv[0] or 'python'))[0] or 'python'
+        os.environ[run_id_variable] = f"{script}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.getpid()}"
+        atexit.register(finish_trace)
+
+# Function to get the id of this run, starting one when tracing was switched on by hand
+def run_id():
+    if run_id_variable not in os.environ:
+        start_trace()
+    return os.environ[run_id_variable]
+
+# Function to get the peak resident memory of this process in bytes, None where it is not available
+def peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+# Function to get the size of a file for the bytes read or written by a span, 0 if it does not exist
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+# Function to append one event to the JSON lines file of this process
+def write_event(event):
+    with _lock:
+        if _state['pid'] != os.getpid():
+            os.makedirs(trace_folder, exist_ok=True)
+            _state['file'] = open(os.path.join(trace_folder, f"{run_id()}_{os.getpid()}.jsonl"), 'a', buffering=1)
+            _state['pid'] = os.getpid()
+        _state['file'].write(json.dumps(event, default=str) + '\n')
+
+# Function to get the open spans of the current thread
+def span_stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+# Context manager timing one stage of the work
+# The band is inherited from the enclosing span, callers add e.g. bytes_read and bytes_written to the yielded dict
+@contextlib.contextmanager
+def span(name, band=None, **args):
+    if not trace_enabled:
+        yield args
+        return
+    stack = span_stack()
+    parent = stack[-1] if stack else None
+    # The outermost span names the stage, so e.g. the render of a 3D frame and of a 2D plot are told apart
+    record = {'band': band or (parent['band'] if parent else None), 'stage': parent['stage'] if parent else name,
+              'args': args, 'child_wall': 0.0, 'child_cpu': 0.0}
+    stack.append(record)
+    ts = time.time_ns() // 1000
+    start, cpu_start = time.perf_counter(), time.thread_time()
+    try:
+        yield args
+    finally:
+        wall = time.perf_counter() - start
+        cpu = time.thread_time() - cpu_start
+        stack.pop()
+        if parent is not None:
+            parent['child_wall'] += wall
+            parent['child_cpu'] += cpu
+        write_event({
+            'type': 'span', 'name': name, 'stage': record['stage'], 'band': record['band'], 'ts': ts,
+            'wall': wall, 'cpu': cpu, 'self_wall': wall - record['child_wall'], 'self_cpu': cpu - record['child_cpu'],
+            'peak_rss': peak_rss(), 'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args
+        })
+
+# Function to add counts, e.g. bytes_read, to the innermost open span of the current thread
+def annotate(**counts):
+    stack = span_stack()
+    if trace_enabled and stack:
+        args = stack[-1]['args']
+        for name, count in counts.items():
+            args[name] = args.get(name, 0) + count
+
+# Function to report progress: printed, and kept in the trace at the time and in the band it happened
+def log(message):
+    if echo_messages:
+        print(message)
+    if trace_enabled:
+        stack = span_stack()
+        write_event({'type': 'log', 'message': message, 'band': stack[-1]['band'] if stack else None,
+                     'ts': time.time_ns() // 1000, 'pid': os.getpid(), 'tid': threading.get_ident()})
+
+# Function to convert the events of a run to Chrome trace events, for chrome://tracing or Perfetto
+def chrome_trace_events(events):
+    trace_events = []
+    for event in events:
+        if event['type'] == 'span':
+            args = dict(event['args'], band=event['band'], cpu_ms=round(event['cpu'] * 1000, 3))
+            trace_events.append({'name': event['name'], 'cat': event['band'] or 'run', 'ph': 'X', 'ts': event['ts'],
+                                 'dur': round(event['wall'] * 1e6), 'pid': event['pid'], 'tid': event['tid'], 'args': args})
+            if event['peak_rss'] is not None:
+                trace_events.append({'name': 'peak_rss', 'ph': 'C', 'ts': event['ts'] + round(event['wall'] * 1e6),
+                                     'pid': event['pid'], 'args': {'MB': round(event['peak_rss'] / 2 ** 20, 1)}})
+        else:
+            trace_events.append({'name': event['message'], 'cat': event['band'] or 'run', 'ph': 'i', 's': 't',
+                                 'ts': event['ts'], 'pid': event['pid'], 'tid': event['tid']})
+    return trace_events
+
+# Function to total the self time, CPU time and bytes of every span of every band, by stage and span name
+def summarize(events):
+    summary = {}
+    for event in events:
+        if event['type'] != 'span':
+            continue
+        name = event['name'] if event['stage'] == event['name'] else f"{event['stage']}/{event['name']}"
+        stage = summary.setdefault(event['band'] or 'run', {}).setdefault(name, {
+            'spans': 0, 'self_wall': 0.0, 'self_cpu': 0.0, 'bytes_read': 0, 'bytes_written': 0, 'peak_rss': 0})
+        stage['spans'] += 1
+        stage['self_wall'] += event['self_wall']
+        stage['self_cpu'] += event['self_cpu']
+        stage['bytes_read'] += event['args'].get('bytes_read', 0)
+        stage['bytes_written'] += event['args'].get('bytes_written', 0)
+        stage['peak_rss'] = max(stage['peak_rss'], event['peak_rss'] or 0)
+    return summary
+
+# Function to print the hottest stages of each band
+def print_summary(summary):
+    print("Hottest stages per band (self time, CPU time, spans, MB read, MB written):")
+    for band, stages in sorted(summary.items()):
+        print(f"  {band}")
+        for name, stage in sorted(stages.items(), key=lambda item: -item[1]['self_wall'])[:summary_top_stages]:
+            print(f"    {name:<32} {stage['self_wall']:9.2f} s {stage['self_cpu']:9.2f} s CPU {stage['spans']:7d} "
+                  f"{stage['bytes_read'] / 2 ** 20:9.1f} {stage['bytes_written'] / 2 ** 20:9.1f}")
+    peak = max((stage['peak_rss'] for stages in summary.values() for stage in stages.values()), default=0)
+    if peak:
+        print(f"  Peak RSS of the largest process: {peak / 2 ** 20:.0f} MB")
+
+# Function to merge the trace files of every process of the run into a Chrome trace and a summary
+def finish_trace():
+    with _lock:
+        if _state['file'] is not None and _state['pid'] == os.getpid():
+            _state['file'].close()
+        _state['pid'], _state['file'] = None, None
+    run = os.environ.get(run_id_variable)
+    paths = sorted(glob.glob(os.path.join(trace_folder, f"{run}_*.jsonl"))) if run else []
+    if not paths:
+        return
+    events = []
+    for path in paths:
+        with open(path) as f:
+            events.extend(json.loads(line) for line in f if line.strip())
+    events.sort(key=lambda event: event['ts'])
+    with open(os.path.join(trace_folder, f"{run}.json"), 'w') as f:
+        json.dump({'traceEvents': chrome_trace_events(events), 'displayTimeUnit': 'ms'}, f)
+    summary = summarize(events)
+    with open(os.path.join(trace_folder, f"{run}_summary.json"), 'w') as f:
+        json.dump(summary, f, indent=2)
+    print_summary(summary)
+    print(f"Trace of {len(events)} events saved to {os.path.join(trace_folder, run)}.json")
@@ -0,0 +1,177 @@
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+import rioxarray as riox
+from rasterio.crs import CRS
+from rasterio.features import rasterize
+from rasterio.warp import transform_geom
+from raster_catalog import refresh_catalog, get_entries
+from build_manifest import input_hash
+from reproject_index import read_source, get_index, apply_index, grid_signature
+from tracing import span, log, file_size, start_trace
+import band_store
+
+# Polygon layers of the zones as GeoJSON, with the property naming each zone
+zone_layers = {
+    'prefecture': {'path': 'C:/Users/nboub/Pictures/Boundaries/crete_prefectures.geojson', 'name_field': 'NAME'},
+    'municipality': {'path': 'C:/Users/nboub/Pictures/Boundaries/crete_municipalities.geojson', 'name_field': 'NAME'}
+}
+
+# Grid the zones are rasterized onto: 'data' for the grid of each band's rasters, 'dem' for the DEM grid of create_3D.py
+zonal_grid = 'data'
+dem_path = 'C:/Users/nboub/Desktop/crete_dem.tif'
+
+# Count every pixel a polygon touches instead of only the pixels whose centre it holds, useful for coarse grids
+all_touched = False
+
+# Folder of the cached label rasters, one per zone layer and grid
+label_folder = 'C:/Users/nboub/Pictures/Zone_Labels'
+
+# Long-format table of the statistics: one row per zone layer, zone, band and year
+zonal_csv_path = 'C:/Users/nboub/Desktop/crete_zonal_statistics.csv'
+
+# Years reduced at once, each batch is one (years, pixels) array
+years_per_batch = 8
+
+# Label rasters already loaded in this run, keyed by zone layer and grid
+_labels_memo = {}
+
+# Function to read the zones of a layer as (name, geometry) in the given CRS
+# GeoJSON is in longitude/latitude unless the file names another CRS
+def read_zones(layer, crs):
+    path = zone_layers[layer]['path']
+    with span('read', path=path, bytes_read=file_size(path)), open(path) as f:
+        collection = json.load(f)
+    source_crs = collection.get('crs', {}).get('properties', {}).get('name', 'EPSG:4326')
+    zones = []
+    for n_feature, feature in enumerate(collection['features'], 1):
+        if not feature.get('geometry'):
+            continue
+        name = (feature.get('properties') or {}).get(zone_layers[layer]['name_field'], f"{layer} {n_feature}")
+        zones.append((str(name), transform_geom(CRS.from_user_input(source_crs), crs, feature['geometry'])))
+    return zones
+
+# Function to get the label raster of a layer on a grid: 0 outside every zone, n for the n-th zone
+# Where zones overlap, the later zone in the file keeps the pixel
+def build_labels(layer, crs, transform, shape):
+    zones = read_zones(layer, crs)
+    with span('rasterize', layer=layer, zones=len(zones), pixels=int(np.prod(shape))):
+        labels = rasterize(((geometry, n_zone) for n_zone, (_, geometry) in enumerate(zones, 1)),
+                           out_shape=shape, transform=transform, fill=0, all_touched=all_touched, dtype=np.int32)
+    return labels, [name for name, _ in zones]
+
+# Function to get the label raster of a layer on a grid, from memory, disk or by rasterizing the polygons
+# The cache key holds the content of the polygon file, so edited boundaries are rasterized again
+def get_labels(layer, crs, transform, shape):
+    key = hashlib.sha256(json.dumps([input_hash(zone_layers[layer]['path']), grid_signature(crs, transform, shape),
+                                     all_touched]).encode()).hexdigest()[:16]
+    if (layer, key) in _labels_memo:
+        return _labels_memo[(layer, key)]
+    labels_path = os.path.join(label_folder, f"{layer}_{key}.npy")
+    names_path = os.path.join(label_folder, f"{layer}_{key}.json")
+    if os.path.exists(labels_path) and os.path.exists(names_path):
+        labels = np.load(labels_path)
+        with open(names_path) as f:
+            names = json.load(f)
+    else:
+        log(f"Rasterizing the {layer} zones onto a {shape[0]}x{shape[1]} grid...")
+        labels, names = build_labels(layer, crs, transform, shape)
+        os.makedirs(label_folder, exist_ok=True)
+        np.save(labels_path, labels)
+        with open(names_path, 'w') as f:
+            json.dump(names, f)
+    _labels_memo[(layer, key)] = zone_index(labels, names)
+    return _labels_memo[(layer, key)]
+
+# Function to order the labelled pixels by zone once, so every statistic of every year is one reduction over segments
+def zone_index(labels, names):
+    flat = labels.ravel()
+    pixels = np.flatnonzero(flat)
+    order = pixels[np.argsort(flat[pixels], kind='stable')]
+    pixel_counts = np.bincount(flat[order], minlength=len(names) + 1)[1:]
+    zones = np.flatnonzero(pixel_counts)  # Zones without pixels on this grid get no statistics
+    starts = np.concatenate([[0], np.cumsum(pixel_counts[zones])[:-1]]).astype(np.int64)
+    return {'names': names, 'order': order, 'zones': zones, 'starts': starts, 'sizes': pixel_counts[zones]}
+
+# Function to compute the count, mean, min, max and standard deviation of every zone for a batch of years
+# values is (years, pixels) on the grid of the labels, NaN is nodata
+def reduce_zones(index, values):
+    ordered = values[:, index['order']].astype(np.float64)
+    valid = ~np.isnan(ordered)
+    starts = index['starts']
+    count = np.add.reduceat(valid.astype(np.int64), starts, axis=1)
+    total = np.add.reduceat(np.where(valid, ordered, 0), starts, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+        deviations = np.where(valid, ordered - np.repeat(mean, index['sizes'], axis=1), 0)
+        std = np.sqrt(np.add.reduceat(deviations * deviations, starts, axis=1) / count)
+    # fmin and fmax skip NaN, they give NaN only for zones with no valid pixel
+    minimum = np.fmin.reduceat(ordered, starts, axis=1)
+    maximum = np.fmax.reduceat(ordered, starts, axis=1)
+    return {'count': count, 'mean': mean, 'min': minimum, 'max': maximum, 'std': std}
+
+# Function to read a batch of rasters onto the chosen grid as one (years, rows, cols) stack, with that grid
+def read_batch(paths, dem_data):
+    sources = [read_source(path) for path in paths]
+    array, crs, transform = sources[0]
+    if dem_data is None:
+        return np.stack([source[0] for source in sources]), crs, transform
+    index = get_index(crs, transform, array.shape, dem_data.rio.crs, dem_data.rio.transform(), dem_data.shape)
+    stack = apply_index(index, np.stack([source[0] for source in sources]))
+    return stack, dem_data.rio.crs, dem_data.rio.transform()
+
+# Function to compute the statistics of every zone of every layer for every year of one band, as long-format rows
+def band_zonal_statistics(band, entries, dem_data=None):
+    rows = []
+    layers = [layer for layer in zone_layers if os.path.exists(zone_layers[layer]['path'])]
+    with span('zonal_statistics', band=band, years=len(entries)):
+        for batch_start in range(0, len(entries), years_per_batch):
+            batch = entries[batch_start:batch_start + years_per_batch]
+            stack, crs, transform = read_batch([entry['path'] for entry in batch], dem_data)
+            values = stack.reshape(len(batch), -1)
+            for layer in layers:
+                index = get_labels(layer, crs, transform, stack.shape[1:])
+                if not len(index['zones']):
+                    continue
+                with span('reduce', layer=layer, zones=len(index['zones']), rasters=len(batch)):
+                    stats = reduce_zones(index, values)
+                for n_year, entry in enumerate(batch):
+                    for n_zone, zone in enumerate(index['zones']):
+                        rows.append({
+                            'layer': layer, 'zone_id': int(zone) + 1, 'zone': index['names'][zone], 'band': band,
+                            'year': entry['year'], 'pixels': int(index['sizes'][n_zone]),
+                            **{name: stats[name][n_year, n_zone] for name in ('count', 'mean', 'min', 'max', 'std')}
+                        })
+    return rows
+
+# Function to compute the zonal statistics of every band of the source folder and save them as one long table
+def compute_zonal_statistics(output_path=None):
+    output_path = output_path or zonal_csv_path
+    missing = [zone_layers[layer]['path'] for layer in zone_layers if not os.path.exists(zone_layers[layer]['path'])]
+    for path in missing:
+        log(f"Zone layer {path} not found, skipping it")
+    if len(missing) == len(zone_layers):
+        return None
+    dem_data = None
+    if zonal_grid == 'dem':
+        with span('read', path=dem_path, bytes_read=file_size(dem_path)):
+            dem_data = riox.open_rasterio(dem_path)[0]
+    entries = [entry for entry in get_entries(folder=band_store.source_folder) if entry['valid_count']]
+    rows = []
+    for band in sorted({entry['band'] for entry in entries}):
+        band_entries = [entry for entry in entries if entry['band'] == band]
+        rows.extend(band_zonal_statistics(band, band_entries, dem_data))
+        log(f"Zonal statistics of {band} computed for {len(band_entries)} years")
+    table = pd.DataFrame(rows, columns=['layer', 'zone_id', 'zone', 'band', 'year', 'pixels', 'count', 'mean', 'min', 'max', 'std'])
+    with span('write', path=output_path) as args:
+        table.to_csv(output_path, index=False)
+        args['bytes_written'] = file_size(output_path)
+    log(f"Zonal statistics of {len(table)} zone-years saved to {output_path}")
+    return table
+
+if __name__ == '__main__':
+    start_trace()
+    refresh_catalog()
+    compute_zonal_statistics()